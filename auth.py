@@ -0,0 +1,318 @@
+"""
+Authentication for the API: users, bcrypt, JWTs and per-user rate limits.
+
+  * Passwords are bcrypt-hashed on a small thread pool (BCRYPT_WORKERS), never
+    on the event loop. At most BCRYPT_MAX_PENDING hash/verify calls may be
+    queued or running; beyond that logins get a 503 rather than waiting behind
+    a queue of ~0.3 s jobs.
+  * Tokens are HS256 JWTs. Decoded claims are cached for TOKEN_CACHE_TTL
+    seconds (never past the token's own exp), so repeat requests skip
+    signature verification.
+  * A token bucket per user (per client IP for anonymous calls) guards
+    inference: RATE_LIMIT_PER_MIN sustained, RATE_LIMIT_BURST at once.
+    Logins have their own, stricter bucket per email, registrations one per
+    client IP. Registration answers the same way for new and already
+    registered emails (and hashes the password either way), so it cannot be
+    used to find out who has an account.
+
+With AUTH_REQUIRED=1 protected endpoints reject anonymous requests. Otherwise a
+missing token is allowed (the current frontend sends none), but an invalid or
+expired one is still rejected. Users are stored in SQLite at AUTH_DB.
+
+hash_password / verify_password / create_token keep the names of
+backend/auth.py; hashes are standard $2b$ bcrypt, so hashes made there verify
+here.
+"""
+import asyncio
+import logging
+import math
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+from fastapi import Depends, Header, HTTPException, Request
+from jose import JWTError, jwt
+
+import metrics
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+AUTH_DB = os.environ.get("AUTH_DB", os.path.join(BASE_DIR, "data", "users.db"))
+AUTH_REQUIRED = os.environ.get("AUTH_REQUIRED", "0") == "1"
+
+SECRET_KEY = os.environ.get("SECRET_KEY", "")
+if not SECRET_KEY:
+    SECRET_KEY = secrets.token_urlsafe(32)
+    log.warning("SECRET_KEY not set; using a random key (tokens will not survive a restart or work across workers)")
+ALGORITHM = "HS256"
+TOKEN_TTL_SECONDS = int(os.environ.get("TOKEN_TTL_SECONDS", str(24 * 3600)))
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+BCRYPT_WORKERS = int(os.environ.get("BCRYPT_WORKERS", "2"))
+BCRYPT_MAX_PENDING = int(os.environ.get("BCRYPT_MAX_PENDING", "16"))
+
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", "60"))
+TOKEN_CACHE_SIZE = 10000
+
+RATE_LIMIT_PER_MIN = float(os.environ.get("RATE_LIMIT_PER_MIN", "60"))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "10"))
+LOGIN_LIMIT_PER_MIN = float(os.environ.get("LOGIN_LIMIT_PER_MIN", "10"))
+REGISTER_LIMIT_PER_MIN = float(os.environ.get("REGISTER_LIMIT_PER_MIN", "5"))
+MIN_PASSWORD_LENGTH = 8
+
+AUTH_OUTCOMES = metrics.REGISTRY.counter("skin_auth_total", "Authentication outcomes")
+RATE_LIMITED = metrics.REGISTRY.counter("skin_rate_limited_total", "Requests refused by a rate limiter")
+
+
+# ---------- PASSWORDS AND TOKENS ----------
+def _secret(password: str) -> bytes:
+    # bcrypt only reads the first 72 bytes
+    return password.encode("utf-8")[:72]
+
+
+def hash_password(password):
+    return bcrypt.hashpw(_secret(password), bcrypt.gensalt(BCRYPT_ROUNDS)).decode("ascii")
+
+
+def verify_password(password, hashed):
+    try:
+        return bcrypt.checkpw(_secret(password), hashed.encode("ascii"))
+    except ValueError:
+        return False
+
+
+def create_token(email, ttl=TOKEN_TTL_SECONDS):
+    now = int(time.time())
+    return jwt.encode({"sub": email, "iat": now, "exp": now + ttl}, SECRET_KEY, algorithm=ALGORITHM)
+
+
+class BcryptPool:
+    """bcrypt on worker threads (it releases the GIL), with a cap on queued + running calls"""
+
+    def __init__(self, workers=BCRYPT_WORKERS, max_pending=BCRYPT_MAX_PENDING):
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._dummy = None
+        self._dummy_lock = threading.Lock()
+
+    async def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            AUTH_OUTCOMES.inc(outcome="bcrypt_busy")
+            raise HTTPException(status_code=503, detail="Too many logins in progress, retry shortly",
+                                headers={"Retry-After": "1"})
+        future = self._executor.submit(fn, *args)
+        # released when the work finishes, even if the awaiting request is cancelled
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
+
+    def _verify_or_dummy(self, password, hashed):
+        if hashed is None:
+            # unknown user: spend the same time as a real check
+            with self._dummy_lock:
+                if self._dummy is None:
+                    self._dummy = hash_password(secrets.token_urlsafe(16))
+            verify_password(password, self._dummy)
+            return False
+        return verify_password(password, hashed)
+
+    async def hash(self, password):
+        return await self.run(hash_password, password)
+
+    async def verify(self, password, hashed):
+        return await self.run(self._verify_or_dummy, password, hashed)
+
+
+class TokenCache:
+    """Decoded claims by token, each kept for at most `ttl` seconds and never past its exp"""
+
+    def __init__(self, ttl=TOKEN_CACHE_TTL, max_size=TOKEN_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return entry[0]
+
+    def put(self, token, claims):
+        keep = min(self.ttl, claims.get("exp", 0) - time.time())
+        if keep <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (claims, time.monotonic() + keep)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class RateLimiter:
+    """Token bucket per key: `per_minute` sustained, up to `burst` at once (per_minute <= 0 disables)"""
+
+    def __init__(self, per_minute, burst, max_keys=100000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """0 if allowed, otherwise seconds until a request would be"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                if len(self._buckets) > self.max_keys:
+                    self._prune(now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def _prune(self, now):
+        # buckets that have refilled completely carry no state
+        full = [k for k, (tokens, last) in self._buckets.items() if tokens + (now - last) * self.rate >= self.burst]
+        for k in full:
+            del self._buckets[k]
+
+
+# ---------- USERS ----------
+class UserStore:
+    def __init__(self, path=AUTH_DB):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, password_hash TEXT NOT NULL, "
+                         "created TEXT NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path)
+        return conn
+
+    def password_hash(self, email):
+        row = self._conn().execute("SELECT password_hash FROM users WHERE email = ?", (email,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, email, password_hash):
+        """False if the email is already registered"""
+        try:
+            with self._conn() as conn:
+                conn.execute("INSERT INTO users VALUES (?, ?, ?)",
+                             (email, password_hash, time.strftime("%Y-%m-%d %H:%M:%S")))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+
+BCRYPT = BcryptPool()
+TOKENS = TokenCache()
+INFERENCE_LIMITER = RateLimiter(RATE_LIMIT_PER_MIN, RATE_LIMIT_BURST)
+LOGIN_LIMITER = RateLimiter(LOGIN_LIMIT_PER_MIN, max(1, int(LOGIN_LIMIT_PER_MIN // 2)))
+REGISTER_LIMITER = RateLimiter(REGISTER_LIMIT_PER_MIN, max(1, int(REGISTER_LIMIT_PER_MIN // 2)))
+_users = None
+
+
+def users():
+    global _users
+    if _users is None:
+        _users = UserStore()
+    return _users
+
+
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+
+def _too_many(wait):
+    RATE_LIMITED.inc()
+    return HTTPException(status_code=429, detail="Rate limit exceeded", headers={"Retry-After": str(math.ceil(wait))})
+
+
+def client_ip(request: Request):
+    return request.client.host if request.client else "unknown"
+
+
+def token_response(email):
+    return {"access_token": create_token(email), "token_type": "bearer", "expires_in": TOKEN_TTL_SECONDS}
+
+
+async def register(email, password, ip):
+    """Same answer whether or not the email was already registered; the client logs in next"""
+    wait = REGISTER_LIMITER.acquire(f"ip:{ip}")
+    if wait > 0:
+        raise _too_many(wait)
+    email = normalize_email(email)
+    if "@" not in email or len(password) < MIN_PASSWORD_LENGTH:
+        raise HTTPException(status_code=400,
+                            detail=f"A valid email and a password of at least {MIN_PASSWORD_LENGTH} characters are required")
+    hashed = await BCRYPT.hash(password)
+    AUTH_OUTCOMES.inc(outcome="registered" if users().add(email, hashed) else "register_existing")
+    return {"status": "accepted", "detail": "If this email was not registered yet, the account is ready. Log in to continue."}
+
+
+async def login(email, password):
+    email = normalize_email(email)
+    wait = LOGIN_LIMITER.acquire(email)
+    if wait > 0:
+        raise _too_many(wait)
+    if not await BCRYPT.verify(password, users().password_hash(email)):
+        AUTH_OUTCOMES.inc(outcome="bad_credentials")
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    AUTH_OUTCOMES.inc(outcome="login")
+    return token_response(email)
+
+
+def decode_token(token):
+    """Claims of a valid token (cached); 401 otherwise"""
+    claims = TOKENS.get(token)
+    if claims is not None:
+        return claims
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        AUTH_OUTCOMES.inc(outcome="invalid_token")
+        raise HTTPException(status_code=401, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"})
+    TOKENS.put(token, claims)
+    return claims
+
+
+# ---------- DEPENDENCIES ----------
+async def current_user(authorization: str = Header("")) -> Optional[dict]:
+    """Claims of the bearer token; None for anonymous requests unless AUTH_REQUIRED"""
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        if AUTH_REQUIRED:
+            AUTH_OUTCOMES.inc(outcome="missing_token")
+            raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+        return None
+    return decode_token(token.strip())
+
+
+async def inference_quota(request: Request, user: Optional[dict] = Depends(current_user)) -> Optional[dict]:
+    """current_user, plus the per-user (or per-IP) inference rate limit"""
+    key = f"user:{user['sub']}" if user else f"ip:{client_ip(request)}"
+    wait = INFERENCE_LIMITER.acquire(key)
+    if wait > 0:
+        raise _too_many(wait)
+    return user
@@ -0,0 +1,220 @@
+"""
+CPU inference autotuner.
+
+Sweeps TensorFlow intra/inter-op thread counts, concurrent worker processes
+and batch sizes against the real model with synthetic inputs, prints a
+throughput vs p99 latency table (Pareto-optimal rows marked with *) and writes
+the chosen settings to perf_profile.json, which main.py applies at startup.
+
+Usage (from the repo root):
+    python autotune.py                       # full sweep, writes perf_profile.json
+    python autotune.py --p99-budget-ms 400   # best throughput under a latency budget
+    python autotune.py --dry-run             # print the table only
+
+Thread settings can only be applied before TensorFlow initializes, so every
+configuration runs in fresh subprocesses (one per simulated uvicorn worker).
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from perf_profile import PROFILE_PATH, save_profile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL = os.path.join(BASE_DIR, "backend", "ai_model", "final_skin_model_B2_90plus.keras")
+
+
+# ---------- WORKER (runs in a subprocess) ----------
+def worker_main(args):
+    """Load the model with the given thread settings, wait for GO, then measure."""
+    import numpy as np
+    import tensorflow as tf
+    from perf_profile import apply_threading
+
+    apply_threading(tf, {"intra_op_threads": args.intra, "inter_op_threads": args.inter})
+    from tensorflow.keras.models import load_model
+    from tensorflow.keras.applications.efficientnet import preprocess_input
+
+    model = load_model(args.model)
+    rng = np.random.default_rng(os.getpid())
+    batches = {}
+    for n in args.batch_sizes:
+        raw = rng.integers(0, 256, size=(n, args.img_size, args.img_size, 3)).astype(np.float32)
+        batches[n] = preprocess_input(raw)
+        model.predict(batches[n], batch_size=n, verbose=0)  # warm-up per shape
+
+    print("READY", flush=True)
+    sys.stdin.readline()  # wait for GO so all workers start together
+
+    results = {}
+    for n in args.batch_sizes:
+        lat = []
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            model.predict(batches[n], batch_size=n, verbose=0)
+            lat.append((time.perf_counter() - t0) * 1000)
+        results[n] = lat
+        print("NEXT", flush=True)
+        sys.stdin.readline()
+    print(json.dumps(results), flush=True)
+
+
+# ---------- DRIVER ----------
+def run_config(args, intra, inter, workers):
+    """Run one (threads, workers) config over every batch size; returns a list of rows."""
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--worker",
+        "--model", args.model, "--img-size", str(args.img_size),
+        "--intra", str(intra), "--inter", str(inter),
+        "--duration", str(args.duration),
+        "--batch-sizes", *[str(b) for b in args.batch_sizes],
+    ]
+    env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL="2")
+    procs = [
+        subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, env=env)
+        for _ in range(workers)
+    ]
+
+    def _expect(token):
+        for p in procs:
+            line = p.stdout.readline().strip()
+            if line != token:
+                raise RuntimeError(f"worker {p.pid} said {line!r}, expected {token}")
+
+    def _go():
+        for p in procs:
+            p.stdin.write("GO\n")
+            p.stdin.flush()
+
+    try:
+        _expect("READY")
+        for _ in args.batch_sizes:
+            _go()
+            _expect("NEXT")
+        _go()
+        per_worker = [json.loads(p.stdout.readline()) for p in procs]
+    finally:
+        for p in procs:
+            p.wait(timeout=60)
+
+    import numpy as np
+    rows = []
+    for n in args.batch_sizes:
+        lat = np.concatenate([np.asarray(w[str(n)]) for w in per_worker])
+        images = len(lat) * n
+        rows.append({
+            "intra_op_threads": intra,
+            "inter_op_threads": inter,
+            "workers": workers,
+            "batch_size": n,
+            "throughput_ips": round(images / args.duration, 2),
+            "p50_ms": round(float(np.percentile(lat, 50)), 1),
+            "p99_ms": round(float(np.percentile(lat, 99)), 1),
+        })
+    return rows
+
+
+def pareto_front(rows):
+    """Rows not dominated on (higher throughput, lower p99)."""
+    front = []
+    for r in rows:
+        dominated = any(
+            o["throughput_ips"] >= r["throughput_ips"] and o["p99_ms"] <= r["p99_ms"]
+            and (o["throughput_ips"] > r["throughput_ips"] or o["p99_ms"] < r["p99_ms"])
+            for o in rows
+        )
+        if not dominated:
+            front.append(r)
+    return front
+
+
+def choose(front, p99_budget_ms):
+    """Highest throughput (within the p99 budget if given, else the lowest-p99 point)."""
+    if not p99_budget_ms:
+        return max(front, key=lambda r: r["throughput_ips"])
+    within = [r for r in front if r["p99_ms"] <= p99_budget_ms]
+    if within:
+        return max(within, key=lambda r: r["throughput_ips"])
+    return min(front, key=lambda r: r["p99_ms"])
+
+
+def print_table(rows, front):
+    print(f"{'':1} {'intra':>5} {'inter':>5} {'workers':>7} {'batch':>5} {'img/s':>8} {'p50_ms':>8} {'p99_ms':>8}")
+    for r in sorted(rows, key=lambda r: -r["throughput_ips"]):
+        mark = "*" if r in front else " "
+        print(f"{mark:1} {r['intra_op_threads']:>5} {r['inter_op_threads']:>5} {r['workers']:>7} "
+              f"{r['batch_size']:>5} {r['throughput_ips']:>8.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+
+
+def _powers_of_two_upto(n):
+    vals, v = [], 1
+    while v <= n:
+        vals.append(v)
+        v *= 2
+    if vals[-1] != n:
+        vals.append(n)
+    return vals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.environ.get("SKIN_MODEL_PATH", DEFAULT_MODEL))
+    parser.add_argument("--img-size", type=int, default=260)
+    parser.add_argument("--intra", type=int, nargs="+", default=None, help="intra-op thread counts")
+    parser.add_argument("--inter", type=int, nargs="+", default=[1, 2], help="inter-op thread counts")
+    parser.add_argument("--workers", type=int, nargs="+", default=None, help="worker process counts")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per measurement")
+    parser.add_argument("--p99-budget-ms", type=float, default=None)
+    parser.add_argument("--allow-oversubscribe", action="store_true",
+                        help="also try workers * intra_op > cpu count")
+    parser.add_argument("--output", default=PROFILE_PATH)
+    parser.add_argument("--results-json", default=None, help="also dump every measured row here")
+    parser.add_argument("--dry-run", action="store_true", help="do not write the profile")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.intra = args.intra[0]
+        args.inter = args.inter[0]
+        return worker_main(args)
+
+    cpus = os.cpu_count() or 1
+    intra_opts = args.intra or _powers_of_two_upto(cpus)
+    worker_opts = args.workers or [w for w in _powers_of_two_upto(cpus) if w <= 4]
+
+    rows = []
+    for intra, inter, workers in itertools.product(intra_opts, args.inter, worker_opts):
+        if workers * intra > cpus and not args.allow_oversubscribe:
+            continue
+        print(f"measuring intra={intra} inter={inter} workers={workers} ...", file=sys.stderr)
+        rows.extend(run_config(args, intra, inter, workers))
+
+    if not rows:
+        raise SystemExit("No configurations to measure; check --intra/--workers")
+
+    front = pareto_front(rows)
+    print_table(rows, front)
+    best = choose(front, args.p99_budget_ms)
+    print(f"\nselected: {best}")
+
+    if args.results_json:
+        with open(args.results_json, "w") as f:
+            json.dump({"cpu_count": cpus, "rows": rows}, f, indent=2)
+
+    if not args.dry_run:
+        profile = dict(best)
+        profile["cpu_count"] = cpus
+        profile["generated_at"] = datetime.now().isoformat(timespec="seconds")
+        save_profile(profile, args.output)
+        print(f"profile written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
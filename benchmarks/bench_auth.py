@@ -0,0 +1,93 @@
+"""
+Auth throughput: bcrypt logins off the event loop, and JWT verification.
+
+Logins: `--logins` concurrent password checks through auth.BcryptPool with
+1, 2 and 4 workers, against the same checks run inline in the coroutine
+(what calling passlib from an async route does). Reports logins/s and the
+worst event-loop stall seen by a 5 ms ticker running alongside.
+
+Verification: auth.decode_token with the cache cleared before every call
+(signature check each time) vs warm, plus the rate limiter's cost per call.
+No server, model or TensorFlow needed.
+
+    python -m benchmarks.bench_auth
+    python -m benchmarks.bench_auth --logins 64 --rounds 10
+"""
+import argparse
+import asyncio
+import time
+
+import auth
+
+
+async def _ticker(stop, lags, interval=0.005):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - t0 - interval)
+
+
+async def _logins(n, hashed, pool):
+    async def inline():
+        return auth.verify_password("correct horse", hashed)
+
+    stop, lags = asyncio.Event(), []
+    ticker = asyncio.create_task(_ticker(stop, lags))
+    await asyncio.sleep(0.02)
+    t0 = time.perf_counter()
+    if pool is None:
+        results = await asyncio.gather(*(inline() for _ in range(n)))
+    else:
+        results = await asyncio.gather(*(pool.verify("correct horse", hashed) for _ in range(n)))
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    await ticker
+    assert all(results)
+    return n / elapsed, max(lags) * 1000
+
+
+def _per_call_us(fn, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def run(logins, rounds, verifies):
+    auth.BCRYPT_ROUNDS = rounds
+    hashed = auth.hash_password("correct horse")
+    print(f"bcrypt cost {rounds}, {logins} concurrent logins")
+    print(f"{'mode':<12} {'logins/s':>9} {'max_loop_stall_ms':>18}")
+    rate, stall = asyncio.run(_logins(logins, hashed, None))
+    print(f"{'inline':<12} {rate:>9.1f} {stall:>18.1f}")
+    for workers in (1, 2, 4):
+        pool = auth.BcryptPool(workers=workers, max_pending=logins)
+        rate, stall = asyncio.run(_logins(logins, hashed, pool))
+        print(f"{f'pool x{workers}':<12} {rate:>9.1f} {stall:>18.1f}")
+
+    tokens = [auth.create_token(f"user{i}@example.com") for i in range(1000)]
+    cache = auth.TOKENS
+
+    def cold(i):
+        cache._entries.clear()
+        auth.decode_token(tokens[i % len(tokens)])
+
+    cold_us = _per_call_us(cold, verifies)
+    for t in tokens:
+        auth.decode_token(t)
+    warm_us = _per_call_us(lambda i: auth.decode_token(tokens[i % len(tokens)]), verifies)
+    limiter = auth.RateLimiter(per_minute=1e9, burst=10 ** 9)
+    limit_us = _per_call_us(lambda i: limiter.acquire(f"user:{i % 1000}"), verifies)
+    print(f"{'verify':<24} {'us/call':>8} {'calls/s':>10}")
+    for name, us in (("jwt decode (no cache)", cold_us), ("jwt decode (cached)", warm_us),
+                     ("rate limiter", limit_us)):
+        print(f"{name:<24} {us:>8.1f} {1e6 / us:>10,.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=auth.BCRYPT_ROUNDS)
+    parser.add_argument("--verifies", type=int, default=20000)
+    args = parser.parse_args()
+    run(args.logins, args.rounds, args.verifies)
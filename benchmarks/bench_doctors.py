@@ -0,0 +1,125 @@
+"""
+Doctor directory at scale: build time and lookup latency.
+
+Builds a directory of synthetic doctors clustered around Indian cities, then
+times filtered lookups and nearest-doctor queries (p50/p99 in microseconds),
+with the result cache bypassed and then warm, and checks nearest results
+against an exhaustive scan. No model or TensorFlow needed.
+
+    python -m benchmarks.bench_doctors --doctors 100000
+    python -m benchmarks.bench_doctors --doctors 1000000 --queries 2000
+"""
+import argparse
+import time
+
+import numpy as np
+
+import doctor_directory
+from doctor_directory import DoctorDirectory, haversine_km
+
+CITIES = {
+    "Delhi": (28.6139, 77.2090), "Mumbai": (19.0760, 72.8777), "Bangalore": (12.9716, 77.5946),
+    "Hyderabad": (17.3850, 78.4867), "Chennai": (13.0827, 80.2707), "Kolkata": (22.5726, 88.3639),
+    "Pune": (18.5204, 73.8567), "Ahmedabad": (23.0225, 72.5714), "Jaipur": (26.9124, 75.7873),
+    "Lucknow": (26.8467, 80.9462), "Kochi": (9.9312, 76.2673), "Chandigarh": (30.7333, 76.7794),
+}
+DISEASES = ["Melanoma", "Basal Cell Carcinoma", "Nevus", "Benign Keratosis-like Lesions", "Vascular Lesion",
+            "Actinic Keratosis", "Dermatofibroma"]
+SPECIALTIES = ["Dermatologist", "Dermato-Oncologist", "Mohs Surgeon", "Plastic Surgeon", "Cosmetic Dermatologist",
+               "Surgical Oncologist", "General Practitioner"]
+
+
+def synthetic_records(n, rng):
+    names = list(CITIES)
+    city = rng.integers(0, len(names), n)
+    centers = np.array([CITIES[c] for c in names])
+    # most doctors near a city centre, some spread across the region
+    spread = np.where(rng.random(n) < 0.8, 0.3, 3.0)[:, None]
+    coords = centers[city] + spread * rng.standard_normal((n, 2))
+    records = []
+    for i in range(n):
+        diseases = rng.choice(len(DISEASES), rng.integers(1, 3), replace=False)
+        records.append({
+            "name": f"Dr. Synthetic {i}",
+            "specialist": SPECIALTIES[rng.integers(0, len(SPECIALTIES))],
+            "hospital": f"Hospital {i % 997}",
+            "city": names[city[i]],
+            "contact": f"+91-9{i:09d}",
+            "diseases": [DISEASES[d] for d in diseases],
+            "lat": float(coords[i, 0]),
+            "lon": float(coords[i, 1]),
+        })
+    return records
+
+
+def _timed_us(fn, queries):
+    times = []
+    for q in queries:
+        t0 = time.perf_counter()
+        fn(q)
+        times.append((time.perf_counter() - t0) * 1e6)
+    return np.median(times), np.percentile(times, 99)
+
+
+def run(n, n_queries, k):
+    rng = np.random.default_rng(0)
+    t0 = time.perf_counter()
+    records = synthetic_records(n, rng)
+    gen_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    directory = DoctorDirectory(records, cache_size=0)
+    build_s = time.perf_counter() - t0
+    status = directory.status()
+    print(f"doctors: {n:,}  generate: {gen_s:.1f}s  build: {build_s:.2f}s  grid cells: {status['grid_cells']}")
+
+    lats = rng.uniform(8, 32, n_queries)
+    lons = rng.uniform(70, 90, n_queries)
+    diseases = rng.choice(DISEASES, n_queries)
+    cities = rng.choice(list(CITIES), n_queries)
+    specialties = rng.choice(SPECIALTIES, n_queries)
+    idx = range(n_queries)
+    cases = [
+        ("disease", lambda i: directory._search(doctor_directory.normalize(diseases[i]), "", "", None, None, 0, 20)),
+        ("disease+city", lambda i: directory._search(doctor_directory.normalize(diseases[i]), "",
+                                                     doctor_directory.normalize(cities[i]), None, None, 0, 20)),
+        ("disease+city+specialty", lambda i: directory._search(
+            doctor_directory.normalize(diseases[i]), doctor_directory.normalize(specialties[i]),
+            doctor_directory.normalize(cities[i]), None, None, 0, 20)),
+        (f"nearest k={k}", lambda i: directory.nearest(lats[i], lons[i], k)),
+        (f"nearest k={k} +disease", lambda i: directory._search(
+            doctor_directory.normalize(diseases[i]), "", "", lats[i], lons[i], 0, k)),
+        (f"nearest k={k} +disease+city", lambda i: directory._search(
+            doctor_directory.normalize(diseases[i]), "", doctor_directory.normalize(cities[i]), lats[i], lons[i], 0, k)),
+        (f"nearest k={k} page 5", lambda i: directory._search("", "", "", lats[i], lons[i], 4 * k, k)),
+    ]
+    print(f"{'query':<26} {'p50_us':>9} {'p99_us':>9}")
+    for name, fn in cases:
+        p50, p99 = _timed_us(fn, idx)
+        print(f"{name:<26} {p50:>9.1f} {p99:>9.1f}")
+
+    cached = DoctorDirectory(records)
+    for i in idx:
+        cached.search(diseases[i], lat=lats[i], lon=lons[i], limit=k)
+    p50, p99 = _timed_us(lambda i: cached.search(diseases[i], lat=lats[i], lon=lons[i], limit=k), idx)
+    print(f"{'cached nearest +disease':<26} {p50:>9.1f} {p99:>9.1f}")
+
+    # grid results must match an exhaustive scan
+    checked = min(n_queries, 200)
+    mismatches = 0
+    for i in range(checked):
+        disease = doctor_directory.normalize(diseases[i])
+        for rows, name in ((np.arange(n), ""), (directory.by_disease[disease], disease)):
+            _, dist = directory.nearest(lats[i], lons[i], k, name)
+            exact = np.sort(haversine_km(np.radians(lats[i]), np.radians(lons[i]),
+                                         directory._lat[rows], directory._lon[rows]))[:k]
+            mismatches += not np.allclose(dist, exact)
+    print(f"nearest vs exhaustive: {mismatches} mismatches in {2 * checked} queries")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--doctors", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    run(args.doctors, args.queries, args.k)
@@ -0,0 +1,87 @@
+"""
+Grad-CAM vs forward-only CAM: latency and heatmap agreement.
+
+Each method is timed the way /predict runs it:
+  gradcam: model.predict + make_gradcam (forward, then forward + backward)
+  cam:     one forward pass for predictions + conv features, then a matmul
+
+Agreement is the Pearson correlation of the two heatmaps and the IoU of their
+top-20% regions, on synthetic lesion images.
+
+    python -m benchmarks.bench_explain --images 50
+"""
+import argparse
+import time
+
+import numpy as np
+
+import main
+from benchmarks.synthetic import synthetic_lesion
+
+
+def _gradcam(x, mv):
+    preds = np.asarray(mv.model.predict(x, verbose=0))
+    return preds, main.make_gradcam(x, mv)
+
+
+def _cam(x, mv):
+    preds, conv = main.forward_with_features(x, mv)
+    return preds, main.make_cam(conv, int(np.argmax(preds[0])), mv)
+
+
+def _top_iou(a, b, frac=0.2):
+    ma = a >= np.quantile(a, 1 - frac)
+    mb = b >= np.quantile(b, 1 - frac)
+    union = np.logical_or(ma, mb).sum()
+    return float(np.logical_and(ma, mb).sum() / union) if union else 1.0
+
+
+def run(n_images, seed):
+    mv = main.MODELS.get()
+    if mv is None:
+        raise SystemExit("Model not loaded; check MODEL_PATH")
+    if not main.cam_supported(mv):
+        raise SystemExit(f"Model head does not support forward-only CAM (layer {mv.last_conv_layer})")
+
+    rng = np.random.default_rng(seed)
+    inputs = [main.prepare_input(synthetic_lesion(rng), mv.img_size)[0] for _ in range(n_images)]
+
+    # warm both paths
+    _gradcam(inputs[0], mv)
+    _cam(inputs[0], mv)
+
+    times = {"gradcam": [], "cam": []}
+    corr, iou, same_class = [], [], 0
+    for x in inputs:
+        t0 = time.perf_counter()
+        p_g, h_g = _gradcam(x, mv)
+        times["gradcam"].append((time.perf_counter() - t0) * 1000)
+
+        t0 = time.perf_counter()
+        p_c, h_c = _cam(x, mv)
+        times["cam"].append((time.perf_counter() - t0) * 1000)
+
+        same_class += int(np.argmax(p_g[0]) == np.argmax(p_c[0]))
+        if h_g is not None and h_c is not None and h_g.std() > 0 and h_c.std() > 0:
+            corr.append(float(np.corrcoef(h_g.ravel(), h_c.ravel())[0, 1]))
+            iou.append(_top_iou(h_g, h_c))
+
+    g, c = np.median(times["gradcam"]), np.median(times["cam"])
+    print(f"images: {n_images}  model: {mv.name}  conv layer: {mv.last_conv_layer}")
+    print(f"{'method':<8} {'p50_ms':>8} {'p95_ms':>8}")
+    for name in ("gradcam", "cam"):
+        t = np.asarray(times[name])
+        print(f"{name:<8} {np.median(t):>8.1f} {np.percentile(t, 95):>8.1f}")
+    print(f"speedup (p50): x{g / c:.2f}")
+    print(f"same predicted class: {same_class}/{n_images}")
+    if corr:
+        print(f"heatmap correlation: mean {np.mean(corr):.3f}, min {np.min(corr):.3f}")
+        print(f"top-20% IoU: mean {np.mean(iou):.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.images, args.seed)
@@ -0,0 +1,84 @@
+"""
+Interactive latency while an evaluation job is running.
+
+Simulates model calls with a CPU-bound numpy kernel (`--chunk-ms` per
+evaluation batch, `--predict-ms` per upload). An evaluation job of `--chunks`
+batches runs in the background while uploads arrive every 50 ms; prints upload
+latency p50/p99 and evaluation wall time for:
+
+  * unscheduled   both call the "model" directly from their own threads
+  * whole job     evaluation submitted as one scheduler item (old behaviour)
+  * chunked       evaluation submitted per batch, shares unlimited
+  * chunked+cap   as above with evaluation capped at `--share`
+
+No server, model or TensorFlow needed.
+
+    python -m benchmarks.bench_scheduler
+    python -m benchmarks.bench_scheduler --chunks 60 --share 0.3
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from scheduler import InferenceScheduler
+
+_A = np.random.default_rng(0).random((128, 128))
+
+
+def burn(ms):
+    """Busy CPU for about `ms` milliseconds"""
+    end = time.perf_counter() + ms / 1000
+    while time.perf_counter() < end:
+        _A @ _A
+
+
+def _run(mode, chunks, chunk_ms, predict_ms, uploads, share):
+    sched = None
+    if mode != "unscheduled":
+        sched = InferenceScheduler(workers=1, shares=f"evaluation={share if mode == 'chunked+cap' else 1.0}",
+                                   window=2.0)
+
+    def evaluation():
+        if sched is None:
+            for _ in range(chunks):
+                burn(chunk_ms)
+        elif mode == "whole job":
+            sched.run("evaluation", lambda: [burn(chunk_ms) for _ in range(chunks)])
+        else:
+            sched.map_chunks("evaluation", lambda c: burn(chunk_ms), list(range(chunks)), 1)
+
+    t0 = time.perf_counter()
+    job = threading.Thread(target=evaluation)
+    job.start()
+    latencies = []
+    for _ in range(uploads):
+        time.sleep(0.05)
+        s = time.perf_counter()
+        if sched is None:
+            burn(predict_ms)
+        else:
+            sched.run("interactive", burn, predict_ms)
+        latencies.append((time.perf_counter() - s) * 1000)
+    job.join()
+    return np.percentile(latencies, 50), np.percentile(latencies, 99), time.perf_counter() - t0
+
+
+def run(chunks, chunk_ms, predict_ms, uploads, share):
+    print(f"evaluation: {chunks} x {chunk_ms} ms, uploads: {uploads} x {predict_ms} ms")
+    print(f"{'mode':<14} {'upload_p50_ms':>14} {'upload_p99_ms':>14} {'eval_wall_s':>12}")
+    for mode in ("unscheduled", "whole job", "chunked", "chunked+cap"):
+        p50, p99, wall = _run(mode, chunks, chunk_ms, predict_ms, uploads, share)
+        print(f"{mode:<14} {p50:>14.1f} {p99:>14.1f} {wall:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=40)
+    parser.add_argument("--chunk-ms", type=float, default=50)
+    parser.add_argument("--predict-ms", type=float, default=20)
+    parser.add_argument("--uploads", type=int, default=30)
+    parser.add_argument("--share", type=float, default=0.5)
+    args = parser.parse_args()
+    run(args.chunks, args.chunk_ms, args.predict_ms, args.uploads, args.share)
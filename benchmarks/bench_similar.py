@@ -0,0 +1,109 @@
+"""
+Embedding index at scale: insert throughput, query latency and recall.
+
+Builds an index of synthetic clustered embeddings (B2's penultimate layer is
+1408-d) in a temporary directory, trains the IVF partitions, then measures
+single-insert latency, query latency (p50/p99) against exhaustive search,
+recall@k, and reload time from disk. No model or TensorFlow needed.
+
+    python -m benchmarks.bench_similar --entries 1000000
+    python -m benchmarks.bench_similar --entries 100000 --nprobe 8 32
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import embedding_index
+from embedding_index import EmbeddingIndex
+
+
+def _clustered(rng, centers, n, noise):
+    labels = rng.integers(0, len(centers), n)
+    return centers[labels] + noise * rng.standard_normal((n, centers.shape[1])).astype(np.float32), labels
+
+
+def _exact_top(vectors, queries, k, chunk=200000):
+    """Exhaustive top-k rows by cosine similarity (vectors are unit float16 rows)"""
+    best_s = np.full((len(queries), k), -np.inf, np.float32)
+    best_i = np.zeros((len(queries), k), np.int64)
+    for start in range(0, len(vectors), chunk):
+        s = queries @ vectors[start:start + chunk].astype(np.float32).T
+        s = np.concatenate([best_s, s], axis=1)
+        i = np.concatenate([best_i, np.arange(start, start + s.shape[1] - k)[None].repeat(len(queries), 0)], axis=1)
+        top = np.argpartition(-s, k - 1, axis=1)[:, :k]
+        best_s, best_i = np.take_along_axis(s, top, 1), np.take_along_axis(i, top, 1)
+    return best_i
+
+
+def run(entries, dim_in, nprobes, k, queries, batch, path):
+    # train explicitly below instead of in the background while inserting
+    embedding_index.TRAIN_MIN = float("inf")
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((64, dim_in)).astype(np.float32)
+    workdir = path or tempfile.mkdtemp(prefix="skin-embeddings-")
+    try:
+        idx = EmbeddingIndex(workdir, dim_in)
+        t0 = time.perf_counter()
+        for start in range(0, entries, batch):
+            n = min(batch, entries - start)
+            x, labels = _clustered(rng, centers, n, 0.8)
+            idx.add([f"p{start + i}" for i in range(n)], x,
+                    [(f"c{lab % 7}", 90.0, "2024-01-01") for lab in labels])
+        build_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        idx.train()
+        train_s = time.perf_counter() - t0
+
+        single = []
+        for i in range(200):
+            x, _ = _clustered(rng, centers, 1, 0.8)
+            t0 = time.perf_counter()
+            idx.add([f"s{i}"], x, [("c0", 90.0, "2024-01-01")])
+            single.append((time.perf_counter() - t0) * 1000)
+
+        qx, _ = _clustered(rng, centers, queries, 0.8)
+        q = idx.project(qx)
+        vectors = idx._vectors.view
+
+        t0 = time.perf_counter()
+        exact = _exact_top(vectors, q, k)
+        exhaustive_ms = (time.perf_counter() - t0) * 1000 / queries
+
+        print(f"entries: {len(idx)}  dim: {dim_in}->{idx.dim}  lists: {len(idx._lists)}  "
+              f"size on disk: {len(idx) * idx.dim * 2 / 1e6:.0f} MB vectors")
+        print(f"bulk insert: {entries / build_s:,.0f} rows/s  train: {train_s:.1f}s  "
+              f"single insert p50 {np.median(single):.2f} ms, p99 {np.percentile(single, 99):.2f} ms")
+        print(f"exhaustive search: {exhaustive_ms:.1f} ms/query")
+        print(f"{'nprobe':>7} {'p50_ms':>8} {'p99_ms':>8} {'recall@' + str(k):>10}")
+        for nprobe in nprobes:
+            idx.nprobe = nprobe
+            times, hits = [], 0
+            for i in range(queries):
+                t0 = time.perf_counter()
+                found = idx.search(q[i], k)
+                times.append((time.perf_counter() - t0) * 1000)
+                hits += len({r for r, _ in found} & set(exact[i].tolist()))
+            print(f"{nprobe:>7} {np.median(times):>8.2f} {np.percentile(times, 99):>8.2f} {hits / (queries * k):>10.3f}")
+
+        t0 = time.perf_counter()
+        EmbeddingIndex(workdir, dim_in)
+        print(f"reload from disk: {time.perf_counter() - t0:.1f}s")
+    finally:
+        if not path:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--dim-in", type=int, default=1408)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=20000, help="rows per bulk insert")
+    parser.add_argument("--path", default=None, help="keep the index here instead of a temp dir")
+    args = parser.parse_args()
+    run(args.entries, args.dim_in, args.nprobe, args.k, args.queries, args.batch, args.path)
@@ -0,0 +1,68 @@
+"""
+Cost of top-k Grad-CAM heatmaps: one tape per class vs one vectorized pass.
+
+  per_class: k separate forward + backward passes (rerunning Grad-CAM per class)
+  batched:   make_gradcam_topk, one forward pass and a vectorized jacobian
+             of the k class scores over the shared conv activations
+
+    python -m benchmarks.bench_topk --k 1 2 3 5 --repeats 10
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import main
+from benchmarks.synthetic import synthetic_lesion
+
+
+def _gradcam_for_class(x, class_index, mv):
+    """make_gradcam for a fixed class instead of the argmax"""
+    with tf.GradientTape() as tape:
+        conv_outputs, preds = mv.grad_model()(x)
+        loss = preds[:, class_index]
+    grads = tape.gradient(loss, conv_outputs)
+    pooled = tf.reduce_mean(grads, axis=(0, 1, 2))
+    return main._normalize_heatmap(tf.squeeze(conv_outputs[0] @ pooled[..., tf.newaxis]).numpy())
+
+
+def _median_ms(fn, repeats):
+    fn()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(times))
+
+
+def run(ks, repeats, seed):
+    mv = main.MODELS.get()
+    if mv is None or mv.grad_model() is None:
+        raise SystemExit("Model not loaded or has no conv layer; check MODEL_PATH")
+
+    x, _ = main.prepare_input(synthetic_lesion(np.random.default_rng(seed)), mv.img_size)
+    preds = np.asarray(mv.model.predict(x, verbose=0))[0]
+    order = [int(i) for i in np.argsort(preds)[::-1]]
+
+    print(f"model: {mv.name}  conv layer: {mv.last_conv_layer}")
+    print(f"{'k':>3} {'per_class_ms':>13} {'batched_ms':>11} {'speedup':>8} {'batched/k=1':>12} {'max_diff':>9}")
+    base = None
+    for k in ks:
+        idx = order[:min(k, len(order))]
+        loop = _median_ms(lambda: [_gradcam_for_class(x, i, mv) for i in idx], repeats)
+        batched = _median_ms(lambda: main.make_gradcam_topk(x, idx, mv), repeats)
+        base = base or batched
+        diff = max(float(np.abs(a - b).max()) for a, b in
+                   zip([_gradcam_for_class(x, i, mv) for i in idx], main.make_gradcam_topk(x, idx, mv)))
+        print(f"{len(idx):>3} {loop:>13.1f} {batched:>11.1f} {loop / batched:>7.2f}x {batched / base:>11.2f}x {diff:>9.1e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 2, 3, 5])
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.k, args.repeats, args.seed)
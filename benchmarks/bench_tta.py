@@ -0,0 +1,51 @@
+"""
+Latency cost of test-time augmentation vs a single view, per batch size.
+
+Run from the repo root (loads the real model through main.py):
+    python -m benchmarks.bench_tta --batch-sizes 1 4 8 16 --repeats 10
+"""
+import argparse
+import time
+
+import numpy as np
+
+import main
+
+
+def _median_ms(fn, repeats):
+    fn()  # warm-up (graph tracing, allocator)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(times))
+
+
+def run(batch_sizes, repeats):
+    if main.model is None:
+        raise SystemExit("Model not loaded; check MODEL_PATH")
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for n in batch_sizes:
+        raw = rng.integers(0, 256, size=(n, main.IMG_SIZE, main.IMG_SIZE, 3)).astype(np.float32)
+        batch = main.preprocess_input(raw)
+
+        single = _median_ms(lambda: main.model.predict(batch, batch_size=n, verbose=0), repeats)
+        tta = _median_ms(lambda: main.predict_tta(batch), repeats)
+        rows.append((n, single, tta, tta / single))
+
+    print(f"views per image: {len(main.TTA_TRANSFORMS)}")
+    print(f"{'batch':>6} {'single_ms':>10} {'tta_ms':>10} {'ratio':>7} {'tta_ms/img':>11}")
+    for n, single, tta, ratio in rows:
+        print(f"{n:>6} {single:>10.1f} {tta:>10.1f} {ratio:>7.2f} {tta / n:>11.1f}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+    run(args.batch_sizes, args.repeats)
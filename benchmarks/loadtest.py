@@ -0,0 +1,291 @@
+"""
+End-to-end load test for the Skin Lesion API.
+
+By default the app is imported and served in-process by uvicorn on a free
+local port, with predictions stored in a throwaway SQLite store seeded with
+--seed-records fake predictions. Use --url to target an already running
+server instead (pass --server-pid to sample its RSS).
+
+    python -m benchmarks.loadtest --concurrency 8 --duration 30
+    python -m benchmarks.loadtest --endpoints predict history --mix 3 1
+    python -m benchmarks.loadtest --url http://127.0.0.1:7860 --server-pid 1234
+    python -m benchmarks.loadtest --compare old.json new.json
+
+Reports p50/p95/p99 latency, requests/s and error rate per endpoint plus RSS
+over time, and writes everything to a JSON file so runs can be compared.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_lesion_jpeg
+
+ENDPOINTS = ("predict", "history", "dashboard", "evaluation")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+# ---------- SERVER ----------
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _seed_records(n, rng):
+    names = ["Melanoma", "Nevus (Common Mole)", "Basal Cell Carcinoma", "Dermatofibroma",
+             "Benign Keratosis-like Lesions (Seborrheic Keratosis)"]
+    start = datetime.now() - timedelta(days=90)
+    return [{
+        "patient_name": f"patient-{i}",
+        "prediction": names[int(rng.integers(len(names)))],
+        "confidence": round(float(rng.uniform(40, 99.9)), 2),
+        "time": str(start + timedelta(minutes=int(i))),
+    } for i in range(n)]
+
+
+def start_inprocess_server(seed_records):
+    """Import main.py, point it at a seeded throwaway SQLite store and serve it on a thread."""
+    import uvicorn
+    import main
+    from prediction_store import SQLitePredictionStore
+
+    main.STORE = SQLitePredictionStore(os.path.join(tempfile.mkdtemp(prefix="skin-loadtest-"), "predictions.db"))
+    main.STORE.insert_many(_seed_records(seed_records, np.random.default_rng(1)))
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}", server, os.getpid()
+
+
+# ---------- RSS ----------
+def read_rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid == os.getpid():
+        import resource
+        # ru_maxrss is a peak, not current, but better than nothing off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval):
+        super().__init__(daemon=True)
+        self.pid, self.interval = pid, interval
+        self.samples = []
+        self._halt = threading.Event()
+        self._t0 = time.perf_counter()
+
+    def run(self):
+        while not self._halt.is_set():
+            rss = read_rss_mb(self.pid)
+            if rss is not None:
+                self.samples.append([round(time.perf_counter() - self._t0, 2), round(rss, 1)])
+            self._halt.wait(self.interval)
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+
+# ---------- REQUESTS ----------
+def _multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data, ctype) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {ctype}\r\n\r\n'.encode() + data + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def make_request(base_url, endpoint, images, rng, timeout):
+    if endpoint == "predict":
+        body, ctype = _multipart(
+            {"patient_name": f"load-{rng.randrange(10**6)}"},
+            {"file": ("lesion.jpg", images[rng.randrange(len(images))], "image/jpeg")},
+        )
+        req = urllib.request.Request(f"{base_url}/predict", data=body, headers={"Content-Type": ctype})
+    else:
+        req = urllib.request.Request(f"{base_url}/{endpoint}")
+
+    t0 = time.perf_counter()
+    ok = True
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            payload = resp.read()
+        # the API reports most failures as 200 + {"error": ...}
+        ok = not payload.startswith(b'{"error"')
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return endpoint, (time.perf_counter() - t0) * 1000, ok
+
+
+def summarize(latencies, errors, elapsed):
+    lat = np.asarray(latencies) if latencies else np.zeros(1)
+    n = len(latencies)
+    return {
+        "requests": n,
+        "errors": errors,
+        "error_rate": round(errors / n, 4) if n else 0.0,
+        "rps": round(n / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(float(np.percentile(lat, 50)), 1),
+        "p95_ms": round(float(np.percentile(lat, 95)), 1),
+        "p99_ms": round(float(np.percentile(lat, 99)), 1),
+        "mean_ms": round(float(lat.mean()), 1),
+    }
+
+
+def run(args):
+    server = None
+    if args.url:
+        base_url, pid = args.url.rstrip("/"), args.server_pid
+    else:
+        base_url, server, pid = start_inprocess_server(args.seed_records)
+
+    np_rng = np.random.default_rng(args.seed)
+    images = [synthetic_lesion_jpeg(np_rng, args.image_size) for _ in range(args.image_pool)]
+    weights = args.mix or [1] * len(args.endpoints)
+
+    sampler = RssSampler(pid, args.rss_interval) if pid else None
+    if sampler:
+        sampler.start()
+
+    lock = threading.Lock()
+    by_endpoint = {e: {"lat": [], "errors": 0} for e in args.endpoints}
+    stop_at = time.perf_counter() + args.duration
+    remaining = [args.requests] if args.requests else None
+
+    def _worker(worker_id):
+        rng = random.Random(args.seed + worker_id)
+        while time.perf_counter() < stop_at:
+            if remaining is not None:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            endpoint = rng.choices(args.endpoints, weights=weights)[0]
+            ep, ms, ok = make_request(base_url, endpoint, images, rng, args.timeout)
+            with lock:
+                by_endpoint[ep]["lat"].append(ms)
+                by_endpoint[ep]["errors"] += 0 if ok else 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(_worker, range(args.concurrency)))
+    elapsed = time.perf_counter() - t0
+
+    if sampler:
+        sampler.stop()
+    if server:
+        server.should_exit = True
+
+    all_lat = [ms for e in by_endpoint.values() for ms in e["lat"]]
+    all_err = sum(e["errors"] for e in by_endpoint.values())
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "target": "in-process" if server else base_url,
+        "config": {
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "requests": args.requests,
+            "endpoints": list(args.endpoints),
+            "mix": list(weights),
+            "image_size": args.image_size,
+            "seed_records": None if args.url else args.seed_records,
+        },
+        "elapsed_s": round(elapsed, 2),
+        "overall": summarize(all_lat, all_err, elapsed),
+        "endpoints": {e: summarize(v["lat"], v["errors"], elapsed) for e, v in by_endpoint.items()},
+        "rss_mb": sampler.samples if sampler else [],
+    }
+
+
+def print_report(result):
+    print(f"target={result['target']} elapsed={result['elapsed_s']}s")
+    print(f"{'endpoint':<12} {'reqs':>6} {'rps':>8} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+    rows = list(result["endpoints"].items()) + [("ALL", result["overall"])]
+    for name, s in rows:
+        print(f"{name:<12} {s['requests']:>6} {s['rps']:>8.2f} {s['error_rate'] * 100:>6.1f} "
+              f"{s['p50_ms']:>8.1f} {s['p95_ms']:>8.1f} {s['p99_ms']:>8.1f}")
+    rss = [r for _, r in result["rss_mb"]]
+    if rss:
+        print(f"RSS MB: start={rss[0]:.0f} peak={max(rss):.0f} end={rss[-1]:.0f}")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'endpoint':<12} {'metric':<8} {'old':>10} {'new':>10} {'change':>8}")
+    names = sorted(set(old["endpoints"]) & set(new["endpoints"])) + ["ALL"]
+    for name in names:
+        a = old["overall"] if name == "ALL" else old["endpoints"][name]
+        b = new["overall"] if name == "ALL" else new["endpoints"][name]
+        for metric in ("rps", "p50_ms", "p95_ms", "p99_ms", "error_rate"):
+            change = (b[metric] - a[metric]) / a[metric] * 100 if a[metric] else 0.0
+            print(f"{name:<12} {metric:<8} {a[metric]:>10} {b[metric]:>10} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=None, help="target a running server instead of in-process")
+    parser.add_argument("--server-pid", type=int, default=None, help="pid to sample RSS from with --url")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=["predict", "history", "dashboard"])
+    parser.add_argument("--mix", type=float, nargs="+", default=None, help="relative weight per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=None, help="stop after this many requests")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--image-size", type=int, default=600)
+    parser.add_argument("--image-pool", type=int, default=16)
+    parser.add_argument("--seed-records", type=int, default=1000)
+    parser.add_argument("--rss-interval", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON result path")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="diff two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(*args.compare)
+    if args.mix and len(args.mix) != len(args.endpoints):
+        parser.error("--mix needs one weight per endpoint")
+
+    result = run(args)
+    print_report(result)
+
+    out = args.output or os.path.join(RESULTS_DIR, f"loadtest-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"results written to {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+Synthetic dermoscopy-like images for benchmarks: a skin-toned background with
+a darker, irregular elliptical lesion and a little sensor noise.
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+
+def synthetic_lesion(rng: np.random.Generator, size: int = 600) -> Image.Image:
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+    skin = np.array([224, 172, 142], dtype=np.float32) * rng.uniform(0.8, 1.05)
+    img = np.ones((size, size, 3), dtype=np.float32) * skin
+
+    cx, cy = rng.uniform(0.35, 0.65, size=2) * size
+    rx, ry = rng.uniform(0.12, 0.3, size=2) * size
+    angle = np.arctan2(yy - cy, xx - cx)
+    wobble = 1 + 0.15 * np.sin(angle * rng.integers(3, 7) + rng.uniform(0, np.pi))
+    dist = np.sqrt(((xx - cx) / rx) ** 2 + ((yy - cy) / ry) ** 2) / wobble
+    mask = np.clip(1.2 - dist, 0, 1)[..., None]
+
+    lesion = np.array([90, 55, 40], dtype=np.float32) * rng.uniform(0.6, 1.3)
+    img = img * (1 - mask) + lesion * mask
+    img += rng.normal(0, 6, size=img.shape)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+
+def synthetic_lesion_jpeg(rng: np.random.Generator, size: int = 600, quality: int = 90) -> bytes:
+    buf = io.BytesIO()
+    synthetic_lesion(rng, size).save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
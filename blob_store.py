@@ -0,0 +1,164 @@
+"""
+Local content-addressed blob store for uploads, model-size crops and heatmaps.
+
+A blob's key is the SHA-256 of its bytes plus an extension
+("3f9a...c1.jpg"), so identical uploads are stored once. Files are sharded
+two levels deep by hash prefix to keep directories small:
+
+    BLOB_DIR/3f/9a/3f9a...c1.jpg
+
+Writes go to a temp file and are renamed into place, so readers never see a
+partial blob. Thumbnails for the history view are generated once, at write
+time, and stored as blobs of their own.
+
+Prediction records reference blobs by key (record["blobs"]). Records moved
+to the Parquet archive by retention.py keep those references, so gc counts
+both the hot store and the archive. Blobs that no record references are
+removed with:
+
+    python blob_store.py gc --dry-run
+    python blob_store.py gc --grace-hours 24
+"""
+import argparse
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+import time
+
+from PIL import Image
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BLOB_DIR = os.environ.get("BLOB_DIR", os.path.join(BASE_DIR, "data", "blobs"))
+THUMB_SIZE = 128
+KEY_RE = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,5}$")
+
+
+def sniff_ext(data: bytes):
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:2] == b"BM":
+        return "bmp"
+    return "bin"
+
+
+def jpeg_bytes(img: Image.Image, quality=90):
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+class BlobStore:
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+
+    def path(self, key):
+        if not KEY_RE.match(key):
+            raise ValueError(f"Invalid blob key: {key}")
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, data: bytes, ext=None):
+        """Store bytes and return their key; a no-op if the content is already stored"""
+        key = f"{hashlib.sha256(data).hexdigest()}.{ext or sniff_ext(data)}"
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return key
+
+    def put_image(self, img: Image.Image, quality=90):
+        return self.put(jpeg_bytes(img, quality), "jpg")
+
+    def put_thumbnail(self, img: Image.Image, size=THUMB_SIZE):
+        thumb = img.copy()
+        thumb.thumbnail((size, size))
+        return self.put(jpeg_bytes(thumb, quality=80), "jpg")
+
+    def get(self, key):
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    def keys(self):
+        """(key, path) for every stored blob"""
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if KEY_RE.match(name):
+                    yield name, os.path.join(dirpath, name)
+
+    def gc(self, referenced, grace_seconds=24 * 3600, dry_run=False):
+        """
+        Delete blobs not in `referenced` and older than grace_seconds (younger
+        ones may belong to a request whose record is not written yet).
+        Returns (deleted_count, freed_bytes, kept_count).
+        """
+        cutoff = time.time() - grace_seconds
+        deleted = freed = kept = 0
+        for key, path in self.keys():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if key in referenced or st.st_mtime > cutoff:
+                kept += 1
+                continue
+            if not dry_run:
+                os.unlink(path)
+            deleted += 1
+            freed += st.st_size
+        return deleted, freed, kept
+
+
+def record_blob_keys(records):
+    """Blob keys referenced by prediction records (the values of record["blobs"])"""
+    keys = set()
+    for rec in records:
+        for key in (rec.get("blobs") or {}).values():
+            if key:
+                keys.add(key)
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    gc = sub.add_parser("gc", help="delete blobs no prediction record references")
+    gc.add_argument("--store", choices=["auto", "mongo", "sqlite"], default=None,
+                    help="prediction store backend (default: PREDICTION_STORE)")
+    gc.add_argument("--archive-dir", default=None, help="retention archive (default: ARCHIVE_DIR)")
+    gc.add_argument("--grace-hours", type=float, default=24.0)
+    gc.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    from prediction_store import open_store
+    import retention
+
+    referenced = record_blob_keys(open_store(args.store).scan())
+    # archived records still point at their images
+    referenced |= record_blob_keys(retention.archived_docs(args.archive_dir or retention.ARCHIVE_DIR))
+    store = BlobStore()
+    deleted, freed, kept = store.gc(referenced, args.grace_hours * 3600, args.dry_run)
+    verb = "would delete" if args.dry_run else "deleted"
+    print(f"{len(referenced)} referenced blobs; {verb} {deleted} ({freed / 1e6:.1f} MB), kept {kept}")
+
+
+if __name__ == "__main__":
+    main()
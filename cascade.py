@@ -0,0 +1,115 @@
+"""
+Confidence-gated cascade inference.
+
+A small, cheap model scores every image first. The full model only runs when
+the fast prediction is low-margin or clinically risky:
+
+  * top-1 minus top-2 probability is below `margin`, or
+  * the fast top class has severity >= `severity_min` (mel, akiec, bcc), or
+  * the summed probability of those high-severity classes is >= `risk_prob`.
+
+Thresholds live in cascade.json (CASCADE_CONFIG) and can be tuned on the
+/evaluation test set with GET /evaluation/cascade and applied with POST
+/admin/cascade (admin token).
+"""
+import itertools
+import json
+import logging
+import os
+
+import numpy as np
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CASCADE_CONFIG = os.environ.get("CASCADE_CONFIG", os.path.join(BASE_DIR, "cascade.json"))
+
+DEFAULTS = {
+    "enabled": False,
+    "fast_version": "fast",
+    "margin": 0.5,
+    "severity_min": 3,
+    "risk_prob": 0.15,
+}
+
+MARGIN_GRID = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8)
+RISK_PROB_GRID = (0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 1.01)  # 1.01 disables the risk-mass rule
+
+
+def load_config(path=CASCADE_CONFIG):
+    cfg = dict(DEFAULTS)
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                cfg.update(json.load(f))
+        except Exception as e:
+            log.warning("Ignoring unreadable cascade config %s: %s", path, e)
+    return cfg
+
+
+def save_config(cfg, path=CASCADE_CONFIG):
+    with open(path, "w") as f:
+        json.dump(cfg, f, indent=2)
+
+
+def severity_vector(class_names, disease_info):
+    return np.array([disease_info.get(c, {}).get("severity", 0) for c in class_names], dtype=np.int32)
+
+
+def escalate_mask(probs, severities, margin, severity_min, risk_prob):
+    """
+    Vectorised gate over (N, K) fast-model probabilities.
+    Returns a bool array: True where the full model must run.
+    """
+    probs = np.asarray(probs, dtype=np.float32)
+    top2 = np.sort(probs, axis=1)[:, -2:]
+    low_margin = (top2[:, 1] - top2[:, 0]) < margin
+    risky_top = severities[np.argmax(probs, axis=1)] >= severity_min
+    risky_mass = probs[:, severities >= severity_min].sum(axis=1) >= risk_prob
+    return low_margin | risky_top | risky_mass
+
+
+def escalation_reason(probs, severities, cfg):
+    """Why a single fast prediction is escalated, or None if it can be served as is."""
+    probs = np.asarray(probs, dtype=np.float32)
+    order = np.argsort(probs)[::-1]
+    if probs[order[0]] - probs[order[1]] < cfg["margin"]:
+        return "low_margin"
+    if severities[order[0]] >= cfg["severity_min"]:
+        return "high_severity"
+    if probs[severities >= cfg["severity_min"]].sum() >= cfg["risk_prob"]:
+        return "high_severity_mass"
+    return None
+
+
+def sweep(fast_probs, full_probs, y_true, fast_ms, full_ms, severities, severity_min=3):
+    """
+    Evaluate every (margin, risk_prob) pair on a labelled set.
+    Latency is modelled as fast_ms + escalation_rate * full_ms per image.
+    """
+    fast_pred = np.argmax(fast_probs, axis=1)
+    full_pred = np.argmax(full_probs, axis=1)
+    high = severities[y_true] >= severity_min
+    rows = []
+    for margin, risk_prob in itertools.product(MARGIN_GRID, RISK_PROB_GRID):
+        esc = escalate_mask(fast_probs, severities, margin, severity_min, risk_prob)
+        pred = np.where(esc, full_pred, fast_pred)
+        rate = float(esc.mean())
+        rows.append({
+            "margin": margin,
+            "risk_prob": risk_prob,
+            "severity_min": severity_min,
+            "accuracy": round(float((pred == y_true).mean()) * 100, 2),
+            "high_severity_recall": round(float((pred[high] == y_true[high]).mean()) * 100, 2) if high.any() else None,
+            "escalation_rate": round(rate, 4),
+            "avg_latency_ms": round(fast_ms + rate * full_ms, 2),
+        })
+    return rows
+
+
+def choose(rows, full_accuracy, max_accuracy_drop):
+    """Cheapest setting whose accuracy is within max_accuracy_drop points of the full model."""
+    ok = [r for r in rows if r["accuracy"] >= full_accuracy - max_accuracy_drop]
+    if not ok:
+        return max(rows, key=lambda r: (r["accuracy"], -r["avg_latency_ms"]))
+    return min(ok, key=lambda r: (r["avg_latency_ms"], -r["accuracy"]))
@@ -0,0 +1,114 @@
+"""
+Request deadlines and abandoned-request detection.
+
+A request's deadline comes from the X-Request-Timeout header (seconds), capped
+at MAX_REQUEST_TIMEOUT, or REQUEST_TIMEOUT_SECONDS when absent. Model work is
+submitted to the scheduler together with the Deadline:
+
+  * a queued item whose deadline has passed, or whose client has gone away,
+    is dropped when it reaches the front of the queue (compute saved);
+  * while a coroutine waits for its item it polls the connection, and
+    cancels the item if the client disconnects;
+  * lane time spent on items whose request was already dead when they
+    finished is counted as wasted.
+
+Saved compute is an estimate: the recent mean run time of the dropped work.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import metrics
+
+log = logging.getLogger("skin-api")
+
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", "30"))
+MAX_REQUEST_TIMEOUT = float(os.environ.get("MAX_REQUEST_TIMEOUT", "300"))
+DISCONNECT_POLL_SECONDS = 0.05
+
+DROPPED = metrics.REGISTRY.counter("skin_deadline_dropped_total", "Work dropped before running, by class and reason")
+SAVED_SECONDS = metrics.REGISTRY.counter("skin_compute_saved_seconds_total",
+                                         "Estimated compute not spent on dead requests, by class and reason")
+WASTED_SECONDS = metrics.REGISTRY.counter("skin_compute_wasted_seconds_total",
+                                          "Compute spent on requests that were dead when it finished")
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, reason):
+        super().__init__(f"Request abandoned ({reason})")
+        self.reason = reason
+
+
+class Deadline:
+    def __init__(self, timeout, request=None):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+        self.request = request
+        self.disconnected = False
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def dead(self):
+        """Why the request is dead ("client_disconnected" or "deadline"), or None"""
+        if self.disconnected:
+            return "client_disconnected"
+        if time.monotonic() >= self.expires:
+            return "deadline"
+        return None
+
+    async def poll(self):
+        """Refresh the connection state; returns dead()"""
+        if not self.disconnected and self.request is not None:
+            self.disconnected = await self.request.is_disconnected()
+        return self.dead()
+
+    async def check(self, cls="interactive", estimate=0.0):
+        """Raise DeadlineExceeded if the request is dead; `estimate` is the compute that saves"""
+        reason = await self.poll()
+        if reason is not None:
+            record_dropped(cls, reason, estimate)
+            raise DeadlineExceeded(reason)
+
+    async def run(self, scheduler, cls, fn, *args):
+        """scheduler.submit(cls, fn, *args) under this deadline, cancelling it if the client goes away"""
+        await self.check(cls, scheduler.estimate(fn))
+        future = scheduler.submit(cls, fn, *args, deadline=self)
+        waiter = asyncio.wrap_future(future)
+        while True:
+            done, _ = await asyncio.wait({waiter}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return waiter.result()
+            if not self.disconnected and await self.poll() == "client_disconnected":
+                if future.cancel():
+                    # never started: it will not run
+                    record_dropped(cls, "client_disconnected", scheduler.estimate(fn))
+                    raise DeadlineExceeded("client_disconnected")
+                # already running; its lane time is counted as wasted when it ends
+
+
+def record_dropped(cls, reason, estimate):
+    DROPPED.inc(**{"class": cls, "reason": reason})
+    SAVED_SECONDS.inc(estimate, **{"class": cls, "reason": reason})
+
+
+def record_skipped(cls, reason, estimate):
+    """A stage the request skipped on its own (e.g. explanation with too little time left)"""
+    SAVED_SECONDS.inc(estimate, **{"class": cls, "reason": reason})
+
+
+def record_wasted(cls, reason, seconds):
+    WASTED_SECONDS.inc(seconds, **{"class": cls, "reason": reason})
+
+
+def from_request(request, default=REQUEST_TIMEOUT_SECONDS):
+    """Deadline from the X-Request-Timeout header (seconds), else `default`"""
+    timeout = default
+    header = request.headers.get("x-request-timeout")
+    if header:
+        try:
+            timeout = float(header)
+        except ValueError:
+            log.debug("Ignoring bad X-Request-Timeout %r", header)
+    return Deadline(max(0.0, min(timeout, MAX_REQUEST_TIMEOUT)), request)
@@ -0,0 +1,153 @@
+"""
+Load-adaptive degradation for /predict.
+
+Under load the server steps down through tiers, cheapest last:
+
+    full         the requested explanation (Grad-CAM by default)
+    cam          Grad-CAM replaced by forward-only CAM (no heatmap if CAM is unsupported)
+    no_heatmap   no explanation at all
+    small_model  no explanation, scored by the `small_model` version (e.g. the cascade's fast model)
+
+The controller watches the interactive queue depth of the scheduler and the
+p90 /predict latency over the last `window_seconds`. When either is above its
+high mark it steps down one tier, at most once per `step_down_seconds`. Once
+both have stayed below their low marks for `step_up_seconds` it steps back up
+one tier at a time; any reading at or above a low mark restarts that wait.
+Requests pinned to a model_version keep it; the tier then only affects the
+explanation.
+
+Settings live in degrade.json (DEGRADE_CONFIG); missing keys use DEFAULTS.
+`tiers` may list a subset, e.g. ["full", "no_heatmap"].
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import metrics
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEGRADE_CONFIG = os.environ.get("DEGRADE_CONFIG", os.path.join(BASE_DIR, "degrade.json"))
+
+TIERS = ("full", "cam", "no_heatmap", "small_model")
+DEFAULTS = {
+    "enabled": True,
+    "tiers": list(TIERS),
+    "small_model": "fast",
+    "queue_high": 4,            # interactive items waiting
+    "queue_low": 1,             # calm means fewer than this waiting
+    "latency_high_ms": 3000,    # p90 /predict latency over the window
+    "latency_low_ms": 1000,
+    "window_seconds": 10,
+    "step_down_seconds": 2,
+    "step_up_seconds": 15,
+}
+MAX_SAMPLES = 512
+
+TIER_LEVEL = metrics.REGISTRY.gauge("skin_degrade_tier", "Current degradation tier (0 = full)")
+TRANSITIONS = metrics.REGISTRY.counter("skin_degrade_transitions_total", "Tier changes, by direction")
+SERVED = metrics.REGISTRY.counter("skin_degrade_served_total", "Predictions served, by tier")
+
+
+def load_config(path=DEGRADE_CONFIG):
+    cfg = dict(DEFAULTS)
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                cfg.update(json.load(f))
+        except Exception as e:
+            log.warning("Ignoring unreadable degradation config %s: %s", path, e)
+    unknown = [t for t in cfg["tiers"] if t not in TIERS]
+    if unknown or not cfg["tiers"]:
+        log.warning("Ignoring unknown degradation tiers %s", unknown)
+        cfg["tiers"] = [t for t in cfg["tiers"] if t in TIERS] or ["full"]
+    return cfg
+
+
+def explain_for(tier, explain_method, cam_ok):
+    """The explanation a request gets at `tier`, given what it resolved to at full service"""
+    if tier == "full":
+        return explain_method
+    if tier == "cam" and explain_method in ("gradcam", "cam"):
+        return "cam" if cam_ok else "none"
+    if tier == "cam":
+        return explain_method
+    return "none"
+
+
+class DegradationController:
+    def __init__(self, queue_depth, cfg=None):
+        """queue_depth() -> interactive items currently waiting"""
+        self.queue_depth = queue_depth
+        self.cfg = cfg or load_config()
+        self.level = 0
+        self._latencies = deque(maxlen=MAX_SAMPLES)
+        self._last_change = time.monotonic()
+        # last time either signal was at or above its low mark
+        self._last_busy = float("-inf")
+        self._lock = threading.Lock()
+        TIER_LEVEL.set(0)
+
+    def observe(self, seconds):
+        """Record the end-to-end latency of a finished /predict"""
+        with self._lock:
+            self._latencies.append((time.monotonic(), seconds))
+
+    def _p90_ms(self, now):
+        start = now - self.cfg["window_seconds"]
+        while self._latencies and self._latencies[0][0] < start:
+            self._latencies.popleft()
+        if not self._latencies:
+            return 0.0
+        return float(np.percentile([s for _, s in self._latencies], 90)) * 1000
+
+    def tier(self):
+        """Re-evaluate the load and return the tier for a new request"""
+        cfg = self.cfg
+        tiers = cfg["tiers"]
+        if not cfg["enabled"]:
+            return tiers[0]
+        with self._lock:
+            now = time.monotonic()
+            depth, p90 = self.queue_depth(), self._p90_ms(now)
+            if depth >= cfg["queue_low"] or p90 >= cfg["latency_low_ms"]:
+                # not calm: the step-up timer starts again once both are below their low marks
+                self._last_busy = now
+            if depth >= cfg["queue_high"] or p90 >= cfg["latency_high_ms"]:
+                if self.level < len(tiers) - 1 and now - self._last_change >= cfg["step_down_seconds"]:
+                    self._move(self.level + 1, now, depth, p90)
+            elif self._last_busy < now and self.level > 0:
+                # one tier per step_up_seconds of calm, even if nobody asked in between
+                calm = now - max(self._last_busy, self._last_change)
+                steps = int(calm // cfg["step_up_seconds"])
+                if steps > 0:
+                    self._move(max(0, self.level - steps), now, depth, p90)
+            return tiers[self.level]
+
+    def _move(self, level, now, depth, p90):
+        direction = "down" if level > self.level else "up"
+        log.info("Degradation tier %s -> %s (queue %d, p90 %.0f ms)",
+                 self.cfg["tiers"][self.level], self.cfg["tiers"][level], depth, p90)
+        TRANSITIONS.inc(abs(level - self.level), direction=direction)
+        self.level = level
+        self._last_change = now
+        TIER_LEVEL.set(level)
+
+    def status(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "enabled": self.cfg["enabled"],
+                "tier": self.cfg["tiers"][self.level],
+                "level": self.level,
+                "queue_depth": self.queue_depth(),
+                "p90_ms": round(self._p90_ms(now), 1),
+                "seconds_in_tier": round(now - self._last_change, 1),
+                "config": self.cfg,
+            }
@@ -0,0 +1,236 @@
+"""
+Knowledge distillation: train a compact student from the served B2 model.
+
+The teacher's soft predictions over the training images are computed once and
+cached under cache/distill/ (keyed by teacher file, image list and input
+size), so re-runs with different student settings skip the teacher entirely.
+Training runs on CPU.
+
+The exported student ends in a softmax and takes raw 0..255 RGB input, like the
+teacher, so main.py can serve it as a registry version (for example as the
+cascade's "fast" model) without code changes.
+
+    python distill.py --student b0 --img-size 224 --epochs 10
+    python distill.py --student mobilenetv3s --temperature 4 --alpha 0.7
+
+Writes <out-dir>/<name>.keras, <name>_class_names.json and <name>_report.json
+comparing accuracy, single-image latency and size against the teacher.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.path.join(BASE_DIR, "backend", "ai_model")
+DEFAULT_TEACHER = os.path.join(MODEL_DIR, "final_skin_model_B2_90plus.keras")
+DEFAULT_CLASS_JSON = os.path.join(MODEL_DIR, "class_names.json")
+CACHE_DIR = os.path.join(BASE_DIR, "cache", "distill")
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+# ---------- DATA ----------
+def list_images(root, class_names):
+    """(paths, labels) for root/<class>/<image>, in class_names order"""
+    paths, labels = [], []
+    for idx, name in enumerate(class_names):
+        class_dir = os.path.join(root, name)
+        if not os.path.isdir(class_dir):
+            continue
+        for fname in sorted(os.listdir(class_dir)):
+            if fname.lower().endswith(IMAGE_EXTS):
+                paths.append(os.path.join(class_dir, fname))
+                labels.append(idx)
+    return paths, np.asarray(labels, dtype=np.int32)
+
+
+def decode(path, img_size):
+    """Pixels stay 0..255: EfficientNet/MobileNetV3 preprocessing is built into the models"""
+    img = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    img = tf.image.resize(img, (img_size, img_size))
+    return tf.cast(img, tf.float32)
+
+
+def image_dataset(paths, img_size, batch_size):
+    """Decode + resize on parallel CPU threads, in file order"""
+    ds = tf.data.Dataset.from_tensor_slices(paths)
+    ds = ds.map(lambda p: decode(p, img_size), num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+# ---------- TEACHER CACHE ----------
+def teacher_cache_path(teacher_path, paths, img_size):
+    h = hashlib.sha1()
+    st = os.stat(teacher_path)
+    h.update(f"{os.path.abspath(teacher_path)}|{st.st_size}|{st.st_mtime_ns}|{img_size}".encode())
+    for p in paths:
+        h.update(p.encode())
+    return os.path.join(CACHE_DIR, f"teacher_{h.hexdigest()[:16]}.npy")
+
+
+def teacher_predictions(teacher_path, paths, img_size, batch_size):
+    cache = teacher_cache_path(teacher_path, paths, img_size)
+    if os.path.exists(cache):
+        print(f"teacher outputs: cached ({cache})")
+        return np.load(cache)
+
+    teacher = tf.keras.models.load_model(teacher_path)
+    t0 = time.perf_counter()
+    probs = teacher.predict(image_dataset(paths, img_size, batch_size), verbose=1).astype(np.float32)
+    print(f"teacher outputs: {len(paths)} images in {time.perf_counter() - t0:.0f}s")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    np.save(cache, probs)
+    return probs
+
+
+# ---------- STUDENT ----------
+def build_student(kind, img_size, num_classes, pretrained):
+    weights = "imagenet" if pretrained else None
+    inputs = tf.keras.Input((img_size, img_size, 3))
+    if kind == "b0":
+        backbone = tf.keras.applications.EfficientNetB0(include_top=False, weights=weights, input_tensor=inputs)
+    elif kind == "mobilenetv3s":
+        backbone = tf.keras.applications.MobileNetV3Small(
+            include_top=False, weights=weights, input_tensor=inputs, include_preprocessing=True)
+    else:
+        raise ValueError(f"Unknown student: {kind}")
+    x = tf.keras.layers.GlobalAveragePooling2D()(backbone.output)
+    x = tf.keras.layers.Dropout(0.2)(x)
+    logits = tf.keras.layers.Dense(num_classes, name="logits")(x)
+    return tf.keras.Model(inputs, logits, name=f"student_{kind}")
+
+
+def distill(student, train_ds, steps_per_epoch, epochs, lr, temperature, alpha):
+    """Loss = alpha * T^2 * KL(teacher_T || student_T) + (1 - alpha) * CE(label)"""
+    optimizer = tf.keras.optimizers.Adam(lr)
+    kl = tf.keras.losses.KLDivergence()
+    ce = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    T = float(temperature)
+
+    @tf.function
+    def train_step(x, soft, y):
+        # soften the cached teacher probabilities with the same temperature
+        soft_t = tf.nn.softmax(tf.math.log(soft + 1e-8) / T)
+        with tf.GradientTape() as tape:
+            logits = student(x, training=True)
+            loss = alpha * (T ** 2) * kl(soft_t, tf.nn.softmax(logits / T)) + (1 - alpha) * ce(y, logits)
+        grads = tape.gradient(loss, student.trainable_variables)
+        optimizer.apply_gradients(zip(grads, student.trainable_variables))
+        return loss
+
+    for epoch in range(epochs):
+        t0 = time.perf_counter()
+        losses = [float(train_step(x, s, y)) for x, s, y in train_ds.take(steps_per_epoch)]
+        print(f"epoch {epoch + 1}/{epochs}: loss={np.mean(losses):.4f} ({time.perf_counter() - t0:.0f}s)")
+
+
+def export_with_softmax(student):
+    """Serve probabilities like the teacher"""
+    probs = tf.keras.layers.Softmax(name="probs")(student.output)
+    return tf.keras.Model(student.input, probs, name=student.name)
+
+
+# ---------- REPORT ----------
+def single_image_ms(model, img_size, repeats=20):
+    x = np.random.default_rng(0).uniform(0, 255, (1, img_size, img_size, 3)).astype(np.float32)
+    model.predict(x, verbose=0)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        model.predict(x, verbose=0)
+        times.append((time.perf_counter() - t0) * 1000)
+    return round(float(np.median(times)), 2)
+
+
+def describe(model, path, img_size, val_paths, val_labels, batch_size):
+    probs = model.predict(image_dataset(val_paths, img_size, batch_size), verbose=0)
+    return {
+        "path": path,
+        "input_size": img_size,
+        "accuracy": round(float((np.argmax(probs, axis=1) == val_labels).mean()) * 100, 2) if len(val_labels) else None,
+        "latency_ms": single_image_ms(model, img_size),
+        "params": int(model.count_params()),
+        "size_mb": round(os.path.getsize(path) / 1e6, 2),
+    }, probs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--teacher", default=DEFAULT_TEACHER)
+    parser.add_argument("--class-names", default=DEFAULT_CLASS_JSON)
+    parser.add_argument("--train-dir", default=os.path.join(BASE_DIR, "dataset", "train"))
+    parser.add_argument("--val-dir", default=os.path.join(BASE_DIR, "dataset", "test"))
+    parser.add_argument("--teacher-img-size", type=int, default=260)
+    parser.add_argument("--student", choices=["b0", "mobilenetv3s"], default="b0")
+    parser.add_argument("--img-size", type=int, default=224, help="student input size")
+    parser.add_argument("--no-pretrained", action="store_true", help="random init (no ImageNet download)")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--temperature", type=float, default=4.0)
+    parser.add_argument("--alpha", type=float, default=0.7, help="weight of the distillation term")
+    parser.add_argument("--name", default=None, help="output basename (default student_<kind>_<size>)")
+    parser.add_argument("--out-dir", default=MODEL_DIR)
+    args = parser.parse_args()
+
+    with open(args.class_names) as f:
+        class_names = [str(c).strip().lower() for c in json.load(f)]
+
+    train_paths, train_labels = list_images(args.train_dir, class_names)
+    val_paths, val_labels = list_images(args.val_dir, class_names)
+    if not train_paths:
+        raise SystemExit(f"No training images under {args.train_dir}")
+    print(f"{len(train_paths)} training / {len(val_paths)} validation images, classes={class_names}")
+
+    soft = teacher_predictions(args.teacher, train_paths, args.teacher_img_size, args.batch_size)
+
+    # shuffle (path, teacher probs, label) triples, then decode, so memory stays bounded
+    train_ds = (
+        tf.data.Dataset.from_tensor_slices((train_paths, soft, train_labels))
+        .shuffle(len(train_paths), seed=0, reshuffle_each_iteration=True)
+        .map(lambda p, s, y: (decode(p, args.img_size), s, y), num_parallel_calls=tf.data.AUTOTUNE)
+        .batch(args.batch_size)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+    steps = int(np.ceil(len(train_paths) / args.batch_size))
+
+    student = build_student(args.student, args.img_size, len(class_names), not args.no_pretrained)
+    distill(student, train_ds, steps, args.epochs, args.lr, args.temperature, args.alpha)
+
+    name = args.name or f"student_{args.student}_{args.img_size}"
+    os.makedirs(args.out_dir, exist_ok=True)
+    model_path = os.path.join(args.out_dir, f"{name}.keras")
+    served = export_with_softmax(student)
+    served.save(model_path)
+    with open(os.path.join(args.out_dir, f"{name}_class_names.json"), "w") as f:
+        json.dump(class_names, f)
+
+    teacher = tf.keras.models.load_model(args.teacher)
+    t_report, t_probs = describe(teacher, args.teacher, args.teacher_img_size, val_paths, val_labels, args.batch_size)
+    s_report, s_probs = describe(tf.keras.models.load_model(model_path), model_path, args.img_size,
+                                 val_paths, val_labels, args.batch_size)
+    agreement = float((np.argmax(t_probs, axis=1) == np.argmax(s_probs, axis=1)).mean()) * 100 if len(val_paths) else None
+    report = {
+        "teacher": t_report,
+        "student": s_report,
+        "top1_agreement": round(agreement, 2) if agreement is not None else None,
+        "speedup": round(t_report["latency_ms"] / s_report["latency_ms"], 2),
+        "size_ratio": round(s_report["size_mb"] / t_report["size_mb"], 3),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("out_dir",)},
+    }
+    with open(os.path.join(args.out_dir, f"{name}_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'':8} {'acc%':>7} {'ms/img':>8} {'MB':>8} {'params':>11}")
+    for label, r in (("teacher", t_report), ("student", s_report)):
+        print(f"{label:8} {r['accuracy']!s:>7} {r['latency_ms']:>8} {r['size_mb']:>8} {r['params']:>11}")
+    print(f"top-1 agreement {report['top1_agreement']}%, speedup x{report['speedup']}")
+    print(f"saved {model_path}")
+
+
+if __name__ == "__main__":
+    main()
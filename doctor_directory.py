@@ -0,0 +1,332 @@
+"""
+Doctor directory: filtered and nearest-location lookups.
+
+Doctors are loaded from DOCTORS_SOURCE (a JSON list or a CSV file, default
+doctors.json, or "mongo" for the `doctors` collection) into in-memory indexes:
+
+  * posting lists (sorted int32 row ids) per disease, specialty and city,
+    keyed by normalised name, plus per-row specialty/city codes so a posting
+    list is narrowed by the other filters with one gather each;
+  * grids of CELL_DEG-degree cells over (lat, lon), rows sorted by cell, one
+    over all doctors and one per disease, for nearest-doctor queries: rings of
+    cells around the query point are scanned outwards until no unscanned cell
+    can hold a closer doctor. Grids of up to BRUTE_MAX doctors are ranked
+    exhaustively instead.
+
+A directory is immutable and keeps an LRU cache of query results; reloading
+builds a new directory, so cached results never outlive their data.
+
+Disease names match case-insensitively and ignoring any parenthesised part,
+so "Nevus (Common Mole)" (the /predict class name) finds doctors listed under
+"Nevus". Class codes ("nv") resolve through `aliases`.
+
+CSV files have the columns name, specialist, hospital, city, contact, lat,
+lon and diseases (";"-separated).
+"""
+import csv
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCTORS_SOURCE = os.environ.get("DOCTORS_SOURCE", os.path.join(BASE_DIR, "doctors.json"))
+MONGO_COLLECTION = "doctors"
+
+PUBLIC_FIELDS = ("name", "specialist", "hospital", "city", "contact")
+EARTH_KM = 6371.0088
+CELL_DEG = 0.5
+BRUTE_MAX = 2000       # rank grids up to this size exhaustively
+CACHE_SIZE = 4096
+MAX_LIMIT = 100
+MAX_NEAREST = 1000     # deepest offset + limit served for nearest queries
+
+EMPTY = np.zeros(0, dtype=np.int32)
+
+
+def normalize(name):
+    """Lookup key: casefolded, whitespace-collapsed, without a parenthesised suffix"""
+    return " ".join(str(name or "").split("(")[0].casefold().split())
+
+
+def load_records(source=DOCTORS_SOURCE):
+    if source == "mongo":
+        from pymongo import MongoClient
+        from prediction_store import MONGO_URI, MONGO_DB
+
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+        return list(client[MONGO_DB][MONGO_COLLECTION].find({}, {"_id": 0}))
+    if source.endswith(".csv"):
+        with open(source, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        for r in rows:
+            r["diseases"] = [d for d in (r.get("diseases") or "").split(";") if d.strip()]
+        return rows
+    with open(source, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _coord(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _postings(keys_per_row):
+    """{key: sorted int32 row ids}"""
+    out = {}
+    for i, keys in enumerate(keys_per_row):
+        for key in keys:
+            if key:
+                out.setdefault(key, []).append(i)
+    return {k: np.asarray(v, dtype=np.int32) for k, v in out.items()}
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance; all angles in radians"""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class _Grid:
+    """
+    Rows bucketed into cell_deg x cell_deg lat/lon cells (sorted by cell) for
+    nearest-neighbour search by expanding rings of cells.
+    """
+
+    def __init__(self, rows, lat_deg, lon_deg, cell_deg=CELL_DEG):
+        self.cell_deg = cell_deg
+        self.nrows, self.ncols = int(np.ceil(180 / cell_deg)), int(np.ceil(360 / cell_deg))
+        keys = self.key(*self.cell(lat_deg[rows], lon_deg[rows]))
+        order = np.argsort(keys, kind="stable")
+        self.rows = rows[order]
+        uniq, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        self.cells = {int(k): (int(s), int(s + c)) for k, s, c in zip(uniq, starts, counts)}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def cell(self, lat_deg, lon_deg):
+        row = np.clip(np.floor((np.asarray(lat_deg) + 90) / self.cell_deg), 0, self.nrows - 1).astype(np.int64)
+        col = np.floor((np.asarray(lon_deg) + 180) / self.cell_deg).astype(np.int64) % self.ncols
+        return row, col
+
+    def key(self, row, col):
+        return row * self.ncols + col % self.ncols
+
+    def ring(self, r0, c0, ring):
+        """Row ids in the cells at Chebyshev distance `ring` from cell (r0, c0)"""
+        if ring == 0:
+            coords = [(r0, c0)]
+        else:
+            span = range(c0 - ring, c0 + ring + 1)
+            side = range(r0 - ring + 1, r0 + ring)
+            coords = [(r0 - ring, c) for c in span] + [(r0 + ring, c) for c in span] + \
+                     [(r, c0 - ring) for r in side] + [(r, c0 + ring) for r in side]
+        chunks = []
+        for r, c in coords:
+            if 0 <= r < self.nrows:
+                cell = self.cells.get(int(self.key(r, c)))
+                if cell:
+                    chunks.append(self.rows[cell[0]:cell[1]])
+        return np.concatenate(chunks) if chunks else EMPTY
+
+    def bound_km(self, lat_deg, lon_deg, r0, c0, ring):
+        """Lower bound on the distance to any point outside the rings scanned so far"""
+        south = (r0 - ring) * self.cell_deg - 90
+        north = (r0 + ring + 1) * self.cell_deg - 90
+        dlon = np.radians(min(lon_deg + 180 - (c0 - ring) * self.cell_deg,
+                              (c0 + ring + 1) * self.cell_deg - 180 - lon_deg))
+        return min(
+            np.radians(lat_deg - south) * EARTH_KM if south > -90 else np.inf,
+            np.radians(north - lat_deg) * EARTH_KM if north < 90 else np.inf,
+            # distance to the great circle through the nearest unscanned meridian
+            np.arcsin(min(1.0, abs(np.cos(np.radians(lat_deg))) * np.sin(dlon))) * EARTH_KM,
+        )
+
+    def exhausted(self, ring):
+        # past this, one exhaustive pass is cheaper than more rings
+        return (2 * ring + 1) ** 2 > 4 * len(self.cells) or 2 * ring + 1 >= self.ncols
+
+
+class DoctorDirectory:
+    def __init__(self, records, aliases=None, cell_deg=CELL_DEG, cache_size=CACHE_SIZE):
+        self.doctors = [{k: r.get(k) for k in PUBLIC_FIELDS} for r in records]
+        self.aliases = {normalize(k): normalize(v) for k, v in (aliases or {}).items()}
+        self.by_disease = _postings([{normalize(d) for d in r.get("diseases") or []} for r in records])
+        self.by_specialty = _postings([{normalize(r.get("specialist"))} for r in records])
+        self.by_city = _postings([{normalize(r.get("city"))} for r in records])
+        # single-valued fields also as per-row codes, to filter a candidate set with one gather
+        self._specialty_codes, self._specialty_code = self._codes(self.by_specialty)
+        self._city_codes, self._city_code = self._codes(self.by_city)
+
+        lat = np.array([_coord(r.get("lat")) for r in records], dtype=np.float64)
+        lon = np.array([_coord(r.get("lon")) for r in records], dtype=np.float64)
+        self._has_loc = np.isfinite(lat) & np.isfinite(lon)
+        self._lat, self._lon = np.radians(lat), np.radians(lon)
+        # one spatial grid over everyone with coordinates, one per disease
+        everyone = np.arange(len(records), dtype=np.int32)
+        self._grid = _Grid(everyone[self._has_loc], lat, lon, cell_deg)
+        self._disease_grids = {d: _Grid(rows[self._has_loc[rows]], lat, lon, cell_deg)
+                               for d, rows in self.by_disease.items()}
+
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.doctors)
+
+    def _codes(self, postings):
+        codes = {key: i for i, key in enumerate(postings)}
+        per_row = np.full(len(self.doctors), -1, dtype=np.int32)
+        for key, rows in postings.items():
+            per_row[rows] = codes[key]
+        return codes, per_row
+
+    # ----- filters -----
+    def _checks(self, specialty, city):
+        """[(per-row codes, code, posting list)] for the given filters; None if a value is unknown"""
+        checks = []
+        for value, codes, per_row, postings in (
+                (specialty, self._specialty_codes, self._specialty_code, self.by_specialty),
+                (city, self._city_codes, self._city_code, self.by_city)):
+            if value:
+                if value not in codes:
+                    return None
+                checks.append((per_row, codes[value], postings[value]))
+        return checks
+
+    @staticmethod
+    def _keep(rows, checks):
+        for per_row, code, _ in checks:
+            rows = rows[per_row[rows] == code]
+        return rows
+
+    def _matching(self, disease, checks):
+        """Sorted row ids matching the disease and checks; None when unfiltered"""
+        if checks is None:
+            return EMPTY
+        if disease:
+            rows = self.by_disease.get(disease, EMPTY)
+        elif checks:
+            rows = min((postings for _, _, postings in checks), key=len)
+        else:
+            return None
+        return self._keep(rows, checks)
+
+    # ----- nearest -----
+    def _rank(self, rows, lat, lon, k):
+        dist = haversine_km(lat, lon, self._lat[rows], self._lon[rows])
+        if k < len(rows):
+            top = np.argpartition(dist, k - 1)[:k]
+            rows, dist = rows[top], dist[top]
+        order = np.argsort(dist, kind="stable")
+        return rows[order], dist[order]
+
+    def nearest(self, lat_deg, lon_deg, k, disease="", checks=(), rows=None):
+        """
+        (row ids, km) of the k nearest located doctors with `disease` that pass
+        `checks`; `rows`, if given, are those matching doctors, located or not.
+        """
+        lat, lon = np.radians(lat_deg), np.radians(lon_deg)
+        grid = self._disease_grids.get(disease, _EMPTY_GRID) if disease else self._grid
+        if len(grid) <= BRUTE_MAX:
+            return self._rank(self._keep(grid.rows, checks), lat, lon, k)
+        if rows is not None and len(rows) <= BRUTE_MAX:
+            # e.g. a city filter: few matches, possibly far from the query point
+            return self._rank(rows[self._has_loc[rows]], lat, lon, k)
+
+        r0, c0 = (int(v) for v in grid.cell(lat_deg, lon_deg))
+        found, n_found, ring = [], 0, 0
+        while not grid.exhausted(ring):
+            cand = self._keep(grid.ring(r0, c0, ring), checks)
+            if len(cand):
+                found.append(cand)
+                n_found += len(cand)
+            if n_found >= k:
+                best, dist = self._rank(np.concatenate(found), lat, lon, k)
+                if dist[-1] <= grid.bound_km(lat_deg, lon_deg, r0, c0, ring):
+                    return best, dist
+            ring += 1
+        return self._rank(self._keep(grid.rows, checks), lat, lon, k)
+
+    # ----- queries -----
+    def _search(self, disease, specialty, city, lat, lon, offset, limit):
+        checks = self._checks(specialty, city)
+        rows = self._matching(disease, checks)
+        if lat is None:
+            total = len(self.doctors) if rows is None else len(rows)
+            page = range(offset, min(offset + limit, total)) if rows is None else rows[offset:offset + limit]
+            return total, [self.doctors[i] for i in page]
+
+        total = len(self._grid) if rows is None else int(self._has_loc[rows].sum())
+        need = min(offset + limit, MAX_NEAREST, total)
+        if offset >= need:
+            return total, []
+        best, dist = self.nearest(lat, lon, need, disease, checks, rows)
+        return total, [{**self.doctors[i], "distance_km": round(float(d), 2)}
+                       for i, d in zip(best[offset:need], dist[offset:need])]
+
+    def resolve_disease(self, name):
+        """Index key for a disease name or class code"""
+        key = normalize(name)
+        return self.aliases.get(key, key)
+
+    def search(self, disease="", specialty="", city="", lat=None, lon=None, offset=0, limit=20):
+        """
+        (total, page) of doctors matching every given filter. With lat/lon the
+        page is nearest first and each doctor has distance_km; otherwise rows
+        keep directory order.
+        """
+        disease = self.resolve_disease(disease)
+        specialty, city = normalize(specialty), normalize(city)
+        if lat is not None and lon is not None:
+            # ~100 m; keeps nearby queries on one cache entry
+            lat, lon = round(float(lat), 3), round(float(lon), 3)
+        else:
+            lat = lon = None
+        offset, limit = max(0, int(offset)), max(1, min(int(limit), MAX_LIMIT))
+        key = (disease, specialty, city, lat, lon, offset, limit)
+
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return result
+        result = self._search(disease, specialty, city, lat, lon, offset, limit)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = result
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def status(self):
+        return {
+            "doctors": len(self.doctors),
+            "located": len(self._grid),
+            "diseases": len(self.by_disease),
+            "specialties": len(self.by_specialty),
+            "cities": len(self.by_city),
+            "grid_cells": len(self._grid.cells),
+            "cache": {"entries": len(self._cache), "hits": self.hits, "misses": self.misses},
+        }
+
+
+_EMPTY_GRID = _Grid(EMPTY, np.zeros(0), np.zeros(0))
+
+
+def load_directory(source=DOCTORS_SOURCE, aliases=None):
+    records = load_records(source)
+    directory = DoctorDirectory(records, aliases)
+    log.info("Doctor directory: %d doctors from %s", len(directory), source)
+    return directory
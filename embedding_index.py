@@ -0,0 +1,336 @@
+"""
+Embedding index for "similar past cases" retrieval.
+
+Every scored image contributes its penultimate-layer embedding (the input of
+the final Dense classifier). Embeddings are reduced with a fixed random
+projection to `dim` (default 256), L2-normalised and stored as float16, so a
+million cases take ~0.5 GB. Search is cosine similarity with an IVF
+(inverted-file) index: spherical k-means centroids partition the vectors and
+a query scans only the `nprobe` closest partitions. Below TRAIN_MIN entries
+the index is searched exhaustively.
+
+One index per model version (embeddings of different models are not
+comparable), persisted under EMBEDDING_INDEX_DIR/<version>/:
+
+    index.json     dims, projection seed
+    vectors.f16    float16 rows, appended on insert
+    meta.jsonl     one line per row: prediction id, class code, confidence, time
+    ivf.npz        centroids (after training)
+    assign.i32     partition of each row (after training), appended on insert
+
+Inserts are appends, so the index is never rewritten on the request path;
+(re)training runs on a background thread when the index grows 4x.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EMBEDDING_INDEX_DIR = os.environ.get("EMBEDDING_INDEX_DIR", os.path.join(BASE_DIR, "cache", "embeddings"))
+
+PROJECTED_DIM = 256
+TRAIN_MIN = 10000        # exhaustive search below this many rows
+RETRAIN_GROWTH = 4       # retrain once the index is this many times larger than at the last training
+NPROBE = 16
+MAX_NLIST = 1024
+
+
+def _normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def _projection(dim_in, dim, seed):
+    """Fixed Gaussian random projection; approximately preserves cosine similarity"""
+    if dim_in <= dim:
+        return None
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal((dim_in, dim)) / np.sqrt(dim)).astype(np.float32)
+
+
+def _nearest(x, centroids, chunk=65536):
+    """Index of the most similar centroid for each row of x"""
+    out = np.empty(len(x), dtype=np.int32)
+    for i in range(0, len(x), chunk):
+        out[i:i + chunk] = np.argmax(np.asarray(x[i:i + chunk], np.float32) @ centroids.T, axis=1)
+    return out
+
+
+def spherical_kmeans(x, k, iters=10, seed=0):
+    """k unit-norm centroids for unit-norm rows x"""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].astype(np.float32)
+    for _ in range(iters):
+        assign = _nearest(x, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = np.bincount(assign, minlength=k) == 0
+        sums[empty] = centroids[empty]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class _Buffer:
+    """Append-only numpy array with amortised O(1) growth"""
+
+    def __init__(self, tail_shape, dtype, data=None):
+        data = np.empty((0,) + tuple(tail_shape), dtype) if data is None else np.asarray(data, dtype)
+        self._data = np.empty((max(1024, len(data) * 2),) + tuple(tail_shape), dtype)
+        self._data[:len(data)] = data
+        self.n = len(data)
+
+    def append(self, rows):
+        rows = np.asarray(rows, self._data.dtype)
+        need = self.n + len(rows)
+        if need > len(self._data):
+            grown = np.empty((max(need, len(self._data) * 2),) + self._data.shape[1:], self._data.dtype)
+            grown[:self.n] = self._data[:self.n]
+            self._data = grown
+        self._data[self.n:need] = rows
+        self.n = need
+
+    @property
+    def view(self):
+        return self._data[:self.n]
+
+
+class EmbeddingIndex:
+    def __init__(self, path, dim_in, dim=PROJECTED_DIM, seed=0, nprobe=NPROBE):
+        self.path = path
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._training = False
+        os.makedirs(path, exist_ok=True)
+
+        header = os.path.join(path, "index.json")
+        if os.path.exists(header):
+            with open(header, "r") as f:
+                cfg = json.load(f)
+        else:
+            cfg = {"dim_in": int(dim_in), "dim": int(min(dim, dim_in)), "seed": int(seed)}
+            with open(header, "w") as f:
+                json.dump(cfg, f)
+        self.dim_in, self.dim, self.seed = cfg["dim_in"], cfg["dim"], cfg["seed"]
+        self._proj = _projection(self.dim_in, self.dim, self.seed)
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    # ----- persistence -----
+    def _load(self):
+        t0 = time.perf_counter()
+        vec_path, meta_path = self._file("vectors.f16"), self._file("meta.jsonl")
+        vectors = np.fromfile(vec_path, dtype=np.float16) if os.path.exists(vec_path) else np.empty(0, np.float16)
+        vectors = vectors[:len(vectors) // self.dim * self.dim].reshape(-1, self.dim)
+
+        meta = []
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                for line in f:
+                    try:
+                        meta.append(tuple(json.loads(line)))
+                    except ValueError:
+                        break  # torn last line after a crash
+
+        # keep rows present in both files, and trim the files to match
+        n = min(len(vectors), len(meta))
+        if os.path.exists(vec_path) and os.path.getsize(vec_path) != n * self.dim * 2:
+            os.truncate(vec_path, n * self.dim * 2)
+        if len(meta) != n or (n and not self._ends_with_newline(meta_path)):
+            with open(meta_path, "w") as f:
+                f.writelines(json.dumps(m) + "\n" for m in meta[:n])
+
+        self._vectors = _Buffer((self.dim,), np.float16, vectors[:n])
+        self._meta = meta[:n]
+        self._row_of = {m[0]: i for i, m in enumerate(self._meta)}
+
+        self._centroids, self._lists, self._assign, self._trained_on = None, None, None, 0
+        if os.path.exists(self._file("ivf.npz")):
+            ivf = np.load(self._file("ivf.npz"))
+            assign = np.fromfile(self._file("assign.i32"), dtype=np.int32)[:n]
+            if len(assign) < n:
+                assign = np.concatenate([assign, _nearest(self._vectors.view[len(assign):], ivf["centroids"])])
+            self._install(ivf["centroids"], assign, int(ivf["trained_on"]))
+            self._write_assign()
+        log.info("Embedding index %s: %d rows loaded in %.1fs", self.path, n, time.perf_counter() - t0)
+
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _write_assign(self):
+        self._assign.view.tofile(self._file("assign.i32"))
+
+    def _install(self, centroids, assign, trained_on):
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(centroids)))])
+        self._lists = [_Buffer((), np.int32, order[bounds[c]:bounds[c + 1]]) for c in range(len(centroids))]
+        self._centroids = centroids.astype(np.float32)
+        self._assign = _Buffer((), np.int32, assign)
+        self._trained_on = trained_on
+
+    # ----- inserts -----
+    def project(self, embeddings):
+        x = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim_in)
+        if self._proj is not None:
+            x = x @ self._proj
+        return _normalize(x)
+
+    def add(self, ids, embeddings, metas):
+        """Append rows; metas are (class_code, confidence, time) tuples"""
+        x = self.project(embeddings).astype(np.float16)
+        rows = [(pid,) + tuple(m) for pid, m in zip(ids, metas)]
+        with self._lock:
+            start = self._vectors.n
+            with open(self._file("vectors.f16"), "ab") as f:
+                f.write(x.tobytes())
+            with open(self._file("meta.jsonl"), "a") as f:
+                f.writelines(json.dumps(r) + "\n" for r in rows)
+            self._vectors.append(x)
+            self._meta.extend(rows)
+            for i, r in enumerate(rows):
+                self._row_of[r[0]] = start + i
+            if self._centroids is not None:
+                assign = _nearest(x, self._centroids)
+                for i, c in enumerate(assign):
+                    self._lists[c].append([start + i])
+                self._assign.append(assign)
+                with open(self._file("assign.i32"), "ab") as f:
+                    f.write(assign.tobytes())
+        self._maybe_train()
+
+    # ----- training -----
+    def _maybe_train(self):
+        with self._lock:
+            n = self._vectors.n
+            if self._training or n < TRAIN_MIN or (self._trained_on and n < self._trained_on * RETRAIN_GROWTH):
+                return
+            self._training = True
+        threading.Thread(target=self.train, daemon=True, name="embedding-train").start()
+
+    def train(self, nlist=None, seed=0):
+        """(Re)build the IVF partitions; inserts and queries keep working meanwhile"""
+        self._training = True
+        try:
+            t0 = time.perf_counter()
+            with self._lock:
+                n0 = self._vectors.n
+                data = self._vectors.view  # rows [0, n0) are never modified
+            nlist = nlist or int(min(MAX_NLIST, max(8, 4 * np.sqrt(n0))))
+            rng = np.random.default_rng(seed)
+            sample = data[rng.choice(n0, min(n0, 32 * nlist), replace=False)].astype(np.float32)
+            centroids = spherical_kmeans(sample, nlist, seed=seed)
+            assign = _nearest(data[:n0], centroids)
+            with self._lock:
+                if self._vectors.n > n0:
+                    assign = np.concatenate([assign, _nearest(self._vectors.view[n0:], centroids)])
+                self._install(centroids, assign, n0)
+                np.savez(self._file("ivf.npz"), centroids=centroids, trained_on=n0)
+                self._write_assign()
+            log.info("Embedding index %s trained: %d rows, %d lists in %.1fs",
+                     self.path, n0, nlist, time.perf_counter() - t0)
+        finally:
+            self._training = False
+
+    # ----- queries -----
+    def __len__(self):
+        return self._vectors.n
+
+    def __contains__(self, prediction_id):
+        return prediction_id in self._row_of
+
+    def search(self, query, k=5, exclude_row=None):
+        """[(row, similarity)] of the k nearest rows to a projected unit vector"""
+        with self._lock:
+            n = self._vectors.n
+            vectors = self._vectors.view
+            if self._centroids is None:
+                rows = np.arange(n, dtype=np.int32)
+            else:
+                probe = np.argsort(self._centroids @ query)[::-1][:self.nprobe]
+                rows = np.concatenate([self._lists[c].view for c in probe])
+            candidates = vectors[rows].astype(np.float32)
+        scores = candidates @ query
+        if exclude_row is not None:
+            scores[rows == exclude_row] = -np.inf
+        k = min(k, len(rows))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def similar(self, prediction_id, k=5):
+        """Nearest past cases to a stored prediction, or None if the id is unknown"""
+        row = self._row_of.get(prediction_id)
+        if row is None:
+            return None
+        query = self._vectors.view[row].astype(np.float32)
+        return [self.describe(r, s) for r, s in self.search(query, k, exclude_row=row)]
+
+    def describe(self, row, similarity):
+        pid, class_code, confidence, when = self._meta[row]
+        return {"prediction_id": pid, "class_code": class_code, "confidence": confidence,
+                "time": when, "similarity": round(similarity, 4)}
+
+    def status(self):
+        return {"rows": len(self), "dim": self.dim, "lists": len(self._lists) if self._lists else 0,
+                "trained_on": self._trained_on, "training": self._training}
+
+
+class EmbeddingStore:
+    """One EmbeddingIndex per model version, opened on first use"""
+
+    def __init__(self, root=EMBEDDING_INDEX_DIR):
+        self.root = root
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _dirname(version):
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", version)
+
+    def index(self, version, dim_in=None):
+        """Index for a version; created only when dim_in is given"""
+        with self._lock:
+            idx = self._indexes.get(version)
+            if idx is None:
+                path = os.path.join(self.root, self._dirname(version))
+                if dim_in is None and not os.path.exists(os.path.join(path, "index.json")):
+                    return None
+                idx = self._indexes[version] = EmbeddingIndex(path, dim_in)
+            return idx
+
+    def open_all(self, versions):
+        for v in versions:
+            self.index(v)
+
+    def add(self, version, prediction_id, embedding, class_code, confidence, when):
+        embedding = np.asarray(embedding).ravel()
+        self.index(version, embedding.size).add([prediction_id], embedding[None], [(class_code, confidence, when)])
+
+    def similar(self, prediction_id, k=5, version=None):
+        """(version, neighbours) for a stored prediction, or (None, None) if unknown"""
+        if version:
+            candidates = [(version, self.index(version))]
+        else:
+            with self._lock:
+                candidates = list(self._indexes.items())
+        for name, idx in candidates:
+            if idx is not None and prediction_id in idx:
+                return name, idx.similar(prediction_id, k)
+        return None, None
+
+    def status(self):
+        with self._lock:
+            return {v: idx.status() for v, idx in self._indexes.items()}
@@ -0,0 +1,123 @@
+"""
+Streaming export of prediction history as CSV or Parquet.
+
+Records come straight from a prediction store scan in id order and are encoded
+ROWS_PER_BATCH at a time (one Parquet row group per batch), so server memory
+stays flat regardless of collection size.
+
+Every row carries a `cursor` column, an opaque token for its record id. Passing the
+last received token back as `after=` resumes the export right after that row,
+for example after a dropped connection.
+"""
+import base64
+import csv
+import io
+
+ROWS_PER_BATCH = 5000
+COLUMNS = ("cursor", "prediction_id", "patient_name", "prediction", "confidence", "model_version", "time",
+           "original_blob", "heatmap_blob")
+
+
+def encode_cursor(record_id):
+    return base64.urlsafe_b64encode(str(record_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Record id (string) for a cursor token; raises ValueError if the token is malformed"""
+    try:
+        return base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor token: {token}") from e
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _row(rec):
+    blobs = rec.get("blobs") or {}
+    return (
+        encode_cursor(rec["_id"]),
+        rec.get("prediction_id"),
+        rec.get("patient_name"),
+        rec.get("prediction"),
+        _float(rec.get("confidence")),
+        rec.get("model_version"),
+        str(rec["time"]) if rec.get("time") is not None else None,
+        blobs.get("original"),
+        blobs.get("heatmap"),
+    )
+
+
+def _batches(records, size=ROWS_PER_BATCH):
+    batch = []
+    for rec in records:
+        batch.append(_row(rec))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_csv(records, size=ROWS_PER_BATCH):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    for batch in _batches(records, size):
+        writer.writerows(batch)
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+class _Drain(io.RawIOBase):
+    """Write-only sink whose contents are handed out and forgotten after each row group"""
+
+    def __init__(self):
+        self._parts = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        out, self._parts = b"".join(self._parts), []
+        return out
+
+
+def parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def stream_parquet(records, size=ROWS_PER_BATCH):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(c, pa.float64() if c == "confidence" else pa.string()) for c in COLUMNS])
+    sink = _Drain()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="snappy") as writer:
+        for batch in _batches(records, size):
+            columns = list(zip(*batch))
+            writer.write_table(pa.table({c: pa.array(columns[i], type=schema.field(c).type)
+                                         for i, c in enumerate(COLUMNS)}, schema=schema))
+            yield sink.drain()
+    # footer
+    yield sink.drain()
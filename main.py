@@ -1,22 +1,25 @@
 import os
 import io
-import json
+import asyncio
 import base64
 import logging
+import time
+import threading
+import uuid
 from datetime import datetime
+from typing import List, Optional
 
 # Force non-interactive matplotlib backend to avoid Tkinter errors on server
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request, Header, HTTPException, Depends
+from fastapi.responses import PlainTextResponse, FileResponse, StreamingResponse
+from starlette.routing import Match
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
 import numpy as np
 import tensorflow as tf
-from tensorflow.keras.models import load_model
-from tensorflow.keras.layers import Conv2D
 from tensorflow.keras.applications.efficientnet import preprocess_input
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from PIL import Image
@@ -25,6 +28,27 @@ import pandas as pd
 from sklearn.metrics import confusion_matrix, roc_curve, auc
 from sklearn.preprocessing import label_binarize
 
+from tta import TTA_TRANSFORMS, augment_batch, aggregate_views
+from perf_profile import load_profile, apply_threading
+import metrics
+from metrics import timed
+from profiling import PROFILER, TracedRoute, is_admin, new_request_id
+from model_registry import ModelRegistry, ModelVersion, load_class_names
+import cascade as cascade_gate
+import quality_gate
+from embedding_index import EmbeddingStore
+from blob_store import BlobStore
+from rescore import RescoreJob, version_field
+import history_export
+from prediction_store import open_store
+import retention
+from doctor_directory import DoctorDirectory, load_directory, MAX_LIMIT as MAX_DOCTORS_PAGE
+from payloads import Payload
+import auth
+import deadlines
+import degrade
+from scheduler import InferenceScheduler
+
 # ---------- CONFIG ----------
 # Running from root 'skin' directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -41,8 +65,24 @@ BATCH_SIZE = 32
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("skin-api")
 
+# ---------- PERF PROFILE (written by autotune.py) ----------
+PERF_PROFILE = load_profile()
+apply_threading(tf, PERF_PROFILE)
+# batch size used for request-path inference (/predict/batch, TTA)
+INFER_BATCH_SIZE = int(PERF_PROFILE.get("batch_size", BATCH_SIZE))
+
+# default heatmap method: "gradcam", "cam" (forward-only, falls back to Grad-CAM), "auto" (= cam) or "none"
+EXPLAIN_METHOD = os.environ.get("EXPLAIN_METHOD", "gradcam").lower()
+EXPLAIN_METHODS = ("gradcam", "cam", "auto", "none")
+# upper bound on the per-request `topk` heatmaps
+HEATMAP_TOPK_MAX = int(os.environ.get("HEATMAP_TOPK_MAX", "3"))
+# heatmaps are skipped when less than this (or their recent run time) is left before the deadline
+EXPLAIN_MIN_SECONDS = float(os.environ.get("EXPLAIN_MIN_SECONDS", "0.5"))
+
 # ---------- APP ----------
 app = FastAPI(title="Skin Lesion API")
+# sync endpoints register their worker thread with an active request profile
+app.router.route_class = TracedRoute
 
 app.add_middleware(
     CORSMiddleware,
@@ -50,79 +90,146 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
-# ---------- LOAD CLASS NAMES ----------
-if not os.path.exists(CLASS_JSON):
-    log.warning(f"class_names.json not found at {CLASS_JSON}; falling back to default names.")
-    CLASS_NAMES = ["akiec", "bcc", "bkl", "df", "mel", "nv", "vasc"]
-else:
-    with open(CLASS_JSON, "r") as f:
-        CLASS_NAMES = json.load(f)
-    # ensure they are simple lower-case codes
-    CLASS_NAMES = [str(c).strip().lower() for c in CLASS_NAMES]
 
-log.info("Class names loaded: %s", CLASS_NAMES)
+def _route_path(request: Request):
+    """Route template (e.g. /doctors/{disease_name}) so metric labels stay bounded"""
+    route = request.scope.get("route")
+    if route is not None:
+        return route.path
+    for r in request.app.router.routes:
+        match, _ = r.matches(request.scope)
+        if match == Match.FULL:
+            return getattr(r, "path", "unmatched")
+    return "unmatched"
+
+
+@app.middleware("http")
+async def request_metrics(request: Request, call_next):
+    """Record end-to-end latency and attach per-stage Server-Timing to every response"""
+    token = metrics.begin_request()
+    t0 = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        elapsed = time.perf_counter() - t0
+        server_timing = metrics.end_request(token)
+    metrics.REQUEST_SECONDS.observe(elapsed, path=_route_path(request), method=request.method)
+    timing = f"total;dur={elapsed * 1000:.1f}"
+    response.headers["Server-Timing"] = f"{server_timing}, {timing}" if server_timing else timing
+    return response
+
+
+@app.middleware("http")
+async def request_profiler(request: Request, call_next):
+    """Profile this request if an operator armed the profiler or sent X-Profile"""
+    tf_trace = PROFILER.claim(request.headers)
+    if tf_trace is None:
+        return await call_next(request)
+
+    request_id = new_request_id(request.headers)
+    try:
+        session = PROFILER.start(tf_trace, request_id)
+    except Exception as e:
+        log.warning("Could not profile request %s: %s", request_id, e)
+        return await call_next(request)
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        PROFILER.finish(session, request.url.path, status_code)
+    response.headers["X-Profile-Id"] = request_id
+    return response
+
+# ---------- MODEL REGISTRY ----------
+# Optional manifest of model versions; without it the single MODEL_PATH model is served as "default"
+MODEL_REGISTRY_FILE = os.environ.get("MODEL_REGISTRY_FILE", os.path.join(BASE_DIR, "backend", "ai_model", "models.json"))
+MODELS = ModelRegistry(warmup_batch_sizes=(1,))
+# all model calls go through the scheduler: uploads first, then batch work, then evaluation
+SCHEDULER = InferenceScheduler()
+MODELS.shadow_runner = lambda fn: SCHEDULER.run("batch", fn)
+# steps /predict down to cheaper explanations (and a smaller model) under load
+DEGRADE = degrade.DegradationController(lambda: SCHEDULER.queued("interactive"))
+
+# Aliases for the active version, kept for scripts/benchmarks. Request handlers
+# take a ModelVersion snapshot instead so a hot-swap never changes them mid-request.
+model = None
+IMG_SIZE = 260 # default fallback
+LAST_CONV_LAYER = None
+CLASS_NAMES = load_class_names(CLASS_JSON)
+
 
-# ---------- LOAD MODEL ----------
-if not os.path.exists(MODEL_PATH):
+def _sync_active_aliases(mv: ModelVersion):
+    global model, IMG_SIZE, LAST_CONV_LAYER, CLASS_NAMES
+    model, IMG_SIZE, LAST_CONV_LAYER, CLASS_NAMES = mv.model, mv.img_size, mv.last_conv_layer, mv.class_names
+
+
+MODELS.on_activate(_sync_active_aliases)
+
+if os.path.exists(MODEL_REGISTRY_FILE):
+    MODELS.load_manifest(MODEL_REGISTRY_FILE)
+elif not os.path.exists(MODEL_PATH):
     log.error("Model file not found at: %s", MODEL_PATH)
     # Don't raise error immediately to allow server to start, but predict will fail
-    # raise FileNotFoundError(f"Model not found: {MODEL_PATH}")
-    model = None
 else:
-    log.info("Loading model (this may take a while)...")
     try:
-        model = load_model(MODEL_PATH)
+        MODELS.load("default", MODEL_PATH, CLASS_JSON)
+        MODELS.activate("default")
         log.info("Model loaded successfully")
     except Exception as e:
         log.error(f"Failed to load model: {e}")
-        model = None
 
-# determine model input size (height, width)
-IMG_SIZE = 260 # default fallback
-if model:
+log.info("Class names loaded: %s", CLASS_NAMES)
+if model is not None and LAST_CONV_LAYER is None:
+    log.warning("Could not find a convolutional layer for Grad-CAM; heatmaps will be blank.")
+
+metrics.MODEL_LOADED.set(1 if model is not None else 0)
+
+# ---------- EMBEDDING INDEX ("similar past cases") ----------
+EMBEDDINGS = EmbeddingStore() if os.environ.get("EMBEDDING_INDEX", "1") != "0" else None
+if EMBEDDINGS is not None:
     try:
-        # model.input_shape may be like (None, H, W, 3) or [(None,H,W,3)]
-        shape = model.input_shape
-        if isinstance(shape, list):
-            shape = shape[0]
-        _, H, W, C = shape
-        IMG_SIZE = int(H)
-        log.info("Detected model input size: %dx%d", IMG_SIZE, IMG_SIZE)
-    except Exception:
-        log.warning("Could not auto-detect model input size; using fallback %d", IMG_SIZE)
+        EMBEDDINGS.open_all(MODELS.status()["versions"])
+    except Exception as e:
+        log.error(f"Failed to open embedding indexes: {e}")
 
-# ---------- FIND LAST CONV LAYER FOR GRADCAM ----------
-LAST_CONV_LAYER = None
-if model:
-    for layer in reversed(model.layers):
-        # check for Conv2D by class OR 4D output shape
-        try:
-            if isinstance(layer, Conv2D) or (hasattr(layer, "output_shape") and len(layer.output_shape) == 4):
-                LAST_CONV_LAYER = layer.name
-                break
-        except Exception:
-            continue
-
-    if LAST_CONV_LAYER is None:
-        log.warning("Could not find a convolutional layer for Grad-CAM; heatmaps will be blank.")
-    else:
-        log.info("Using last conv layer for Grad-CAM: %s", LAST_CONV_LAYER)
+# ---------- BLOB STORE (uploads, crops, heatmaps, thumbnails) ----------
+BLOBS = BlobStore() if os.environ.get("BLOB_STORE", "1") != "0" else None
+
+# ---------- CASCADE (fast model first, full model on hard/risky cases) ----------
+CASCADE = cascade_gate.load_config()
+CASCADE_ESCALATIONS = metrics.REGISTRY.counter("skin_cascade_total", "Cascade decisions by outcome")
+
+# ---------- QUALITY GATE (reject unusable photos before the model) ----------
+QUALITY = quality_gate.load_config()
+QUALITY_CHECKS = metrics.REGISTRY.counter("skin_quality_gate_total", "Quality gate outcomes by reason")
 
 
-# ---------- MONGO (optional) ----------
+def quality_check(img: Image.Image, endpoint: str):
+    """Run the quality gate on a decoded upload; returns (reason, message, measurements)"""
+    with timed(endpoint, "quality_gate"):
+        reason, message, measured = quality_gate.check(img, QUALITY)
+    QUALITY_CHECKS.inc(outcome=reason or "passed")
+    return reason, message, measured
+
+
+# ---------- PREDICTION STORE (MongoDB or embedded SQLite) ----------
 try:
-    client = MongoClient("mongodb://127.0.0.1:27017", serverSelectionTimeoutMS=2000)
-    # Check connection
-    # _ = client.server_info() 
-    # Calling server_info might block if mongo is down, so we trust lazy connect or set timeout
-    db = client["skin_lesion_db"]
-    collection = db["predictions"]
-    log.info("MongoDB connected (lazy)")
+    STORE = open_store()
+    log.info("Prediction store: %s", STORE.backend)
 except Exception as e:
-    collection = None
-    log.warning("MongoDB not connected: %s", e)
+    STORE = None
+    log.warning("Prediction store not available: %s", e)
+
+
+@app.on_event("shutdown")
+def close_store():
+    # commits inserts still queued by the SQLite writer
+    if STORE is not None:
+        STORE.close()
 
 
 # ---------- DISEASE INFO (map short codes) ----------
@@ -191,149 +298,50 @@ DISEASE_INFO = {
         "risk_factors": "Excessive cumulative sun exposure, fair skin, immunosuppression, and older age."
     }
 }
-# ===================== DOCTORS DATABASE =====================
-
-DOCTORS = {
-    "Melanoma": [
-        {
-            "name": "Dr. Rajesh Kumar",
-            "specialist": "Dermato-Oncologist",
-            "hospital": "Apollo Cancer Center",
-            "city": "Delhi",
-            "contact": "+91-9876543210"
-        },
-        {
-            "name": "Dr. Aditi Sharma",
-            "specialist": "Skin Oncology",
-            "hospital": "AIIMS",
-            "city": "Delhi",
-            "contact": "+91-9123456789"
-        },
-        {
-            "name": "Dr. Sameer Khan",
-            "specialist": "Surgical Oncologist",
-            "hospital": "Tata Memorial Hospital",
-            "city": "Mumbai",
-            "contact": "+91-9820101010"
-        }
-    ],
-
-    "Basal Cell Carcinoma": [
-        {
-            "name": "Dr. Neha Varma",
-            "specialist": "Dermatologist",
-            "hospital": "Fortis",
-            "city": "Mumbai",
-            "contact": "+91-9898989898"
-        },
-        {
-            "name": "Dr. Vikram Das",
-            "specialist": "Mohs Surgeon",
-            "hospital": "Medanta",
-            "city": "Gurugram",
-            "contact": "+91-8811223344"
-        },
-        {
-            "name": "Dr. Sanjana Reddy",
-            "specialist": "Dermatologist",
-            "hospital": "Continental Hospitals",
-            "city": "Hyderabad",
-            "contact": "+91-7700112233"
-        }
-    ],
-
-    "Nevus": [
-        {
-            "name": "Dr. Sunil Patel",
-            "specialist": "Dermatologist",
-            "hospital": "Civil Hospital",
-            "city": "Ahmedabad",
-            "contact": "+91-9000012345"
-        },
-        {
-            "name": "Dr. Maya Singhania",
-            "specialist": "Cosmetic Dermatologist",
-            "hospital": "Breach Candy Hospital",
-            "city": "Mumbai",
-            "contact": "+91-9821556677"
-        }
-    ],
-
-    "Benign Keratosis-like Lesions": [
-        {
-            "name": "Dr. Rakesh Malhotra",
-            "specialist": "Dermatologist",
-            "hospital": "Max Healthcare",
-            "city": "Delhi",
-            "contact": "+91-9009988776"
-        },
-        {
-            "name": "Dr. Lakshmi Murthy",
-            "specialist": "General Dermatologist",
-            "hospital": "Aster CMI",
-            "city": "Bangalore",
-            "contact": "+91-8054321098"
-        }
-    ],
-
-    "Vascular Lesion": [
-        {
-            "name": "Dr. Pooja Iyer",
-            "specialist": "Plastic Surgeon",
-            "hospital": "Manipal Hospital",
-            "city": "Bangalore",
-            "contact": "+91-8887776665"
-        },
-        {
-            "name": "Dr. Siddharth Rao",
-            "specialist": "Vascular Surgeon",
-            "hospital": "Apollo Hospitals",
-            "city": "Chennai",
-            "contact": "+91-9940101010"
-        }
-    ],
-
-    "Actinic Keratosis": [
-        {
-            "name": "Dr. Kunal Mehta",
-            "specialist": "Dermatologist",
-            "hospital": "Jaslok Hospital",
-            "city": "Mumbai",
-            "contact": "+91-7999887766"
-        },
-        {
-            "name": "Dr. Anita Nair",
-            "specialist": "Dermatologist",
-            "hospital": "KIMS Hospital",
-            "city": "Kochi",
-            "contact": "+91-9556677889"
-        }
-    ],
-
-    "Dermatofibroma": [
-        {
-            "name": "Dr. Suman Rao",
-            "specialist": "Dermatologist",
-            "hospital": "Care Hospital",
-            "city": "Hyderabad",
-            "contact": "+91-9445566778"
-        },
-        {
-            "name": "Dr. Aman Deep",
-            "specialist": "General Practitioner",
-            "hospital": "City Clinic",
-            "city": "Chandigarh",
-            "contact": "+91-9776655443"
-        }
-    ]
-}
+# ---------- DOCTOR DIRECTORY (doctors.json, a CSV file or MongoDB; see doctor_directory.py) ----------
+# class codes ("mel") resolve to full disease names
+DOCTOR_ALIASES = {code: info["name"] for code, info in DISEASE_INFO.items()}
+try:
+    DOCTORS = load_directory(aliases=DOCTOR_ALIASES)
+except Exception as e:
+    log.error(f"Failed to load doctor directory: {e}")
+    DOCTORS = DoctorDirectory([], DOCTOR_ALIASES)
+
+
+# ---------- PRECOMPUTED REFERENCE RESPONSES (serialized/compressed once; see payloads.py) ----------
+REFERENCE_MAX_AGE = int(os.environ.get("REFERENCE_MAX_AGE", "3600"))
+DOCTORS_PAGE = 20
+DISEASE_INFO_PAYLOAD = Payload(DISEASE_INFO, REFERENCE_MAX_AGE)
+
+
+def doctors_page(directory, disease="", specialty="", city="", lat=None, lon=None, offset=0, limit=DOCTORS_PAGE):
+    with timed("doctors", "lookup"):
+        total, doctors = directory.search(disease, specialty, city, lat, lon, offset, limit)
+    return {"doctors": doctors, "total": total, "offset": offset, "limit": limit}
+
+
+def doctor_payloads(directory):
+    """Default /doctors/{disease} page for every indexed disease; "" is the unknown-disease reply"""
+    payloads = {"": Payload({"doctors": [], "total": 0, "offset": 0, "limit": DOCTORS_PAGE,
+                             "message": "No doctor available for this disease"}, REFERENCE_MAX_AGE)}
+    for disease in directory.by_disease:
+        payloads[disease] = Payload(doctors_page(directory, disease), REFERENCE_MAX_AGE)
+    return payloads
+
+
+DOCTOR_PAYLOADS = doctor_payloads(DOCTORS)
 
 
 # ---------- HELPERS ----------
-def preprocess_image(file_bytes: bytes):
-    """Return (model_input_array, pil_image_resized)"""
-    img = Image.open(io.BytesIO(file_bytes)).convert("RGB")
-    img = img.resize((IMG_SIZE, IMG_SIZE))
+def decode_image(file_bytes: bytes):
+    """Decode upload bytes into an RGB PIL image"""
+    return Image.open(io.BytesIO(file_bytes)).convert("RGB")
+
+
+def prepare_input(img: Image.Image, img_size: int = None):
+    """Return (model_input_array, pil_image_resized) from a decoded image"""
+    size = img_size or IMG_SIZE
+    img = img.resize((size, size))
     arr = np.array(img).astype(np.float32)
     # use preprocess_input for EfficientNet
     arr = preprocess_input(arr)
@@ -341,16 +349,78 @@ def preprocess_image(file_bytes: bytes):
     return arr, img
 
 
-def make_gradcam(img_array: np.ndarray):
+def preprocess_image(file_bytes: bytes, img_size: int = None):
+    """Return (model_input_array, pil_image_resized)"""
+    return prepare_input(decode_image(file_bytes), img_size)
+
+
+def class_info(probs: np.ndarray, class_names=None, idx: int = None):
+    """Return (class_code, confidence_percent, disease_info) for one probability vector (top class unless idx)"""
+    idx = int(np.argmax(probs)) if idx is None else int(idx)
+
+    # safe class code lookup (fallback to idx)
+    try:
+        class_code = (class_names or CLASS_NAMES)[idx]
+    except Exception:
+        class_code = f"class_{idx}"
+
+    confidence = float(probs[idx] * 100)
+
+    info = DISEASE_INFO.get(class_code, {
+        "name": class_code,
+        "description": "Not enough data available.",
+        "recommendation": "Consult a dermatologist."
+    })
+    return class_code, confidence, info
+
+
+def predict_tta(batch: np.ndarray, mv: ModelVersion = None):
+    """
+    Score every TTA view of every image in `batch` with a single model call.
+    Returns (mean_probs, variance), both shaped (N, num_classes).
+    """
+    mv = mv or MODELS.get()
+    views = augment_batch(batch)
+    metrics.BATCH_SIZE.set(len(views))
+    preds = mv.model.predict(views, batch_size=min(len(views), INFER_BATCH_SIZE * len(TTA_TRANSFORMS)), verbose=0)
+    return aggregate_views(preds, len(TTA_TRANSFORMS))
+
+
+def batch_forward(batch: np.ndarray, mv: ModelVersion):
+    """Class probabilities for a batch of preprocessed images"""
+    metrics.BATCH_SIZE.set(len(batch))
+    return np.asarray(mv.model.predict(batch, batch_size=INFER_BATCH_SIZE, verbose=0))
+
+
+def tta_summary(mean: np.ndarray, var: np.ndarray, class_names=None):
+    """Per-class averaged probability and variance for the response payload"""
+    class_names = class_names or CLASS_NAMES
+    names = [class_names[i] if i < len(class_names) else f"class_{i}" for i in range(len(mean))]
+    return {
+        "views": len(TTA_TRANSFORMS),
+        "probabilities": {n: round(float(p), 6) for n, p in zip(names, mean)},
+        "variance": {n: round(float(v), 6) for n, v in zip(names, var)},
+    }
+
+
+def resolve_model(version: str = ""):
+    """Return (ModelVersion, None) or (None, error_message) for a requested version"""
+    mv = MODELS.get(version or None)
+    if mv is not None:
+        return mv, None
+    if version:
+        return None, f"Unknown model version: {version}"
+    return None, "Model not loaded. Please check server logs."
+
+
+def make_gradcam(img_array: np.ndarray, mv: ModelVersion = None):
     """Return heatmap (H x W) normalized 0..1 or None if not available"""
-    if LAST_CONV_LAYER is None:
+    mv = mv or MODELS.get()
+    # the two-output model is built once per loaded version
+    grad_model = mv.grad_model() if mv is not None else None
+    if grad_model is None:
         return None
 
-    grad_model = tf.keras.models.Model(
-        [model.inputs],
-        [model.get_layer(LAST_CONV_LAYER).output, model.output]
-    )
-
     with tf.GradientTape() as tape:
         conv_outputs, preds = grad_model(img_array)
         pred_index = tf.argmax(preds[0])
@@ -364,11 +434,130 @@ def make_gradcam(img_array: np.ndarray):
     conv_outputs = conv_outputs[0]
     heatmap = conv_outputs @ pooled_grads[..., tf.newaxis]
     heatmap = tf.squeeze(heatmap).numpy()
+    return _normalize_heatmap(heatmap)
+
+
+def make_gradcam_topk(img_array: np.ndarray, class_indices, mv: ModelVersion = None):
+    """
+    Grad-CAM heatmaps for several classes from one forward pass. The k class
+    scores are differentiated together (vectorized jacobian) against the shared
+    conv activations instead of re-running the tape once per class.
+    Returns one heatmap (or None) per entry in class_indices.
+    """
+    mv = mv or MODELS.get()
+    grad_model = mv.grad_model() if mv is not None else None
+    if grad_model is None:
+        return [None] * len(class_indices)
+
+    with tf.GradientTape() as tape:
+        conv_outputs, preds = grad_model(img_array)
+        scores = tf.gather(preds[0], tf.constant(class_indices, dtype=tf.int32))
+
+    grads = tape.jacobian(scores, conv_outputs)  # (k, 1, h, w, c)
+    if grads is None:
+        return [None] * len(class_indices)
+
+    pooled_grads = tf.reduce_mean(grads, axis=(1, 2, 3))  # (k, c)
+    heatmaps = tf.einsum("hwc,kc->khw", conv_outputs[0], pooled_grads).numpy()
+    return [_normalize_heatmap(h) for h in heatmaps]
+
+
+def _normalize_heatmap(heatmap: np.ndarray):
     heatmap = np.maximum(heatmap, 0)
     if np.max(heatmap) == 0:
         return heatmap
-    heatmap = heatmap / (np.max(heatmap) + 1e-9)
-    return heatmap
+    return heatmap / (np.max(heatmap) + 1e-9)
+
+
+def forward_with_features(img_array: np.ndarray, mv: ModelVersion):
+    """One forward pass returning (predictions, last conv activations) as numpy"""
+    conv_outputs, preds = mv.grad_model()(img_array, training=False)
+    return np.asarray(preds), np.asarray(conv_outputs)
+
+
+def forward_with_embedding(img_array: np.ndarray, mv: ModelVersion):
+    """One forward pass returning (predictions, penultimate embeddings); embeddings are None without a Dense head"""
+    embed_model = mv.embed_model()
+    if embed_model is None:
+        return np.asarray(mv.model.predict(img_array, verbose=0)), None
+    embeddings, preds = embed_model(img_array, training=False)
+    return np.asarray(preds), np.asarray(embeddings)
+
+
+def make_cam(conv_features: np.ndarray, class_index: int, mv: ModelVersion):
+    """
+    Forward-only class activation map from the last conv features and the dense
+    classifier weights (valid for conv -> GAP -> Dense heads). No backward pass.
+    """
+    weights = mv.cam_weights[:, class_index]
+    return _normalize_heatmap(conv_features[0] @ weights)
+
+
+def make_cam_topk(conv_features: np.ndarray, class_indices, mv: ModelVersion):
+    """CAM heatmaps for several classes with a single matmul"""
+    heatmaps = conv_features[0] @ mv.cam_weights[:, list(class_indices)]  # (h, w, k)
+    return [_normalize_heatmap(heatmaps[..., i]) for i in range(heatmaps.shape[-1])]
+
+
+def cam_supported(mv: ModelVersion):
+    return mv is not None and mv.cam_weights is not None and mv.last_conv_layer is not None
+
+
+def resolve_explain_method(requested: str, mv: ModelVersion):
+    """Map a requested method to the one that will actually run for this model"""
+    method = (requested or EXPLAIN_METHOD).lower()
+    if method not in EXPLAIN_METHODS:
+        method = EXPLAIN_METHOD
+    if method in ("cam", "auto"):
+        return "cam" if cam_supported(mv) else "gradcam"
+    return method
+
+
+def fast_forward(x: np.ndarray, mv: ModelVersion):
+    """(probs, embedding or None) of the cascade's fast model for one image"""
+    with timed("predict", "fast_forward"):
+        preds, embeddings = forward_with_embedding(x, mv)
+    if preds.ndim == 1:
+        preds = preds[np.newaxis, :]
+    return preds[0], embeddings[0] if embeddings is not None else None
+
+
+def model_forward(x: np.ndarray, mv: ModelVersion, explain_method: str, tta: bool):
+    """
+    The /predict forward pass (runs on a scheduler lane).
+    Returns (probs, tta_stats, conv_features, embedding); the last three may be None.
+    """
+    tta_stats = conv_features = embedding = None
+    with timed("predict", "model_forward"):
+        if explain_method == "cam" and not tta:
+            # CAM needs the conv features anyway: one forward pass gives both
+            metrics.BATCH_SIZE.set(1)
+            preds, conv_features = forward_with_features(x, mv)
+            # conv -> GAP -> Dense head: the pooled features are the embedding
+            embedding = conv_features[0].mean(axis=(0, 1))
+        elif tta:
+            mean, var = predict_tta(x, mv)
+            preds = mean
+            tta_stats = tta_summary(mean[0], var[0], mv.class_names)
+        else:
+            metrics.BATCH_SIZE.set(1)
+            preds, embeddings = forward_with_embedding(x, mv)
+            if preds.ndim == 1:
+                preds = preds[np.newaxis, :]
+            if embeddings is not None:
+                embedding = embeddings[0]
+    return preds[0], tta_stats, conv_features, embedding
+
+
+def explain_heatmaps(x: np.ndarray, mv: ModelVersion, explain_method: str, top_indices, conv_features=None):
+    """One heatmap (or None) per class in top_indices, with CAM or Grad-CAM (runs on a scheduler lane)"""
+    if explain_method == "cam":
+        with timed("predict", "cam"):
+            if conv_features is None:
+                _, conv_features = forward_with_features(x, mv)
+            return make_cam_topk(conv_features, top_indices, mv)
+    with timed("predict", "gradcam"):
+        return make_gradcam_topk(x, top_indices, mv) if len(top_indices) > 1 else [make_gradcam(x, mv)]
 
 
 def overlay_heatmap(pil_image: Image.Image, heatmap: np.ndarray):
@@ -392,157 +581,489 @@ def root():
 
 
 @app.get("/config/disease-info")
-def get_disease_config():
-    """Returns the full dictionary of disease information."""
-    return DISEASE_INFO
+def get_disease_config(request: Request):
+    """Returns the full dictionary of disease information (precomputed, with ETag)."""
+    return DISEASE_INFO_PAYLOAD.response(request)
 
 # 3. DOCTORS ENDPOINT: Expose doctors for a specific full disease name
+@app.get("/doctors")
+def search_doctors(disease: str = "", specialty: str = "", city: str = "", lat: Optional[float] = None,
+                   lon: Optional[float] = None, offset: int = 0, limit: int = DOCTORS_PAGE):
+    """Doctors matching every given filter; with lat/lon, nearest first with distance_km"""
+    if (lat is None) != (lon is None):
+        return {"error": "Pass both lat and lon"}
+    if lat is not None and not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return {"error": "lat must be within [-90, 90] and lon within [-180, 180]"}
+    offset, limit = max(0, offset), max(1, min(limit, MAX_DOCTORS_PAGE))
+    return doctors_page(DOCTORS, disease, specialty, city, lat, lon, offset, limit)
+
+
 @app.get("/doctors/{disease_name}")
-def get_doctors_by_class(disease_name: str):
-    """Returns a list of doctors for the given disease name."""
-    # Look up using the FULL name (e.g., "Melanoma")
-    return {"doctors": DOCTORS.get(disease_name, [])}
+def get_doctors_by_class(request: Request, disease_name: str, specialty: str = "", city: str = "",
+                         lat: Optional[float] = None, lon: Optional[float] = None, offset: int = 0,
+                         limit: int = DOCTORS_PAGE):
+    """Returns doctors for the given disease (full name, /predict class name or class code)."""
+    if not (specialty or city) and lat is None and lon is None and offset == 0 and limit == DOCTORS_PAGE:
+        # what the frontend asks for: served precomputed
+        payloads = DOCTOR_PAYLOADS
+        return (payloads.get(DOCTORS.resolve_disease(disease_name)) or payloads[""]).response(request)
+    result = search_doctors(disease_name, specialty, city, lat, lon, offset, limit)
+    if not result.get("doctors") and "error" not in result:
+        result["message"] = "No doctor available for this disease"
+    return result
 
 
-@app.post("/predict")
-async def predict(file: UploadFile = File(...), patient_name: str = Form("")):
-    """Accepts multipart/form-data: file + patient_name"""
-    if model is None:
-         return {"error": "Model not loaded. Please check server logs."}
+# ===================== AUTH (see auth.py) =====================
+@app.post("/auth/register")
+async def register(request: Request, email: str = Form(...), password: str = Form(...)):
+    """Create an account, then log in with /auth/login (existing emails get the same answer)"""
+    return await auth.register(email, password, auth.client_ip(request))
 
-    try:
-        content = await file.read()
-        x, pil_img = preprocess_image(content)
 
-        preds = model.predict(x)
-        preds = np.asarray(preds)
-        if preds.ndim == 1:
-            preds = preds[np.newaxis, :]
-        preds0 = preds[0]
-        idx = int(np.argmax(preds0))
+@app.post("/auth/login")
+async def login(email: str = Form(...), password: str = Form(...)):
+    """Returns a bearer token for valid credentials"""
+    return await auth.login(email, password)
 
-        # safe class code lookup (fallback to idx)
-        try:
-            class_code = CLASS_NAMES[idx]
-        except Exception:
-            class_code = f"class_{idx}"
 
-        confidence = float(preds0[idx] * 100)
+@app.get("/auth/me")
+async def whoami(user: Optional[dict] = Depends(auth.current_user)):
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    return {"email": user["sub"], "expires": user.get("exp")}
 
-        info = DISEASE_INFO.get(class_code, {
-            "name": class_code,
-            "description": "Not enough data available.",
-            "recommendation": "Consult a dermatologist."
-        })
 
-        # Grad-CAM
-        heatmap = make_gradcam(x)
-        overlay = overlay_heatmap(pil_img, heatmap)
+@app.post("/predict", dependencies=[Depends(auth.inference_quota)])
+async def predict(request: Request, file: UploadFile = File(...), patient_name: str = Form(""), tta: bool = Form(False),
+                  model_version: str = Form(""), cascade: Optional[bool] = Form(None),
+                  explain: str = Form(""), topk: int = Form(1), check_quality: Optional[bool] = Form(None),
+                  compact: bool = Form(False)):
+    """
+    Accepts multipart/form-data: file + patient_name.
+    Optional: tta flag, model_version, cascade (defaults to the cascade.json setting),
+    explain = gradcam | cam | auto | none (defaults to EXPLAIN_METHOD),
+    topk = number of top classes to return heatmaps for (up to HEATMAP_TOPK_MAX),
+    check_quality (defaults to the quality_gate.json setting),
+    compact = return class codes without the disease texts (see /config/disease-info).
+    X-Request-Timeout (seconds) sets the deadline; work for a request past it, or
+    whose client disconnected, is dropped.
+    Under load the explanation and model are degraded (see degrade.py); "tier" says how.
+    """
+    mv, error = resolve_model(model_version)
+    if mv is None:
+         return {"error": error}
+    deadline = deadlines.from_request(request)
+    tier = DEGRADE.tier()
+    if tier == "small_model":
+        small = MODELS.get(DEGRADE.cfg["small_model"]) if not model_version else None
+        if small is not None:
+            mv = small
+        else:
+            tier = "no_heatmap"
 
-        _, buf = cv2.imencode(".jpg", overlay)
-        heat_b64 = base64.b64encode(buf.tobytes()).decode("utf-8")
+    t_start = time.perf_counter()
+    metrics.QUEUE_DEPTH.inc()
+    try:
+        with timed("predict", "upload_read"):
+            content = await file.read()
+        with timed("predict", "decode"):
+            decoded = decode_image(content)
+        if QUALITY["enabled"] if check_quality is None else check_quality:
+            reason, message, measured = quality_check(decoded, "predict")
+            if reason is not None:
+                return {"error": message, "rejected": reason, "quality": measured}
+        with timed("predict", "preprocess"):
+            x, pil_img = prepare_input(decoded, mv.img_size)
+
+        tta_stats = None
+        cascade_info = None
+        preds0 = None
+        embedding = None
+        use_cascade = ((CASCADE["enabled"] if cascade is None else cascade) and not model_version and not tta
+                       and tier != "small_model")
+        fast = MODELS.get(CASCADE["fast_version"]) if use_cascade else None
+        if fast is not None and fast is not mv:
+            fx, fimg = (x, pil_img) if fast.img_size == mv.img_size else prepare_input(decoded, fast.img_size)
+            fprobs, fembedding = await deadline.run(SCHEDULER, "interactive", fast_forward, fx, fast)
+            reason = cascade_gate.escalation_reason(
+                fprobs, cascade_gate.severity_vector(fast.class_names, DISEASE_INFO), CASCADE)
+            cascade_info = {"fast_version": fast.name, "escalated": reason is not None, "reason": reason}
+            CASCADE_ESCALATIONS.inc(outcome=reason or "served_fast")
+            if reason is None:
+                # served by the fast model: indexed for /similar under the fast version
+                mv, x, pil_img, preds0, embedding = fast, fx, fimg, fprobs, fembedding
+
+        explain_method = degrade.explain_for(tier, resolve_explain_method(explain, mv), cam_supported(mv))
+        conv_features = None
+
+        # preds0 is already set when the cascade's fast model served the request
+        if preds0 is None:
+            preds0, tta_stats, conv_features, embedding = await deadline.run(
+                SCHEDULER, "interactive", model_forward, x, mv, explain_method, tta)
+
+        class_code, confidence, info = class_info(preds0, mv.class_names)
+        MODELS.maybe_shadow(mv.name, class_code, decoded, prepare_input)
+
+        # Explanation heatmap(s); top_indices[0] is the predicted class
+        topk = max(1, min(int(topk or 1), HEATMAP_TOPK_MAX, len(preds0)))
+        top_indices = [int(i) for i in np.argsort(preds0)[::-1][:topk]]
+        heatmaps = [None] * topk
+        explain_skipped = False
+        if explain_method in ("cam", "gradcam"):
+            expected = SCHEDULER.estimate(explain_heatmaps)
+            if deadline.remaining() < max(EXPLAIN_MIN_SECONDS, expected):
+                deadlines.record_skipped("interactive", "explain_skipped", expected)
+                explain_method, explain_skipped = "none", True
+            else:
+                heatmaps = await deadline.run(SCHEDULER, "interactive", explain_heatmaps,
+                                              x, mv, explain_method, top_indices, conv_features)
+        with timed("predict", "overlay"):
+            overlay = overlay_heatmap(pil_img, heatmaps[0])
+
+        with timed("predict", "jpeg_encode"):
+            _, buf = cv2.imencode(".jpg", overlay)
+        with timed("predict", "base64"):
+            heat_b64 = base64.b64encode(buf.tobytes()).decode("utf-8")
+
+        # nobody is waiting for the result any more: skip storing it. A result that is
+        # merely late is still stored and returned; dropping happens before inference.
+        if await deadline.poll() == "client_disconnected":
+            raise deadlines.DeadlineExceeded("client_disconnected")
+
+        blobs = None
+        if BLOBS is not None:
+            try:
+                with timed("predict", "blob_write"):
+                    blobs = {
+                        "original": BLOBS.put(content),
+                        "input": BLOBS.put_image(pil_img),
+                        "heatmap": BLOBS.put(buf.tobytes(), "jpg"),
+                        "original_thumb": BLOBS.put_thumbnail(decoded),
+                        # overlay is in OpenCV channel order
+                        "heatmap_thumb": BLOBS.put_thumbnail(Image.fromarray(overlay[..., ::-1])),
+                    }
+            except Exception as e:
+                log.warning("Failed to store blobs: %s", e)
+
+        topk_heatmaps = None
+        if topk > 1:
+            with timed("predict", "topk_encode"):
+                topk_heatmaps = []
+                for rank, (idx, hm) in enumerate(zip(top_indices, heatmaps)):
+                    code, prob, k_info = class_info(preds0, mv.class_names, idx)
+                    if rank == 0:
+                        b64 = heat_b64
+                    else:
+                        _, kbuf = cv2.imencode(".jpg", overlay_heatmap(pil_img, hm))
+                        b64 = base64.b64encode(kbuf.tobytes()).decode("utf-8")
+                    item = {"code": code, "confidence": round(prob, 2), "heatmap_base64": b64}
+                    if not compact:
+                        item["class"] = k_info["name"]
+                    topk_heatmaps.append(item)
 
         # Save to DB (non blocking for UI)
-        if collection is not None:
+        prediction_id = uuid.uuid4().hex
+        now = str(datetime.now())
+        if STORE is not None:
             try:
-                collection.insert_one({
-                    "patient_name": patient_name,
-                    "prediction": info["name"],
-                    "confidence": round(confidence, 2),
-                    "time": str(datetime.now())
-                })
+                with timed("predict", "db_write"):
+                    STORE.insert({
+                        "prediction_id": prediction_id,
+                        "patient_name": patient_name,
+                        "prediction": info["name"],
+                        "confidence": round(confidence, 2),
+                        "model_version": mv.name,
+                        "blobs": blobs,
+                        "time": now
+                    })
             except Exception as e:
-                log.warning("Failed to write to MongoDB: %s", e)
+                log.warning("Failed to store prediction: %s", e)
 
-        return {
-        "patient_name": patient_name,
-        "class": info["name"], # Returns FULL NAME (e.g., "Melanoma")
-        "confidence": round(confidence, 2),
-        "description": info["description"],
-        "recommendation": info["recommendation"],
-        "heatmap_base64": heat_b64
-    }
+        if EMBEDDINGS is not None and embedding is not None:
+            try:
+                with timed("predict", "embedding_index"):
+                    EMBEDDINGS.add(mv.name, prediction_id, embedding, class_code, round(confidence, 2), now)
+            except Exception as e:
+                log.warning("Failed to index embedding: %s", e)
 
+        if compact:
+            # name, description and recommendation are DISEASE_INFO[class_code], served cached
+            result = {"patient_name": patient_name, "class_code": class_code}
+        else:
+            result = {
+                "patient_name": patient_name,
+                "class": info["name"], # Returns FULL NAME (e.g., "Melanoma")
+                "description": info["description"],
+                "recommendation": info["recommendation"],
+            }
+        result.update({
+            "confidence": round(confidence, 2),
+            "heatmap_base64": heat_b64,
+            "model_version": mv.name,
+            "explain_method": explain_method,
+            "tier": tier,
+            "prediction_id": prediction_id,
+            "blobs": blobs
+        })
+        if explain_skipped:
+            result["explain_skipped"] = "deadline"
+        degrade.SERVED.inc(tier=tier)
+        if tta_stats is not None:
+            result["tta"] = tta_stats
+        if cascade_info is not None:
+            result["cascade"] = cascade_info
+        if topk_heatmaps is not None:
+            result["heatmaps"] = topk_heatmaps
+        return result
+
+    except deadlines.DeadlineExceeded as e:
+        return {"error": "Request deadline exceeded", "abandoned": e.reason}
     except Exception as e:
         log.exception("Prediction failed")
         return {"error": str(e)}
+    finally:
+        metrics.QUEUE_DEPTH.dec()
+        DEGRADE.observe(time.perf_counter() - t_start)
+
+
+@app.post("/predict/batch", dependencies=[Depends(auth.inference_quota)])
+async def predict_batch(request: Request, files: List[UploadFile] = File(...), tta: bool = Form(False),
+                        model_version: str = Form(""),
+                        check_quality: Optional[bool] = Form(None)):
+    """
+    Scores several images in one model call (no heatmaps).
+    With tta=true every augmented view of every image goes into the same batch.
+    Images failing the quality gate are reported in place and not scored.
+    """
+    mv, error = resolve_model(model_version)
+    if mv is None:
+        return {"error": error}
+    deadline = deadlines.from_request(request)
+
+    metrics.QUEUE_DEPTH.inc()
+    try:
+        arrays, accepted, rejected = [], [], {}
+        for i, f in enumerate(files):
+            with timed("predict_batch", "decode"):
+                decoded = decode_image(await f.read())
+            if QUALITY["enabled"] if check_quality is None else check_quality:
+                reason, message, measured = quality_check(decoded, "predict_batch")
+                if reason is not None:
+                    rejected[i] = {"filename": f.filename, "error": message, "rejected": reason, "quality": measured}
+                    continue
+            with timed("predict_batch", "preprocess"):
+                x, _ = prepare_input(decoded, mv.img_size)
+            arrays.append(x[0])
+            accepted.append(i)
+
+        probs, var = [], None
+        if arrays:
+            batch = np.stack(arrays)
+            await deadline.check("batch")
+            with timed("predict_batch", "model_forward"):
+                # one scheduler item per INFER_BATCH_SIZE images, so uploads can run in between
+                if tta:
+                    chunks = await asyncio.to_thread(SCHEDULER.map_chunks, "batch", lambda b: predict_tta(b, mv),
+                                                     batch, INFER_BATCH_SIZE, deadline)
+                    probs = np.concatenate([c[0] for c in chunks])
+                    var = np.concatenate([c[1] for c in chunks])
+                else:
+                    chunks = await asyncio.to_thread(SCHEDULER.map_chunks, "batch", lambda b: batch_forward(b, mv),
+                                                     batch, INFER_BATCH_SIZE, deadline)
+                    probs = np.concatenate(chunks)
+
+        scored = {}
+        for j, i in enumerate(accepted):
+            class_code, confidence, info = class_info(probs[j], mv.class_names)
+            item = {
+                "filename": files[i].filename,
+                "class": info["name"],
+                "class_code": class_code,
+                "confidence": round(confidence, 2),
+            }
+            if var is not None:
+                item["tta"] = tta_summary(probs[j], var[j], mv.class_names)
+            scored[i] = item
+        results = [scored.get(i) or rejected[i] for i in range(len(files))]
+        return {"results": results, "model_version": mv.name}
+
+    except deadlines.DeadlineExceeded as e:
+        return {"error": "Request deadline exceeded", "abandoned": e.reason}
+    except Exception as e:
+        log.exception("Batch prediction failed")
+        return {"error": str(e)}
+    finally:
+        metrics.QUEUE_DEPTH.dec()
 
 
-@app.get("/history")
-def get_history():
-    if collection is None:
+@app.get("/blobs/{key}", dependencies=[Depends(auth.current_user)])
+def get_blob(key: str):
+    """Stored upload / crop / heatmap / thumbnail by content key; immutable, cacheable by the client only"""
+    if BLOBS is None:
+        raise HTTPException(status_code=404, detail="Blob store is disabled")
+    try:
+        path = BLOBS.path(key)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Unknown blob")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Unknown blob")
+    return FileResponse(path, headers={"Cache-Control": "private, max-age=31536000, immutable"})
+
+
+@app.get("/similar/{prediction_id}", dependencies=[Depends(auth.current_user)])
+def similar_cases(prediction_id: str, k: int = 5, model_version: str = ""):
+    """Closest past cases to a stored prediction, by penultimate-layer embedding"""
+    if EMBEDDINGS is None:
+        return {"error": "Embedding index is disabled"}
+    k = max(1, min(int(k), 50))
+    with timed("similar", "search"):
+        version, hits = EMBEDDINGS.similar(prediction_id, k, model_version or None)
+    if hits is None:
+        return {"error": f"Unknown prediction id: {prediction_id}"}
+    for h in hits:
+        h["class"] = DISEASE_INFO.get(h["class_code"], {}).get("name", h["class_code"])
+    return {"prediction_id": prediction_id, "model_version": version, "similar": hits}
+
+
+def _history_filter(patient_name: str = "", prediction: str = "", model_version: str = "",
+                    since: str = "", until: str = ""):
+    """Store filters for the history query parameters; since/until compare against the stored time string"""
+    return {"patient_name": patient_name, "prediction": prediction, "model_version": model_version,
+            "since": since, "until": until}
+
+
+@app.get("/history", dependencies=[Depends(auth.current_user)])
+def get_history(patient_name: str = "", prediction: str = "", model_version: str = "",
+                since: str = "", until: str = "", limit: int = 0):
+    if STORE is None:
         return []
     try:
-        recs = list(collection.find({}, {"_id": 0}).sort("time", -1))
+        recs = STORE.find(_history_filter(patient_name, prediction, model_version, since, until), limit)
         return recs
     except Exception as e:
         log.warning("History read failed: %s", e)
         return []
-# ===================== DOCTOR API =====================
 
-@app.get("/doctors/{disease_name}")
-def get_doctors(disease_name: str):
 
-    doctors = DOCTORS.get(disease_name, [])
+@app.get("/history/export", dependencies=[Depends(auth.current_user)])
+def export_history(format: str = "csv", after: str = "", limit: int = 0, patient_name: str = "",
+                   prediction: str = "", model_version: str = "", since: str = "", until: str = ""):
+    """
+    Streams history as CSV or Parquet in _id order, with the same filters as /history.
+    Each row has a `cursor` column; pass the last one as `after` to resume.
+    """
+    if STORE is None:
+        return {"error": "Database not connected"}
+    fmt = format.lower()
+    if fmt not in ("csv", "parquet"):
+        return {"error": f"Unsupported format: {format} (use csv or parquet)"}
+    if fmt == "parquet" and not history_export.parquet_available():
+        return {"error": "Parquet export needs pyarrow installed"}
+
+    last_id = None
+    if after:
+        try:
+            last_id = history_export.decode_cursor(after)
+            STORE.parse_id(last_id)
+        except ValueError as e:
+            return {"error": str(e)}
+
+    cursor = STORE.scan(_history_filter(patient_name, prediction, model_version, since, until),
+                        after=last_id, limit=limit, batch_size=history_export.ROWS_PER_BATCH)
+    if fmt == "csv":
+        body, media_type = history_export.stream_csv(cursor), "text/csv"
+    else:
+        body, media_type = history_export.stream_parquet(cursor), "application/vnd.apache.parquet"
+    return StreamingResponse(body, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="predictions.{fmt}"'})
+
+
+def load_test_data(img_size: int):
+    """Unshuffled test-set generator preprocessed for a model of the given input size"""
+    test_gen = ImageDataGenerator(preprocessing_function=preprocess_input)
+    return test_gen.flow_from_directory(
+        TEST_DIR,
+        target_size=(img_size, img_size),
+        batch_size=BATCH_SIZE,
+        class_mode="categorical",
+        shuffle=False
+    )
+
+
+def predict_test_set(data, mv: ModelVersion):
+    """
+    Probabilities for every image of a test generator, one scheduler item per
+    generator batch, so /predict requests get the lane between batches.
+    """
+    probs = [SCHEDULER.run("evaluation", batch_forward, data[i][0], mv) for i in range(len(data))]
+    return np.concatenate(probs) if probs else np.zeros((0, len(mv.class_names)))
 
-    if not doctors:
-        return {"message": "No doctor available for this disease", "doctors": []}
 
-    return {"doctors": doctors}
+def _single_image_ms(mv: ModelVersion, sample: np.ndarray, repeats: int = 10):
+    """Median latency of a one-image predict, i.e. what a /predict request pays"""
+    x = sample[:1]
+    mv.model.predict(x, verbose=0)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        mv.model.predict(x, verbose=0)
+        times.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(times))
 
 
-@app.get("/evaluation")
-def evaluate_model():
-    if model is None:
-        return {"error": "Model not loaded"}
+@app.get("/evaluation", dependencies=[Depends(auth.inference_quota)])
+def evaluate_model(model_version: str = ""):
+    mv, error = resolve_model(model_version)
+    if mv is None:
+        return {"error": error}
 
     if not os.path.exists(TEST_DIR):
         return {"error": f"Test directory not found at {TEST_DIR}"}
 
     try:
-        test_gen = ImageDataGenerator(preprocessing_function=preprocess_input)
-        test_data = test_gen.flow_from_directory(
-            TEST_DIR,
-            target_size=(IMG_SIZE, IMG_SIZE),
-            batch_size=BATCH_SIZE,
-            class_mode="categorical",
-            shuffle=False
-        )
+        with timed("evaluation", "load_data"):
+            test_data = load_test_data(mv.img_size)
     except Exception as e:
          return {"error": f"Failed to load test data: {e}"}
 
     try:
-        loss, acc = model.evaluate(test_data, verbose=0)
-        preds = model.predict(test_data, verbose=0)
+        with timed("evaluation", "model_predict"):
+            preds = predict_test_set(test_data, mv)
         y_pred = np.argmax(preds, axis=1)
-        y_true = test_data.classes
+        y_true = np.asarray(test_data.classes)
+        # accuracy and categorical cross-entropy from the same pass (model.evaluate would be a second one)
+        acc = float((y_pred == y_true).mean()) if len(y_true) else 0.0
+        true_probs = preds[np.arange(len(y_true)), y_true] if len(y_true) else np.ones(1)
+        loss = float(-np.log(np.clip(true_probs, 1e-7, 1.0)).mean())
 
         # Confusion matrix image
-        cm = confusion_matrix(y_true, y_pred)
-        fig, ax = plt.subplots(figsize=(6, 6))
-        ax.imshow(cm, cmap="Blues")
-        ax.set_xticks(np.arange(len(CLASS_NAMES)))
-        ax.set_yticks(np.arange(len(CLASS_NAMES)))
-        ax.set_xticklabels(CLASS_NAMES, rotation=45)
-        ax.set_yticklabels(CLASS_NAMES)
-        for i in range(len(CLASS_NAMES)):
-            for j in range(len(CLASS_NAMES)):
-                ax.text(j, i, int(cm[i, j]), ha="center", va="center", color="white")
-        buf = io.BytesIO()
-        plt.tight_layout()
-        plt.savefig(buf, format="png")
-        buf.seek(0)
-        cm_img = base64.b64encode(buf.read()).decode("utf-8")
-        plt.close(fig)
+        with timed("evaluation", "confusion_matrix_chart"):
+            cm = confusion_matrix(y_true, y_pred)
+            fig, ax = plt.subplots(figsize=(6, 6))
+            ax.imshow(cm, cmap="Blues")
+            ax.set_xticks(np.arange(len(mv.class_names)))
+            ax.set_yticks(np.arange(len(mv.class_names)))
+            ax.set_xticklabels(mv.class_names, rotation=45)
+            ax.set_yticklabels(mv.class_names)
+            for i in range(len(mv.class_names)):
+                for j in range(len(mv.class_names)):
+                    ax.text(j, i, int(cm[i, j]), ha="center", va="center", color="white")
+            buf = io.BytesIO()
+            plt.tight_layout()
+            plt.savefig(buf, format="png")
+            buf.seek(0)
+            cm_img = base64.b64encode(buf.read()).decode("utf-8")
+            plt.close(fig)
 
         # ROC
+        roc_t0 = time.perf_counter()
         try:
-            y_true_bin = label_binarize(y_true, classes=np.arange(len(CLASS_NAMES)))
+            y_true_bin = label_binarize(y_true, classes=np.arange(len(mv.class_names)))
             fig2, ax2 = plt.subplots(figsize=(6, 6))
-            for i in range(len(CLASS_NAMES)):
+            for i in range(len(mv.class_names)):
                 fpr, tpr, _ = roc_curve(y_true_bin[:, i], preds[:, i])
                 roc_auc = auc(fpr, tpr)
-                ax2.plot(fpr, tpr, label=f"{CLASS_NAMES[i]} ({roc_auc:.2f})")
+                ax2.plot(fpr, tpr, label=f"{mv.class_names[i]} ({roc_auc:.2f})")
             ax2.plot([0, 1], [0, 1], "k--")
             ax2.legend()
             buf2 = io.BytesIO()
@@ -554,33 +1075,300 @@ def evaluate_model():
         except Exception as e:
             log.warning("ROC generation failed: %s", e)
             roc_img = ""
+        metrics.record_stage("evaluation", "roc_chart", time.perf_counter() - roc_t0)
 
         return {
             "accuracy": round(float(acc) * 100, 2),
             "loss": round(float(loss), 4),
             "confusion_matrix": cm_img,
-            "roc_curve": roc_img
+            "roc_curve": roc_img,
+            "model_version": mv.name
         }
     except Exception as e:
         log.error(f"Evaluation failed: {e}")
         return {"error": str(e)}
 
 
+def cascade_sweep(max_accuracy_drop: float, severity_min: int):
+    """
+    Scores the test set with the fast and full models, sweeps the cascade
+    thresholds and reports accuracy vs average per-image latency; {"error": ...} on failure.
+    """
+    full = MODELS.get()
+    fast = MODELS.get(CASCADE["fast_version"])
+    if full is None or fast is None:
+        return {"error": f"Need both the active model and fast model '{CASCADE['fast_version']}' loaded"}
+    if list(fast.class_names) != list(full.class_names):
+        # the gate and the accuracy comparison both assume one class order
+        return {"error": f"Fast model '{fast.name}' and active model '{full.name}' have different class names"}
+    if not os.path.exists(TEST_DIR):
+        return {"error": f"Test directory not found at {TEST_DIR}"}
+
+    try:
+        with timed("evaluation", "cascade_full_predict"):
+            full_data = load_test_data(full.img_size)
+            full_probs = predict_test_set(full_data, full)
+        with timed("evaluation", "cascade_fast_predict"):
+            fast_data = load_test_data(fast.img_size)
+            fast_probs = predict_test_set(fast_data, fast)
+        y_true = np.asarray(full_data.classes)
+
+        full_ms = SCHEDULER.run("evaluation", _single_image_ms, full, full_data[0][0])
+        fast_ms = SCHEDULER.run("evaluation", _single_image_ms, fast, fast_data[0][0])
+
+        severities = cascade_gate.severity_vector(fast.class_names, DISEASE_INFO)
+        rows = cascade_gate.sweep(fast_probs, full_probs, y_true, fast_ms, full_ms, severities, severity_min)
+        full_acc = round(float((np.argmax(full_probs, axis=1) == y_true).mean()) * 100, 2)
+        fast_acc = round(float((np.argmax(fast_probs, axis=1) == y_true).mean()) * 100, 2)
+        best = cascade_gate.choose(rows, full_acc, max_accuracy_drop)
+
+        return {
+            "full_model": {"version": full.name, "accuracy": full_acc, "latency_ms": round(full_ms, 2)},
+            "fast_model": {"version": fast.name, "accuracy": fast_acc, "latency_ms": round(fast_ms, 2)},
+            "selected": best,
+            "applied": False,
+            "tradeoff": sorted(rows, key=lambda r: r["avg_latency_ms"]),
+        }
+    except Exception as e:
+        log.error(f"Cascade evaluation failed: {e}")
+        return {"error": str(e)}
+
+
+@app.get("/evaluation/cascade", dependencies=[Depends(auth.inference_quota)])
+def evaluate_cascade(max_accuracy_drop: float = 1.0, severity_min: int = 3):
+    """Read-only threshold sweep; POST /admin/cascade applies the selected thresholds"""
+    return cascade_sweep(max_accuracy_drop, severity_min)
+
+
+@app.post("/admin/cascade")
+def apply_cascade(max_accuracy_drop: float = 1.0, severity_min: int = 3, x_admin_token: str = Header("")):
+    """Run the sweep, save the selected thresholds to cascade.json and enable the cascade"""
+    _require_admin(x_admin_token)
+    report = cascade_sweep(max_accuracy_drop, severity_min)
+    if "error" in report:
+        raise HTTPException(status_code=409, detail=report["error"])
+    best = report["selected"]
+    CASCADE.update({k: best[k] for k in ("margin", "risk_prob", "severity_min")})
+    CASCADE.update({"enabled": True, "fast_version": report["fast_model"]["version"]})
+    cascade_gate.save_config(CASCADE)
+    report["applied"] = True
+    return report
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Prometheus text exposition of stage timers and gauges"""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+def _require_admin(token: str):
+    if not is_admin(token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+@app.post("/admin/profile")
+def arm_profiler(count: int = 1, tf_trace: bool = False, x_admin_token: str = Header("")):
+    """Profile the next `count` requests; results land in PROFILE_DIR keyed by request id"""
+    _require_admin(x_admin_token)
+    PROFILER.arm(count, tf_trace)
+    return PROFILER.status()
+
+
+@app.get("/admin/profile")
+def profiler_status(x_admin_token: str = Header("")):
+    _require_admin(x_admin_token)
+    return PROFILER.status()
+
+
+@app.get("/admin/scheduler")
+def scheduler_status(x_admin_token: str = Header("")):
+    """Queued model work and lane-time share per priority class"""
+    _require_admin(x_admin_token)
+    return SCHEDULER.status()
+
+
+@app.get("/admin/degrade")
+def degrade_status(x_admin_token: str = Header("")):
+    """Current degradation tier and the load signals behind it"""
+    _require_admin(x_admin_token)
+    return DEGRADE.status()
+
+
 @app.get("/model-status")
 def model_status():
+    mv = MODELS.get()
     return {
-        "status": "loaded" if model is not None else "not_loaded",
-        "model_name": getattr(model, "ai_model", "final_skin_model_90plus.keras")
+        "status": "loaded" if mv is not None else "not_loaded",
+        "model_name": os.path.basename(mv.path) if mv is not None else "final_skin_model_90plus.keras",
+        "active_version": MODELS.active_name,
+        "versions": sorted(MODELS.status()["versions"]),
     }
 
 
-@app.get("/dashboard")
-def dashboard():
+# ===================== MODEL REGISTRY ADMIN =====================
+
+@app.get("/admin/models")
+def list_models(x_admin_token: str = Header("")):
+    _require_admin(x_admin_token)
+    status = MODELS.status()
+    status["embedding_indexes"] = EMBEDDINGS.status() if EMBEDDINGS is not None else None
+    return status
+
+
+@app.post("/admin/models")
+def load_model_version(name: str, path: str, class_names: str = "", activate: bool = False,
+                       x_admin_token: str = Header("")):
+    """Load (and warm up) a model version in the background; activate it when ready if asked"""
+    _require_admin(x_admin_token)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=400, detail=f"Model file not found: {path}")
+    started = MODELS.load_async(name, path, class_names or CLASS_JSON, activate=activate)
+    if not started:
+        raise HTTPException(status_code=409, detail=f"{name} is already loading")
+    return {"status": "loading", "name": name}
+
+
+@app.post("/admin/models/{name}/activate")
+def activate_model_version(name: str, x_admin_token: str = Header("")):
+    _require_admin(x_admin_token)
+    try:
+        MODELS.activate(name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model version: {name}")
+    return MODELS.status()
+
+
+@app.delete("/admin/models/{name}")
+def unload_model_version(name: str, x_admin_token: str = Header("")):
+    _require_admin(x_admin_token)
+    try:
+        removed = MODELS.unload(name)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"removed": removed}
+
+
+@app.post("/admin/models/shadow")
+def set_shadow_model(name: str = "", sample_rate: float = 0.1, x_admin_token: str = Header("")):
+    """Score a sample of traffic on `name` off the request path (empty name disables)"""
+    _require_admin(x_admin_token)
+    try:
+        MODELS.set_shadow(name, sample_rate)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model version: {name}")
+    return MODELS.status()
+
+
+@app.post("/admin/doctors/reload")
+def reload_doctors(x_admin_token: str = Header("")):
+    """Rebuild the doctor directory from DOCTORS_SOURCE, its result cache and precomputed pages"""
+    global DOCTORS, DOCTOR_PAYLOADS
+    _require_admin(x_admin_token)
+    try:
+        directory = load_directory(aliases=DOCTOR_ALIASES)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load doctor directory: {e}")
+    DOCTORS, DOCTOR_PAYLOADS = directory, doctor_payloads(directory)
+    return DOCTORS.status()
+
+
+@app.get("/admin/doctors")
+def doctors_status(x_admin_token: str = Header("")):
+    _require_admin(x_admin_token)
+    return DOCTORS.status()
+
+
+# ===================== BULK RE-SCORING =====================
+RESCORE_JOBS = {}
+
+
+def _prepare_bytes(data: bytes, img_size: int):
+    x, _ = prepare_input(decode_image(data), img_size)
+    return x[0]
+
+
+@app.post("/admin/rescore")
+def start_rescore(model_version: str, chunk: int = 512, decode_workers: int = 4, restart: bool = False,
+                  x_admin_token: str = Header("")):
+    """Re-score every stored case with `model_version` in the background, resuming from its checkpoint"""
+    _require_admin(x_admin_token)
+    if STORE is None or BLOBS is None:
+        raise HTTPException(status_code=409, detail="Re-scoring needs both the prediction store and the blob store")
+    mv = MODELS.get(model_version)
+    if mv is None:
+        raise HTTPException(status_code=404, detail=f"Unknown model version: {model_version}")
+    job = RESCORE_JOBS.get(model_version)
+    if job is not None and job.running:
+        raise HTTPException(status_code=409, detail=f"Re-scoring with {model_version} is already running")
+    job = RescoreJob(STORE, BLOBS, mv, _prepare_bytes, class_info,
+                     batch_size=INFER_BATCH_SIZE, chunk=chunk, decode_workers=decode_workers, scheduler=SCHEDULER)
+    if restart:
+        job.reset()
+    RESCORE_JOBS[model_version] = job
+    job.start()
+    return job.status()
+
+
+@app.get("/admin/rescore")
+def rescore_status(x_admin_token: str = Header("")):
+    _require_admin(x_admin_token)
+    return {name: job.status() for name, job in RESCORE_JOBS.items()}
+
+
+@app.post("/admin/rescore/{model_version}/stop")
+def stop_rescore(model_version: str, x_admin_token: str = Header("")):
+    """Stop after the current chunk; a later start resumes from the checkpoint"""
+    _require_admin(x_admin_token)
+    job = RESCORE_JOBS.get(model_version)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No re-scoring job for {model_version}")
+    job.stop()
+    return job.status()
+
+
+# ===================== RETENTION (archive old records, purge junk) =====================
+RETENTION_STATUS = {"running": False, "last_report": None, "error": None}
+
+
+def _run_retention(days, dry_run):
+    try:
+        RETENTION_STATUS["last_report"] = retention.run(STORE, days, dry_run=dry_run)
+        RETENTION_STATUS["error"] = None
+    except BaseException as e:
+        log.exception("Retention run failed")
+        RETENTION_STATUS["error"] = str(e)
+    finally:
+        RETENTION_STATUS["running"] = False
+
+
+@app.post("/admin/retention")
+def start_retention(days: int = retention.RETENTION_DAYS, dry_run: bool = False, x_admin_token: str = Header("")):
+    """Purge junk records and archive records older than `days` in the background"""
+    _require_admin(x_admin_token)
+    if STORE is None:
+        raise HTTPException(status_code=409, detail="Prediction store not available")
+    if RETENTION_STATUS["running"]:
+        raise HTTPException(status_code=409, detail="A retention run is already in progress")
+    RETENTION_STATUS["running"] = True
+    threading.Thread(target=_run_retention, args=(days, dry_run), name="retention", daemon=True).start()
+    return RETENTION_STATUS
+
+
+@app.get("/admin/retention")
+def retention_status(x_admin_token: str = Header("")):
+    _require_admin(x_admin_token)
+    return {**RETENTION_STATUS, "rollups": retention.load_rollups()}
+
+
+@app.get("/dashboard", dependencies=[Depends(auth.current_user)])
+def dashboard(model_version: str = ""):
     """
     Fetches prediction records from the database, calculates key statistics,
     and generates three base64-encoded charts for the dashboard visualization.
+    With model_version, records re-scored by that version use the re-scored prediction.
+    Archived records (retention.py) are included through their rollups, with their original prediction.
     """
-    if collection is None:
+    if STORE is None:
         # Return fallback data if DB is down, to avoid crashing frontend
         return {
                 "total_cases": 0,
@@ -593,10 +1381,19 @@ def dashboard():
 
     try:
         # 1. Fetch data from the connected database
-        # Find all records, excluding the MongoDB _id field
-        records = list(collection.find({}, {"_id": 0})) 
-
-        if not records:
+        # All records, without backend ids
+        with timed("dashboard", "db_read"):
+            records = STORE.find()
+            if model_version:
+                field = version_field(model_version)
+                for r in records:
+                    rescored = (r.get("rescored") or {}).get(field)
+                    if rescored:
+                        r["prediction"], r["confidence"] = rescored["prediction"], rescored["confidence"]
+
+        # Records archived by retention.py are counted from their rollups
+        archived = retention.load_rollups()
+        if not records and not (archived and archived["total"]):
             # Return zeroed stats if no records are found
             return {
                 "total_cases": 0,
@@ -607,20 +1404,34 @@ def dashboard():
                 "disease_bar_graph": ""
             }
 
-        df = pd.DataFrame(records)
-        # Ensure confidence is treated as a float for calculations/plotting
-        df['confidence'] = df['confidence'].astype(float) 
-        
+        with timed("dashboard", "dataframe"):
+            df = pd.DataFrame(records, columns=["prediction", "confidence"])
+            # Ensure confidence is treated as a float for calculations/plotting
+            df['confidence'] = pd.to_numeric(df['confidence'], errors="coerce")
+            counts = df["prediction"].value_counts()
+            hist = retention.confidence_histogram(df["confidence"].dropna())
+            total_cases = len(df)
+            max_confidence = df["confidence"].max()
+            if archived:
+                counts = counts.add(pd.Series(archived["prediction_counts"], dtype=float), fill_value=0)
+                counts = counts.astype(int).sort_values(ascending=False)
+                hist = hist + np.asarray(archived["confidence_hist"])
+                total_cases += archived["total"]
+                max_confidence = np.nanmax([max_confidence, archived["max_confidence"] or np.nan])
+
+        charts_t0 = time.perf_counter()
+
         # Helper function to generate and encode plot images
         def generate_plot(fig):
             """Saves matplotlib figure to a base64 string and closes the figure."""
             # Use 'png' format and bbox_inches='tight' for clean output
             buf = io.BytesIO()
-            plt.tight_layout()
-            plt.savefig(buf, format="png", bbox_inches='tight')
-            buf.seek(0)
-            img_base64 = base64.b64encode(buf.read()).decode("utf-8")
-            plt.close(fig)
+            with timed("dashboard", "chart_encode"):
+                plt.tight_layout()
+                plt.savefig(buf, format="png", bbox_inches='tight')
+                buf.seek(0)
+                img_base64 = base64.b64encode(buf.read()).decode("utf-8")
+                plt.close(fig)
             return img_base64
 
         # ----------------------------------------------------
@@ -629,10 +1440,10 @@ def dashboard():
         fig_pie, ax_pie = plt.subplots(figsize=(6, 6))
         
         # Check if there's enough data for a pie chart (more than one category)
-        if df["prediction"].nunique() > 1:
+        if len(counts) > 1:
             ax_pie.pie(
-                df["prediction"].value_counts(), 
-                labels=df["prediction"].value_counts().index, 
+                counts,
+                labels=counts.index,
                 autopct='%1.1f%%', 
                 startangle=90, 
                 wedgeprops={'edgecolor': 'white'}
@@ -648,7 +1459,8 @@ def dashboard():
         # 2. Case Confidence (Histogram)
         # ----------------------------------------------------
         fig_hist, ax_hist = plt.subplots(figsize=(7, 4))
-        ax_hist.hist(df['confidence'], bins=10, edgecolor='black', color='#3b82f6')
+        bins = retention.CONFIDENCE_BINS
+        ax_hist.hist(bins[:-1], bins=bins, weights=hist, edgecolor='black', color='#3b82f6')
         ax_hist.set_title("Distribution of Model Confidence", fontsize=14, fontweight='bold')
         ax_hist.set_xlabel("Confidence (%)")
         ax_hist.set_ylabel("Number of Cases")
@@ -658,18 +1470,20 @@ def dashboard():
         # 3. Disease Counts (Bar Graph)
         # ----------------------------------------------------
         fig_bar, ax_bar = plt.subplots(figsize=(7, 4))
-        df["prediction"].value_counts().plot(kind="bar", ax=ax_bar, color='#10b981')
+        counts.plot(kind="bar", ax=ax_bar, color='#10b981')
         ax_bar.set_title("Total Cases by Predicted Disease", fontsize=14, fontweight='bold')
         ax_bar.set_xlabel("Predicted Disease")
         ax_bar.set_ylabel("Count")
         plt.xticks(rotation=30, ha='right') 
         disease_bar_graph = generate_plot(fig_bar)
 
+        metrics.record_stage("dashboard", "charts_total", time.perf_counter() - charts_t0)
+
         # 4. Compile and Return Data
         return {
-            "total_cases": int(len(df)),
-            "total_diseases": int(df["prediction"].nunique()),
-            "max_confidence": float(df["confidence"].max()),
+            "total_cases": int(total_cases),
+            "total_diseases": int(len(counts)),
+            "max_confidence": float(np.nan_to_num(max_confidence)),
             "disease_pie_chart": disease_pie_chart,
             "confidence_histogram": confidence_histogram,
             "disease_bar_graph": disease_bar_graph,
@@ -683,5 +1497,10 @@ if __name__ == "__main__":
     import uvicorn
     # Use PORT env variable provided by Railway, default to 7860
     port = int(os.environ.get("PORT", 7860))
+    workers = int(os.environ.get("WEB_CONCURRENCY", PERF_PROFILE.get("workers", 1)))
     # Use 0.0.0.0 to allow access from other devices/containers
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    if workers > 1:
+        # multiple workers need an import string; each worker re-applies the profile
+        uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
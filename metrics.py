@@ -0,0 +1,193 @@
+"""
+Minimal in-process metrics: counters, gauges and fixed-bucket histograms,
+rendered in the Prometheus text exposition format for the /metrics endpoint.
+
+Stage timers also append to a per-request list so main.py can emit a
+`Server-Timing` header. Each observation is a perf_counter call plus a short
+locked update, cheap enough to leave on in production.
+"""
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# seconds; covers sub-ms bookkeeping up to multi-second /evaluation phases
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# stage timings of the current request, for the Server-Timing header
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _label_key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+
+def _fmt_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items)
+    return "{" + body + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0.0)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for key, v in self._values.items():
+                lines.append(f"{self.name}{_fmt_labels(key)} {v}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = float(value)
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for key, (counts, total, n) in self._values.items():
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    lines.append(f"{self.name}_bucket{_fmt_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, [('le', '+Inf')])} {n}")
+                lines.append(f"{self.name}_sum{_fmt_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_fmt_labels(key)} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text):
+        return self._metrics.get(name) or self._add(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self._metrics.get(name) or self._add(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._metrics.get(name) or self._add(Histogram(name, help_text, buckets))
+
+    def add_collector(self, fn):
+        """Register a callback run just before rendering (for computed gauges)."""
+        self._collectors.append(fn)
+
+    def render(self):
+        for fn in self._collectors:
+            fn()
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("skin_stage_seconds", "Time spent per pipeline stage")
+REQUEST_SECONDS = REGISTRY.histogram("skin_request_seconds", "End-to-end request latency")
+QUEUE_DEPTH = REGISTRY.gauge("skin_queue_depth", "Inference requests waiting or running")
+BATCH_SIZE = REGISTRY.gauge("skin_batch_size", "Rows in the most recent model call")
+MODEL_LOADED = REGISTRY.gauge("skin_model_loaded", "1 if the model is loaded")
+CACHE_LOOKUPS = REGISTRY.counter("skin_cache_lookups_total", "Cache lookups")
+CACHE_HITS = REGISTRY.counter("skin_cache_hits_total", "Cache hits")
+CACHE_HIT_RATIO = REGISTRY.gauge("skin_cache_hit_ratio", "Cache hits / lookups")
+
+
+def _update_hit_ratio():
+    for key, lookups in list(CACHE_LOOKUPS._values.items()):
+        labels = dict(key)
+        CACHE_HIT_RATIO.set(CACHE_HITS.value(**labels) / lookups if lookups else 0.0, **labels)
+
+
+REGISTRY.add_collector(_update_hit_ratio)
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.inc(cache=cache)
+    if hit:
+        CACHE_HITS.inc(cache=cache)
+
+
+# ---------- PER-REQUEST STAGE TIMING ----------
+def begin_request():
+    """Start collecting stage timings for this request; returns a reset token."""
+    return _request_timings.set([])
+
+
+def end_request(token):
+    """Stop collecting and return the Server-Timing header value."""
+    timings = _request_timings.get() or []
+    _request_timings.reset(token)
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in timings)
+
+
+def record_stage(endpoint: str, stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, endpoint=endpoint, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds * 1000))
+
+
+@contextmanager
+def timed(endpoint: str, stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(endpoint, stage, time.perf_counter() - t0)
@@ -0,0 +1,345 @@
+"""
+Versioned model registry with background loading and atomic hot-swap.
+
+Each ModelVersion bundles a Keras model with its own class names, input size
+and Grad-CAM layer. Requests take a reference to a version once, at the start,
+and use it to the end, so swapping the active version never affects a
+request already in flight; the old model is freed when its last request
+finishes.
+
+An optional manifest (MODEL_REGISTRY_FILE, default backend/ai_model/models.json)
+lists versions to load at startup:
+
+    {"active": "b2-v1",
+     "versions": {"b2-v1": {"path": "final_skin_model_B2_90plus.keras",
+                            "class_names": "class_names.json"}}}
+
+Relative paths are resolved against the manifest's directory.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2D
+from tensorflow.keras.models import load_model
+
+import metrics
+
+log = logging.getLogger("skin-api")
+
+DEFAULT_CLASS_NAMES = ["akiec", "bcc", "bkl", "df", "mel", "nv", "vasc"]
+FALLBACK_IMG_SIZE = 260  # B2 default
+
+SHADOW_TOTAL = metrics.REGISTRY.counter("skin_shadow_scored_total", "Requests re-scored by the shadow model")
+SHADOW_AGREE = metrics.REGISTRY.counter("skin_shadow_agree_total", "Shadow predictions matching the served class")
+SHADOW_DROPPED = metrics.REGISTRY.counter("skin_shadow_dropped_total", "Shadow jobs skipped because the queue was full")
+
+
+def load_class_names(path):
+    if not path or not os.path.exists(path):
+        log.warning(f"class_names.json not found at {path}; falling back to default names.")
+        return list(DEFAULT_CLASS_NAMES)
+    with open(path, "r") as f:
+        names = json.load(f)
+    # ensure they are simple lower-case codes
+    return [str(c).strip().lower() for c in names]
+
+
+def detect_input_size(model):
+    try:
+        # model.input_shape may be like (None, H, W, 3) or [(None,H,W,3)]
+        shape = model.input_shape
+        if isinstance(shape, list):
+            shape = shape[0]
+        _, H, W, C = shape
+        return int(H)
+    except Exception:
+        log.warning("Could not auto-detect model input size; using fallback %d", FALLBACK_IMG_SIZE)
+        return FALLBACK_IMG_SIZE
+
+
+def find_last_conv_layer(model):
+    for layer in reversed(model.layers):
+        # check for Conv2D by class OR 4D output shape
+        try:
+            if isinstance(layer, Conv2D) or (hasattr(layer, "output_shape") and len(layer.output_shape) == 4):
+                return layer.name
+        except Exception:
+            continue
+    return None
+
+
+# layers that are identities at inference and may sit between pooling and the classifier
+_CAM_PASSTHROUGH = ("Dropout", "SpatialDropout2D", "GaussianNoise", "GaussianDropout", "AlphaDropout", "Identity")
+
+
+def find_cam_head(model, conv_layer_name):
+    """
+    Dense kernel (channels x classes) if the model ends in
+    conv -> GlobalAveragePooling2D -> [dropout] -> Dense[softmax], which is
+    what forward-only CAM needs; None for any other head.
+    """
+    if conv_layer_name is None:
+        return None
+    names = [layer.name for layer in model.layers]
+    tail = model.layers[names.index(conv_layer_name) + 1:]
+    if not tail or type(tail[0]).__name__ != "GlobalAveragePooling2D":
+        return None
+    dense = None
+    for layer in tail[1:]:
+        kind = type(layer).__name__
+        if kind in _CAM_PASSTHROUGH:
+            continue
+        if kind == "Dense" and dense is None:
+            dense = layer
+            continue
+        if kind in ("Activation", "Softmax") and dense is not None:
+            continue
+        return None
+    if dense is None or getattr(dense.activation, "__name__", "") not in ("linear", "softmax"):
+        return None
+    return dense.get_weights()[0]
+
+
+def find_embedding_layer(model):
+    """Final Dense classifier, whose input is the penultimate-layer embedding; None if absent"""
+    for layer in reversed(model.layers):
+        if type(layer).__name__ == "Dense":
+            return layer
+    return None
+
+
+class ModelVersion:
+    def __init__(self, name, model, class_names, path=""):
+        self.name = name
+        self.model = model
+        self.class_names = class_names
+        self.path = path
+        self.img_size = detect_input_size(model)
+        self.last_conv_layer = find_last_conv_layer(model)
+        self.loaded_at = datetime.now().isoformat(timespec="seconds")
+        self._grad_model = None
+        self._embed_model = None
+        self._grad_lock = threading.Lock()
+        self.cam_weights = find_cam_head(model, self.last_conv_layer)
+
+    def grad_model(self):
+        """(conv activations, predictions) sub-model for Grad-CAM, built once"""
+        if self.last_conv_layer is None:
+            return None
+        metrics.cache_lookup("grad_model", self._grad_model is not None)
+        if self._grad_model is None:
+            with self._grad_lock:
+                if self._grad_model is None:
+                    self._grad_model = tf.keras.models.Model(
+                        [self.model.inputs],
+                        [self.model.get_layer(self.last_conv_layer).output, self.model.output]
+                    )
+        return self._grad_model
+
+    def embed_model(self):
+        """(penultimate embedding, predictions) sub-model, built once; None without a Dense head"""
+        metrics.cache_lookup("embed_model", self._embed_model is not None)
+        if self._embed_model is None:
+            dense = find_embedding_layer(self.model)
+            if dense is None:
+                return None
+            with self._grad_lock:
+                if self._embed_model is None:
+                    self._embed_model = tf.keras.models.Model([self.model.inputs], [dense.input, self.model.output])
+        return self._embed_model
+
+    def warm_up(self, batch_sizes=(1,)):
+        """Trace the predict/Grad-CAM graphs so the first real request is not slow"""
+        t0 = time.perf_counter()
+        for n in batch_sizes:
+            self.model.predict(np.zeros((n, self.img_size, self.img_size, 3), np.float32), verbose=0)
+        for sub in (self.grad_model(), self.embed_model()):
+            if sub is not None:
+                sub(np.zeros((1, self.img_size, self.img_size, 3), np.float32))
+        log.info("Model %s warmed up in %.1fs", self.name, time.perf_counter() - t0)
+
+    def describe(self):
+        return {
+            "name": self.name,
+            "path": self.path,
+            "img_size": self.img_size,
+            "classes": self.class_names,
+            "gradcam_layer": self.last_conv_layer,
+            "cam_supported": self.cam_weights is not None,
+            "loaded_at": self.loaded_at,
+        }
+
+
+class ModelRegistry:
+    def __init__(self, warmup_batch_sizes=(1,)):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._active = None
+        self._loading = {}
+        self._listeners = []
+        self.warmup_batch_sizes = tuple(warmup_batch_sizes)
+        # shadow scoring runs off the request path on its own thread
+        self._shadow = None
+        self._shadow_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+        self._shadow_pending = 0
+        self._shadow_lock = threading.Lock()
+        self.shadow_max_pending = 8
+        # optional fn(callable) -> result that runs the shadow model call, e.g. on a scheduler
+        self.shadow_runner = None
+
+    # ----- lookup -----
+    def get(self, name=None):
+        """Active version, or the named one. Returns None if unavailable."""
+        with self._lock:
+            if not name:
+                return self._versions.get(self._active)
+            return self._versions.get(name)
+
+    @property
+    def active_name(self):
+        return self._active
+
+    def on_activate(self, fn):
+        """Call fn(version) whenever the active version changes"""
+        self._listeners.append(fn)
+
+    # ----- loading -----
+    def load(self, name, path, class_names_path=None, warm_up=True):
+        """Load and warm up a version synchronously, then register it (not active)"""
+        log.info("Loading model %s from %s (this may take a while)...", name, path)
+        model = load_model(path)
+        mv = ModelVersion(name, model, load_class_names(class_names_path), path)
+        if warm_up:
+            mv.warm_up(self.warmup_batch_sizes)
+        with self._lock:
+            self._versions[name] = mv
+            replaced_active = name == self._active
+        log.info("Model %s ready: input %dx%d, Grad-CAM layer %s", name, mv.img_size, mv.img_size, mv.last_conv_layer)
+        if replaced_active:
+            # reloading the active name swaps it in place
+            self._notify(mv)
+        return mv
+
+    def load_async(self, name, path, class_names_path=None, activate=False):
+        """Load in a background thread; optionally activate once warm"""
+        with self._lock:
+            if self._loading.get(name) == "loading":
+                return False
+            self._loading[name] = "loading"
+
+        def _run():
+            try:
+                self.load(name, path, class_names_path)
+                self._loading[name] = "ready"
+                if activate:
+                    self.activate(name)
+            except Exception as e:
+                log.exception("Background load of %s failed", name)
+                self._loading[name] = f"failed: {e}"
+
+        threading.Thread(target=_run, daemon=True, name=f"load-{name}").start()
+        return True
+
+    def activate(self, name):
+        with self._lock:
+            mv = self._versions.get(name)
+            if mv is None:
+                raise KeyError(name)
+            previous, self._active = self._active, name
+        log.info("Active model switched %s -> %s", previous, name)
+        self._notify(mv)
+        return mv
+
+    def _notify(self, mv):
+        metrics.MODEL_LOADED.set(1)
+        for fn in self._listeners:
+            fn(mv)
+
+    def unload(self, name):
+        with self._lock:
+            if name == self._active:
+                raise ValueError("Cannot unload the active model")
+            if self._shadow and self._shadow[0] == name:
+                self._shadow = None
+            self._loading.pop(name, None)
+            return self._versions.pop(name, None) is not None
+
+    def load_manifest(self, path):
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+        resolve = lambda p: p if not p or os.path.isabs(p) else os.path.join(base, p)
+        for name, spec in manifest.get("versions", {}).items():
+            try:
+                self.load(name, resolve(spec["path"]), resolve(spec.get("class_names")))
+            except Exception as e:
+                log.error(f"Failed to load model {name}: {e}")
+        active = manifest.get("active") or next(iter(self._versions), None)
+        if active in self._versions:
+            self.activate(active)
+
+    # ----- shadow scoring -----
+    def set_shadow(self, name, sample_rate):
+        if not name:
+            self._shadow = None
+            return
+        if self.get(name) is None:
+            raise KeyError(name)
+        self._shadow = (name, max(0.0, min(1.0, float(sample_rate))))
+
+    def maybe_shadow(self, served_version, served_class, pil_image, prepare):
+        """
+        With probability sample_rate, re-score the request on the shadow
+        version in the background. `prepare(pil_image, img_size)` must return
+        the model input batch.
+        """
+        shadow = self._shadow
+        if shadow is None or shadow[0] == served_version or random.random() >= shadow[1]:
+            return
+        with self._shadow_lock:
+            if self._shadow_pending >= self.shadow_max_pending:
+                SHADOW_DROPPED.inc(candidate=shadow[0])
+                return
+            self._shadow_pending += 1
+        self._shadow_pool.submit(self._run_shadow, shadow[0], served_version, served_class, pil_image, prepare)
+
+    def _run_shadow(self, name, served_version, served_class, pil_image, prepare):
+        try:
+            mv = self.get(name)
+            if mv is None:
+                return
+            x, _ = prepare(pil_image, mv.img_size)
+            predict = lambda: np.asarray(mv.model.predict(x, verbose=0))[0]
+            probs = self.shadow_runner(predict) if self.shadow_runner else predict()
+            idx = int(np.argmax(probs))
+            shadow_class = mv.class_names[idx] if idx < len(mv.class_names) else f"class_{idx}"
+            SHADOW_TOTAL.inc(candidate=name)
+            if shadow_class == served_class:
+                SHADOW_AGREE.inc(candidate=name)
+            else:
+                log.info("Shadow %s disagrees with %s: %s vs %s (%.2f)",
+                         name, served_version, shadow_class, served_class, float(probs[idx]))
+        except Exception:
+            log.exception("Shadow scoring on %s failed", name)
+        finally:
+            with self._shadow_lock:
+                self._shadow_pending -= 1
+
+    # ----- status -----
+    def status(self):
+        with self._lock:
+            versions = {n: mv.describe() for n, mv in self._versions.items()}
+        return {
+            "active": self._active,
+            "versions": versions,
+            "loading": dict(self._loading),
+            "shadow": {"name": self._shadow[0], "sample_rate": self._shadow[1]} if self._shadow else None,
+        }
@@ -0,0 +1,284 @@
+"""
+Offline inference-graph optimizer for the served Keras model.
+
+Produces an inference-only copy of a training artifact:
+  * training-only layers (Dropout variants, GaussianNoise, in-model Random*
+    augmentation, ActivityRegularization) become identities,
+  * every BatchNormalization that directly follows a linear Conv2D /
+    DepthwiseConv2D (and is that conv's only consumer) is folded into the
+    conv's kernel and bias,
+  * the input shape is fixed to (IMG_SIZE, IMG_SIZE, 3).
+
+Nested models (e.g. the EfficientNet backbone) are rewritten recursively.
+The result is checked for numerical equivalence on the test set before it is
+written, and per-image latency / weight memory are reported for both models.
+
+    python optimize_model.py
+    python optimize_model.py --model backend/ai_model/other.keras --img-size 260 --atol 1e-3
+"""
+import argparse
+import inspect
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL = os.path.join(BASE_DIR, "backend", "ai_model", "final_skin_model_B2_90plus.keras")
+TEST_DIR = os.path.join(BASE_DIR, "dataset", "test")
+
+TRAINING_ONLY = (
+    "Dropout", "SpatialDropout1D", "SpatialDropout2D", "SpatialDropout3D", "GaussianNoise",
+    "GaussianDropout", "AlphaDropout", "ActivityRegularization", "RandomFlip", "RandomRotation",
+    "RandomZoom", "RandomTranslation", "RandomContrast", "RandomBrightness", "RandomCrop",
+    "RandomHeight", "RandomWidth",
+)
+FOLDABLE_CONVS = ("Conv2D", "DepthwiseConv2D")
+
+
+def _identity(name):
+    if hasattr(tf.keras.layers, "Identity"):
+        layer = tf.keras.layers.Identity(name=name)
+    else:
+        layer = tf.keras.layers.Activation("linear", name=name)
+    layer._is_identity = True
+    return layer
+
+
+def _call_clone(layer, *args, **kwargs):
+    """Keras 3 replays each node's call kwargs (e.g. BatchNormalization's mask) on its clone"""
+    if getattr(layer, "_is_identity", False):
+        return layer(args[0])
+    return layer(*args, **kwargs)
+
+
+# Keras 2's clone_model has no call_function and does not replay call kwargs;
+# Sequential models never take one
+_CLONE_KWARGS = ({"call_function": _call_clone}
+                 if "call_function" in inspect.signature(tf.keras.models.clone_model).parameters else {})
+
+
+def _inbound_layers(layer):
+    """Layers feeding `layer` (Keras 2 and Keras 3 node APIs)"""
+    nodes = getattr(layer, "_inbound_nodes", None) or getattr(layer, "inbound_nodes", [])
+    out = []
+    for node in nodes:
+        inbound = getattr(node, "inbound_layers", None)
+        if inbound is not None:
+            out.extend(inbound if isinstance(inbound, (list, tuple)) else [inbound])
+        else:
+            out.extend(p.operation for p in getattr(node, "parent_nodes", []))
+    return out
+
+
+def _consumers(layer):
+    return len(getattr(layer, "_outbound_nodes", None) or getattr(layer, "outbound_nodes", []))
+
+
+def find_fold_pairs(model):
+    """{bn_name: conv_layer} for BN layers that can be folded into their producer"""
+    pairs = {}
+    for layer in model.layers:
+        if type(layer).__name__ != "BatchNormalization":
+            continue
+        axis = layer.axis[0] if isinstance(layer.axis, (list, tuple)) else layer.axis
+        if axis not in (-1, 3):
+            continue
+        inbound = _inbound_layers(layer)
+        if len(inbound) != 1:
+            continue
+        conv = inbound[0]
+        if type(conv).__name__ not in FOLDABLE_CONVS or _consumers(conv) != 1:
+            continue
+        if getattr(conv.activation, "__name__", "") != "linear":
+            continue
+        pairs[layer.name] = conv
+    return pairs
+
+
+def fold_weights(conv, bn):
+    """Kernel and bias of conv followed by bn, as one conv"""
+    depthwise = type(conv).__name__ == "DepthwiseConv2D"
+    weights = conv.get_weights()
+    kernel = weights[0]
+    out_channels = kernel.shape[2] * kernel.shape[3] if depthwise else kernel.shape[-1]
+    bias = weights[1] if conv.use_bias else np.zeros(out_channels, np.float32)
+
+    bn_w = bn.get_weights()
+    i = 0
+    gamma = bn_w[i] if bn.scale else 1.0
+    i += 1 if bn.scale else 0
+    beta = bn_w[i] if bn.center else 0.0
+    i += 1 if bn.center else 0
+    mean, var = bn_w[i], bn_w[i + 1]
+    scale = gamma / np.sqrt(var + bn.epsilon)
+
+    if depthwise:
+        # kernel (kh, kw, in, mult); output channel c = in_idx * mult + m
+        kernel = kernel * scale.reshape(kernel.shape[2], kernel.shape[3])
+    else:
+        kernel = kernel * scale
+    bias = (bias - mean) * scale + beta
+    return [kernel.astype(np.float32), bias.astype(np.float32)]
+
+
+def _rewrite(model, stats, input_tensors=None):
+    """Clone `model` with training-only layers and folded BNs replaced by identities"""
+    pairs = find_fold_pairs(model)
+    folded_convs = {conv.name for conv in pairs.values()}
+
+    def clone_fn(layer):
+        kind = type(layer).__name__
+        if isinstance(layer, tf.keras.Model):
+            return _rewrite(layer, stats)
+        if kind in TRAINING_ONLY:
+            stats["removed"] += 1
+            return _identity(layer.name)
+        if layer.name in pairs:
+            stats["folded"] += 1
+            return _identity(layer.name)
+        config = layer.get_config()
+        if layer.name in folded_convs:
+            config["use_bias"] = True
+        return layer.__class__.from_config(config)
+
+    kwargs = {} if isinstance(model, tf.keras.Sequential) else _CLONE_KWARGS
+    new = tf.keras.models.clone_model(model, input_tensors=input_tensors, clone_function=clone_fn, **kwargs)
+
+    # copy weights by name; folded convs take the BN-adjusted kernel/bias
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.Model) or not layer.weights:
+            continue
+        if layer.name in pairs:
+            continue
+        target = new.get_layer(layer.name)
+        if layer.name in folded_convs:
+            bn = next(model.get_layer(b) for b, c in pairs.items() if c.name == layer.name)
+            target.set_weights(fold_weights(layer, bn))
+        elif target.weights:
+            target.set_weights(layer.get_weights())
+    return new
+
+
+def optimize(model, img_size):
+    stats = {"removed": 0, "folded": 0}
+    # clone onto a fixed-size input so shapes are static throughout the graph; cloning
+    # (not calling the clone as a layer) keeps the top level flat, so the conv, pooling
+    # and Dense layers Grad-CAM, CAM and the embedding index look up stay visible
+    inputs = tf.keras.Input((img_size, img_size, 3), name="image")
+    rewritten = _rewrite(model, stats, input_tensors=inputs)
+    fixed = tf.keras.Model(rewritten.inputs, rewritten.outputs, name=f"{model.name}_inference")
+    return fixed, stats
+
+
+# ---------- CHECKS / REPORT ----------
+def load_test_images(img_size, limit):
+    from tensorflow.keras.applications.efficientnet import preprocess_input
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    if not os.path.isdir(TEST_DIR):
+        return None, None
+    gen = ImageDataGenerator(preprocessing_function=preprocess_input).flow_from_directory(
+        TEST_DIR, target_size=(img_size, img_size), batch_size=32, class_mode="sparse", shuffle=False)
+    xs, ys = [], []
+    for i in range(len(gen)):
+        x, y = gen[i]
+        xs.append(x)
+        ys.append(y)
+        if limit and sum(len(b) for b in xs) >= limit:
+            break
+    x, y = np.concatenate(xs), np.concatenate(ys).astype(int)
+    return (x[:limit], y[:limit]) if limit else (x, y)
+
+
+def single_image_ms(model, x, repeats=30):
+    x = x[:1]
+    model.predict(x, verbose=0)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        model.predict(x, verbose=0)
+        times.append((time.perf_counter() - t0) * 1000)
+    return round(float(np.median(times)), 2)
+
+
+def weight_mb(model):
+    return round(sum(np.prod(w.shape) * w.dtype.size for w in model.weights) / 1e6, 2)
+
+
+def count_layers(model):
+    return sum(count_layers(l) if isinstance(l, tf.keras.Model) else 1 for l in model.layers)
+
+
+def explain_layers(model):
+    """Names of the layers Grad-CAM, CAM and the embedding index look up (None if not found)"""
+    from model_registry import find_cam_head, find_embedding_layer, find_last_conv_layer
+
+    conv = find_last_conv_layer(model)
+    dense = find_embedding_layer(model)
+    return {"last_conv": conv, "cam_head": find_cam_head(model, conv) is not None,
+            "embedding": dense.name if dense is not None else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--img-size", type=int, default=None, help="defaults to the model's input size")
+    parser.add_argument("--output", default=None, help="default <model>_inference.keras")
+    parser.add_argument("--atol", type=float, default=1e-3, help="max abs probability difference")
+    parser.add_argument("--limit", type=int, default=0, help="test images to check (0 = all)")
+    parser.add_argument("--force", action="store_true", help="write even if the equivalence check fails")
+    args = parser.parse_args()
+
+    from model_registry import detect_input_size
+
+    model = tf.keras.models.load_model(args.model)
+    img_size = args.img_size or detect_input_size(model)
+    optimized, stats = optimize(model, img_size)
+    print(f"removed {stats['removed']} training-only layers, folded {stats['folded']} BatchNorms")
+
+    x, y = load_test_images(img_size, args.limit)
+    if x is None:
+        print(f"Test directory {TEST_DIR} not found; checking on random inputs")
+        x = np.random.default_rng(0).uniform(0, 255, (16, img_size, img_size, 3)).astype(np.float32)
+
+    ref = model.predict(x, batch_size=32, verbose=0)
+    out = optimized.predict(x, batch_size=32, verbose=0)
+    max_diff = float(np.abs(ref - out).max())
+    agree = float((ref.argmax(1) == out.argmax(1)).mean()) * 100
+    layers_ok = explain_layers(optimized) == explain_layers(model)
+    ok = max_diff <= args.atol and layers_ok
+
+    report = {
+        "images_checked": int(len(x)),
+        "max_abs_diff": max_diff,
+        "top1_agreement": round(agree, 3),
+        "equivalent": ok,
+        "explain_layers": {"original": explain_layers(model), "optimized": explain_layers(optimized)},
+        "original": {"latency_ms": single_image_ms(model, x), "weights_mb": weight_mb(model),
+                     "layers": count_layers(model)},
+        "optimized": {"latency_ms": single_image_ms(optimized, x), "weights_mb": weight_mb(optimized),
+                      "layers": count_layers(optimized)},
+        **stats,
+    }
+    if y is not None:
+        report["original"]["accuracy"] = round(float((ref.argmax(1) == y).mean()) * 100, 2)
+        report["optimized"]["accuracy"] = round(float((out.argmax(1) == y).mean()) * 100, 2)
+    print(json.dumps(report, indent=2))
+
+    if not layers_ok and not args.force:
+        raise SystemExit("Explanation / embedding layers changed in the optimized model; not writing")
+    if not ok and not args.force:
+        raise SystemExit(f"Equivalence check failed (max diff {max_diff:.2e} > {args.atol}); not writing")
+
+    output = args.output or os.path.splitext(args.model)[0] + "_inference.keras"
+    optimized.save(output)
+    with open(os.path.splitext(output)[0] + "_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {output}")
+
+
+if __name__ == "__main__":
+    main()
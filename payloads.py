@@ -0,0 +1,99 @@
+"""
+Precomputed responses for reference data (disease info, doctor lists).
+
+A Payload is serialized once (orjson when installed, otherwise compact json)
+and compressed once (gzip, plus brotli when the `brotli` package is
+installed). Serving it is only header work: a matching If-None-Match gets a
+304, anything else gets the best variant the client accepts. Each encoding
+has its own strong ETag ("<sha256 prefix>", "<...>-gzip", "<...>-br"), since
+the bytes differ. Build a new Payload when the source data changes.
+"""
+import gzip
+import hashlib
+import json
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_BYTES = 256
+# preferred order when the client accepts several encodings equally
+ENCODINGS = ("br", "gzip", "identity")
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _accepted(header):
+    """{encoding: q} from an Accept-Encoding header"""
+    accepted = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+def _etags(header):
+    return {t.strip().removeprefix("W/") for t in header.split(",") if t.strip()}
+
+
+class Payload:
+    def __init__(self, obj, max_age=300):
+        body = dumps(obj)
+        tag = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {"identity": body}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            self.variants["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(body, quality=11)
+        self.etags = {enc: f'"{tag}"' if enc == "identity" else f'"{tag}-{enc}"' for enc in self.variants}
+        self.cache_control = f"public, max-age={max_age}"
+
+    def negotiate(self, accept_encoding):
+        accepted = _accepted(accept_encoding or "")
+        wildcard = accepted.get("*", 0.0)
+        best, best_q = "identity", 0.0
+        for enc in ENCODINGS:
+            if enc not in self.variants:
+                continue
+            q = accepted.get(enc, 1.0 if enc == "identity" else wildcard)
+            if q > best_q:
+                best, best_q = enc, q
+        return best
+
+    def response(self, request: Request):
+        encoding = self.negotiate(request.headers.get("accept-encoding"))
+        headers = {"ETag": self.etags[encoding], "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = _etags(if_none_match)
+            # any encoding of the same content is still valid for the client
+            if "*" in tags or tags & set(self.etags.values()):
+                return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(self.variants[encoding], media_type="application/json", headers=headers)
+
+    def sizes(self):
+        return {enc: len(body) for enc, body in self.variants.items()}
@@ -0,0 +1,52 @@
+"""
+CPU performance profile produced by autotune.py and applied by main.py at startup.
+
+The profile is a small JSON file:
+    {"intra_op_threads": 4, "inter_op_threads": 1, "workers": 2, "batch_size": 8, ...}
+"""
+import json
+import logging
+import os
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILE_PATH = os.environ.get("SKIN_PERF_PROFILE", os.path.join(BASE_DIR, "perf_profile.json"))
+
+
+def load_profile(path: str = PROFILE_PATH):
+    """Return the profile dict, or {} if no profile has been written yet"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        log.warning("Ignoring unreadable perf profile %s: %s", path, e)
+        return {}
+
+
+def save_profile(profile: dict, path: str = PROFILE_PATH):
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+
+
+def apply_threading(tf, profile: dict):
+    """
+    Set TensorFlow's thread pools from the profile.
+    Must run before the first op executes (i.e. before load_model).
+    """
+    intra = int(profile.get("intra_op_threads", 0) or 0)
+    inter = int(profile.get("inter_op_threads", 0) or 0)
+    try:
+        if intra:
+            tf.config.threading.set_intra_op_parallelism_threads(intra)
+        if inter:
+            tf.config.threading.set_inter_op_parallelism_threads(inter)
+    except RuntimeError as e:
+        # TF refuses once the runtime is initialized
+        log.warning("Could not apply thread settings: %s", e)
+        return False
+    if intra or inter:
+        log.info("Applied perf profile: intra_op=%s inter_op=%s", intra or "default", inter or "default")
+    return True
@@ -0,0 +1,448 @@
+"""
+Pluggable storage for prediction records.
+
+/predict, /history, /history/export, /dashboard and the re-scoring job all go
+through a PredictionStore. Two backends:
+
+  * MongoPredictionStore  - the existing `skin_lesion_db.predictions` collection
+  * SQLitePredictionStore - an embedded database file (WAL mode), for
+                            single-node deployments without MongoDB
+
+Records are plain dicts (patient_name, prediction, confidence, model_version,
+time, ...). Filters are backend-neutral dicts with the optional keys
+patient_name, prediction, model_version, since, until (compared against the
+stored time string) and has_original (records with a stored upload).
+
+PREDICTION_STORE selects the backend: "mongo", "sqlite" or "auto" (default:
+MongoDB if it answers a ping, otherwise SQLite). Move data between backends
+with:
+
+    python prediction_store.py migrate --source mongo --target sqlite
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STORE_BACKEND = os.environ.get("PREDICTION_STORE", "auto")
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://127.0.0.1:27017")
+MONGO_DB = "skin_lesion_db"
+MONGO_COLLECTION = "predictions"
+SQLITE_PATH = os.environ.get("SQLITE_PATH", os.path.join(BASE_DIR, "data", "predictions.db"))
+
+
+class PredictionStore(ABC):
+    backend = ""
+
+    @abstractmethod
+    def insert(self, record):
+        """Store one record (may be written asynchronously; see flush)"""
+
+    @abstractmethod
+    def insert_many(self, records):
+        ...
+
+    @abstractmethod
+    def find(self, filters=None, limit=0):
+        """Matching records, newest first, without backend ids"""
+
+    @abstractmethod
+    def scan(self, filters=None, after=None, limit=0, batch_size=5000):
+        """Matching records in insertion (id) order, each with a string "_id"; resumes after `after`"""
+
+    @abstractmethod
+    def set_field(self, path, updates):
+        """Set dotted `path` to value for each (id, value) in updates"""
+
+    @abstractmethod
+    def delete(self, ids):
+        ...
+
+    @abstractmethod
+    def count(self, filters=None):
+        ...
+
+    @abstractmethod
+    def parse_id(self, raw):
+        """Backend id for a string id; ValueError if malformed"""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# ---------- MONGO ----------
+class MongoPredictionStore(PredictionStore):
+    backend = "mongo"
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    @staticmethod
+    def _query(filters):
+        f = filters or {}
+        q = {k: f[k] for k in ("patient_name", "prediction", "model_version") if f.get(k)}
+        if f.get("since") or f.get("until"):
+            q["time"] = {}
+            if f.get("since"):
+                q["time"]["$gte"] = f["since"]
+            if f.get("until"):
+                q["time"]["$lt"] = f["until"]
+        if f.get("has_original"):
+            q["blobs.original"] = {"$exists": True, "$ne": None}
+        return q
+
+    def insert(self, record):
+        # insert_one adds _id to the dict it is given
+        self.collection.insert_one(dict(record))
+
+    def insert_many(self, records):
+        if records:
+            self.collection.insert_many([dict(r) for r in records], ordered=False)
+
+    def find(self, filters=None, limit=0):
+        cursor = self.collection.find(self._query(filters), {"_id": 0}).sort("time", -1)
+        if limit > 0:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    def scan(self, filters=None, after=None, limit=0, batch_size=5000):
+        q = self._query(filters)
+        if after:
+            q["_id"] = {"$gt": self.parse_id(after)}
+        cursor = self.collection.find(q).sort("_id", 1).batch_size(batch_size)
+        if limit > 0:
+            cursor = cursor.limit(limit)
+        for rec in cursor:
+            rec["_id"] = str(rec["_id"])
+            yield rec
+
+    def set_field(self, path, updates):
+        from pymongo import UpdateOne
+
+        ops = [UpdateOne({"_id": self.parse_id(i)}, {"$set": {path: v}}) for i, v in updates]
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+
+    def delete(self, ids):
+        ids = [self.parse_id(i) for i in ids]
+        return self.collection.delete_many({"_id": {"$in": ids}}).deleted_count if ids else 0
+
+    def count(self, filters=None):
+        return self.collection.count_documents(self._query(filters))
+
+    def parse_id(self, raw):
+        from bson import ObjectId
+        from bson.errors import InvalidId
+
+        try:
+            return ObjectId(raw)
+        except (InvalidId, TypeError) as e:
+            raise ValueError(f"Invalid record id: {raw}") from e
+
+
+# ---------- SQLITE ----------
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    prediction_id TEXT,
+    patient_name  TEXT,
+    prediction    TEXT,
+    confidence    REAL,
+    model_version TEXT,
+    time          TEXT,
+    original_blob TEXT,
+    doc           TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_predictions_time ON predictions(time);
+CREATE INDEX IF NOT EXISTS ix_predictions_patient ON predictions(patient_name, time);
+CREATE INDEX IF NOT EXISTS ix_predictions_prediction ON predictions(prediction, time);
+CREATE INDEX IF NOT EXISTS ix_predictions_model ON predictions(model_version, time);
+CREATE INDEX IF NOT EXISTS ix_predictions_pid ON predictions(prediction_id);
+CREATE INDEX IF NOT EXISTS ix_predictions_original ON predictions(id) WHERE original_blob IS NOT NULL;
+"""
+_COLUMNS = ("prediction_id", "patient_name", "prediction", "confidence", "model_version", "time", "original_blob")
+_INSERT = f"INSERT INTO predictions ({', '.join(_COLUMNS)}, doc) VALUES ({', '.join('?' * (len(_COLUMNS) + 1))})"
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _row(record):
+    record = {k: v for k, v in record.items() if k != "_id"}
+    blobs = record.get("blobs") or {}
+    return (
+        record.get("prediction_id"),
+        record.get("patient_name"),
+        record.get("prediction"),
+        _as_float(record.get("confidence")),
+        record.get("model_version"),
+        str(record["time"]) if record.get("time") is not None else None,
+        blobs.get("original"),
+        json.dumps(record, default=str),
+    )
+
+
+def _where(filters):
+    f = filters or {}
+    clauses, params = [], []
+    for col in ("patient_name", "prediction", "model_version"):
+        if f.get(col):
+            clauses.append(f"{col} = ?")
+            params.append(f[col])
+    if f.get("since"):
+        clauses.append("time >= ?")
+        params.append(f["since"])
+    if f.get("until"):
+        clauses.append("time < ?")
+        params.append(f["until"])
+    if f.get("has_original"):
+        clauses.append("original_blob IS NOT NULL")
+    return clauses, params
+
+
+class SQLitePredictionStore(PredictionStore):
+    """
+    Single writer thread with group commit: inserts are queued and everything
+    queued while the previous transaction was committing goes into the next
+    one, so throughput scales with load instead of paying one fsync per row.
+    Readers use their own per-thread connections (WAL lets them run alongside
+    the writer).
+    """
+    backend = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH, max_batch=1000):
+        self.path = path
+        self.max_batch = max_batch
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True, name="sqlite-writer")
+        self._writer.start()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ----- writes -----
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            records = [r for r in batch if r is not None]
+            try:
+                if records:
+                    self._insert_rows(records)
+            except Exception:
+                log.exception("SQLite write of %d records failed", len(records))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _insert_rows(self, records):
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.executemany(_INSERT, [_row(r) for r in records])
+
+    def insert(self, record):
+        self._queue.put(dict(record))
+
+    def insert_many(self, records):
+        if records:
+            self._insert_rows(records)
+
+    def flush(self):
+        """Block until every queued insert is committed"""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join(timeout=10)
+
+    def set_field(self, path, updates):
+        keys = path.split(".")
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                for rid, value in updates:
+                    row = conn.execute("SELECT doc FROM predictions WHERE id = ?", (self.parse_id(rid),)).fetchone()
+                    if row is None:
+                        continue
+                    doc = json.loads(row[0])
+                    node = doc
+                    for k in keys[:-1]:
+                        node = node.setdefault(k, {})
+                    node[keys[-1]] = value
+                    cols = _row(doc)
+                    conn.execute(f"UPDATE predictions SET {', '.join(c + ' = ?' for c in _COLUMNS)}, doc = ? "
+                                 "WHERE id = ?", cols + (self.parse_id(rid),))
+
+    def delete(self, ids):
+        ids = [self.parse_id(i) for i in ids]
+        deleted = 0
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    cur = conn.execute(f"DELETE FROM predictions WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+                    deleted += cur.rowcount
+        return deleted
+
+    # ----- reads -----
+    def find(self, filters=None, limit=0):
+        clauses, params = _where(filters)
+        sql = "SELECT doc FROM predictions"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY time DESC"
+        if limit > 0:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [json.loads(doc) for (doc,) in self._conn().execute(sql, params)]
+
+    def scan(self, filters=None, after=None, limit=0, batch_size=5000):
+        # keyset pagination: no long-lived read transaction, bounded memory
+        clauses, params = _where(filters)
+        last = self.parse_id(after) if after else 0
+        remaining = limit if limit > 0 else None
+        while remaining is None or remaining > 0:
+            page = batch_size if remaining is None else min(batch_size, remaining)
+            sql = "SELECT id, doc FROM predictions WHERE " + " AND ".join(clauses + ["id > ?"]) + \
+                  " ORDER BY id LIMIT ?"
+            rows = self._conn().execute(sql, params + [last, page]).fetchall()
+            if not rows:
+                return
+            for rid, doc in rows:
+                rec = json.loads(doc)
+                rec["_id"] = str(rid)
+                yield rec
+            last = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def count(self, filters=None):
+        clauses, params = _where(filters)
+        sql = "SELECT COUNT(*) FROM predictions" + (" WHERE " + " AND ".join(clauses) if clauses else "")
+        return self._conn().execute(sql, params).fetchone()[0]
+
+    def parse_id(self, raw):
+        try:
+            return int(raw)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid record id: {raw}") from e
+
+
+# ---------- FACTORY ----------
+def open_mongo(uri=MONGO_URI, ping=False):
+    from pymongo import MongoClient
+
+    client = MongoClient(uri, serverSelectionTimeoutMS=2000)
+    if ping:
+        client.admin.command("ping")
+    return MongoPredictionStore(client[MONGO_DB][MONGO_COLLECTION])
+
+
+def open_store(backend=None, sqlite_path=SQLITE_PATH, mongo_uri=MONGO_URI):
+    backend = (backend or STORE_BACKEND).lower()
+    if backend == "sqlite":
+        return SQLitePredictionStore(sqlite_path)
+    if backend == "mongo":
+        return open_mongo(mongo_uri)
+    try:
+        return open_mongo(mongo_uri, ping=True)
+    except Exception as e:
+        log.warning("MongoDB not reachable (%s); storing predictions in SQLite at %s", e, sqlite_path)
+        return SQLitePredictionStore(sqlite_path)
+
+
+def _migration_key(rec):
+    """Identity of a record across backends: prediction_id, or its contents for older records without one"""
+    if rec.get("prediction_id"):
+        return rec["prediction_id"]
+    return (rec.get("patient_name"), str(rec.get("time")), rec.get("prediction"), rec.get("model_version"))
+
+
+def migrate(source, target, batch_size=1000):
+    """
+    Copy records from source to target, skipping those the target already has,
+    so an interrupted migration can simply be run again. Returns (copied, skipped).
+    """
+    present = {_migration_key(rec) for rec in target.scan(batch_size=batch_size)}
+    copied, skipped, batch, t0 = 0, 0, [], time.perf_counter()
+    for rec in source.scan(batch_size=batch_size):
+        rec.pop("_id", None)
+        key = _migration_key(rec)
+        if key in present:
+            skipped += 1
+            continue
+        present.add(key)
+        batch.append(rec)
+        if len(batch) >= batch_size:
+            target.insert_many(batch)
+            copied += len(batch)
+            batch = []
+            print(f"{copied} records ({copied / (time.perf_counter() - t0):.0f}/s)", flush=True)
+    target.insert_many(batch)
+    copied += len(batch)
+    target.flush()
+    return copied, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    mig = sub.add_parser("migrate", help="copy all prediction records from one backend to another")
+    mig.add_argument("--source", choices=["mongo", "sqlite"], required=True)
+    mig.add_argument("--target", choices=["mongo", "sqlite"], required=True)
+    mig.add_argument("--sqlite-path", default=SQLITE_PATH)
+    mig.add_argument("--mongo-uri", default=MONGO_URI)
+    mig.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.source == args.target:
+        raise SystemExit("Source and target must differ")
+    source = open_store(args.source, args.sqlite_path, args.mongo_uri)
+    target = open_store(args.target, args.sqlite_path, args.mongo_uri)
+    before = target.count()
+    t0 = time.perf_counter()
+    copied, skipped = migrate(source, target, args.batch_size)
+    print(f"copied {copied} records in {time.perf_counter() - t0:.1f}s, skipped {skipped} already present; "
+          f"target now has {target.count()} (had {before})")
+    # backend ids are not carried over
+    print("Record ids differ between backends: start re-scoring jobs with restart=true and /history/export "
+          "cursors from scratch")
+    target.close()
+
+
+if __name__ == "__main__":
+    main()
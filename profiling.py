@@ -0,0 +1,228 @@
+"""
+On-demand request profiling.
+
+An operator arms the profiler for the next N requests (POST /admin/profile)
+or profiles a single request with `X-Profile: 1`; both need the
+`X-Admin-Token` header to match the ADMIN_TOKEN environment variable.
+
+For each profiled request a background thread samples Python stacks with
+sys._current_frames() and writes them in collapsed ("folded") form, ready for
+flamegraph.pl or speedscope. Only the request's own threads are sampled: the
+event-loop thread handling it, the worker thread of a sync endpoint (routes use
+TracedRoute) and scheduler lanes while they run its model work (traced()).
+Other requests and background threads do not show up. Optionally a TensorFlow profiler trace of the
+request (model forward + Grad-CAM) is captured for TensorBoard.
+
+When nothing is armed the per-request cost is one header lookup and an
+integer check.
+"""
+import collections
+import contextvars
+import functools
+import hmac
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+from fastapi.routing import APIRoute
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(BASE_DIR, "cache", "profiles"))
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+# sampler of the profiled request, seen by everything running in its context
+_active_sampler = contextvars.ContextVar("active_sampler", default=None)
+
+
+def is_admin(token: str) -> bool:
+    """Admin features are disabled unless ADMIN_TOKEN is set"""
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token or "", ADMIN_TOKEN)
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the Python stacks of the threads in `threads` (a set that may change
+    while sampling) at a fixed interval; threads=None samples every other thread.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, threads=None):
+        super().__init__(daemon=True, name="stack-sampler")
+        self.interval = interval
+        self.threads = threads
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._halt = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        while not self._halt.is_set():
+            for tid, frame in sys._current_frames().items():
+                if tid == me or (self.threads is not None and tid not in self.threads):
+                    continue
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if tid not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                parts.append(names.get(tid, str(tid)))
+                self.stacks[";".join(reversed(parts))] += 1
+            self.samples += 1
+            self._halt.wait(self.interval)
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+        return self.stacks
+
+
+def traced(fn, *args, **kwargs):
+    """fn(*args, **kwargs), with this thread sampled meanwhile if the calling request is profiled"""
+    sampler = _active_sampler.get()
+    if sampler is None:
+        return fn(*args, **kwargs)
+    tid = threading.get_ident()
+    added = tid not in sampler.threads
+    sampler.threads.add(tid)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        if added:
+            sampler.threads.discard(tid)
+
+
+class TracedRoute(APIRoute):
+    """APIRoute whose sync endpoints run through traced(), so their worker thread is profiled"""
+
+    def __init__(self, path, endpoint, **kwargs):
+        if not inspect.iscoroutinefunction(endpoint):
+            endpoint = _traced_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+def _traced_endpoint(endpoint):
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        return traced(endpoint, *args, **kwargs)
+    return wrapper
+
+
+class ProfileController:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # one profiled request at a time so stacks and TF traces are not mixed
+        self._busy = threading.Lock()
+        self.remaining = 0
+        self.tf_trace = False
+
+    def arm(self, count: int, tf_trace: bool = False):
+        with self._lock:
+            self.remaining = max(0, int(count))
+            self.tf_trace = bool(tf_trace)
+        log.info("Profiler armed for %d request(s) (tf_trace=%s)", self.remaining, self.tf_trace)
+
+    def status(self):
+        files = sorted(os.listdir(PROFILE_DIR)) if os.path.isdir(PROFILE_DIR) else []
+        return {"remaining": self.remaining, "tf_trace": self.tf_trace, "dir": PROFILE_DIR, "files": files}
+
+    def claim(self, headers):
+        """
+        Decide whether this request is profiled.
+        Returns None (the common, zero-cost path) or the tf_trace flag.
+        """
+        forced = headers.get("x-profile")
+        if not self.remaining and not forced:
+            return None
+        if forced and not is_admin(headers.get("x-admin-token", "")):
+            return None
+        if not self._busy.acquire(blocking=False):
+            return None
+        if forced:
+            return headers.get("x-profile-tf") == "1"
+        with self._lock:
+            if self.remaining > 0:
+                self.remaining -= 1
+                return self.tf_trace
+        self._busy.release()
+        return None
+
+    def start(self, tf_trace: bool, request_id: str):
+        """Begin a session; caller must already hold the claim, which is released if this fails."""
+        session = {"id": request_id, "t0": time.perf_counter(), "tf_dir": None}
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            if tf_trace:
+                try:
+                    import tensorflow as tf
+                    session["tf_dir"] = os.path.join(PROFILE_DIR, f"{request_id}_tf")
+                    tf.profiler.experimental.start(session["tf_dir"])
+                except Exception as e:
+                    log.warning("TF profiler unavailable: %s", e)
+                    session["tf_dir"] = None
+            # the thread running the middleware (the event loop); traced() adds the others
+            session["sampler"] = StackSampler(threads={threading.get_ident()})
+            session["token"] = _active_sampler.set(session["sampler"])
+            session["sampler"].start()
+        except BaseException:
+            if "token" in session:
+                _active_sampler.reset(session["token"])
+            if session["tf_dir"]:
+                try:
+                    import tensorflow as tf
+                    tf.profiler.experimental.stop()
+                except Exception:
+                    pass
+            self._busy.release()
+            raise
+        return session
+
+    def finish(self, session, path: str, status_code: int):
+        try:
+            _active_sampler.reset(session["token"])
+            stacks = session["sampler"].stop()
+            elapsed = time.perf_counter() - session["t0"]
+            if session["tf_dir"]:
+                try:
+                    import tensorflow as tf
+                    tf.profiler.experimental.stop()
+                except Exception as e:
+                    log.warning("Stopping TF profiler failed: %s", e)
+
+            base = os.path.join(PROFILE_DIR, session["id"])
+            with open(base + ".folded", "w") as f:
+                for stack, n in stacks.most_common():
+                    f.write(f"{stack} {n}\n")
+            with open(base + ".json", "w") as f:
+                json.dump({
+                    "request_id": session["id"],
+                    "path": path,
+                    "status": status_code,
+                    "duration_ms": round(elapsed * 1000, 1),
+                    "samples": session["sampler"].samples,
+                    "interval_s": session["sampler"].interval,
+                    "threads": "request",
+                    "tf_trace_dir": session["tf_dir"],
+                }, f, indent=2)
+            log.info("Profile %s written (%.1f ms, %s)", session["id"], elapsed * 1000, path)
+        finally:
+            self._busy.release()
+
+
+def new_request_id(headers):
+    rid = headers.get("x-request-id", "")
+    # keep ids filesystem-safe
+    rid = "".join(c for c in rid if c.isalnum() or c in "-_")[:64]
+    return rid or uuid.uuid4().hex
+
+
+PROFILER = ProfileController()
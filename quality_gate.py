@@ -0,0 +1,111 @@
+"""
+Cheap image-quality / out-of-scope gate, run before model inference.
+
+Works on a small downscaled copy of the upload with OpenCV/numpy only (no
+TensorFlow), so a rejected photo costs a few milliseconds instead of a full
+forward pass and Grad-CAM. Checks, in order:
+
+  * resolution:  shorter side of the original upload below `min_side`
+  * exposure:    mean brightness outside [dark_max, bright_min], or too many
+                 clipped pixels
+  * blur:        variance of the Laplacian below `blur_min`
+  * not_skin:    fraction of skin-coloured pixels (YCrCb box) below `skin_min`
+
+Thresholds live in quality_gate.json (QUALITY_GATE_CONFIG); missing keys use
+DEFAULTS. The gate is off by default, since the thresholds have not been
+validated on this dataset: set "enabled": true there to turn it on, or pass
+check_quality per request.
+"""
+import json
+import logging
+import os
+
+import cv2
+import numpy as np
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+QUALITY_GATE_CONFIG = os.environ.get("QUALITY_GATE_CONFIG", os.path.join(BASE_DIR, "quality_gate.json"))
+
+DEFAULTS = {
+    "enabled": False,
+    "analysis_size": 256,    # longer side of the copy the checks run on
+    "min_side": 128,         # px, on the original upload
+    "dark_max": 40,          # mean gray level below this is underexposed
+    "bright_min": 220,       # mean gray level above this is overexposed
+    "clipped_max": 0.5,      # max fraction of pixels at 0..5 or 250..255
+    "blur_min": 20.0,        # Laplacian variance on the analysis copy
+    "skin_min": 0.10,        # min fraction of skin-coloured pixels
+}
+
+MESSAGES = {
+    "resolution": "Image resolution is too low. Please upload a photo at least {min_side}px on the shorter side.",
+    "underexposed": "Image is too dark. Retake the photo in better light.",
+    "overexposed": "Image is overexposed. Avoid direct flash or strong light on the skin and retake the photo.",
+    "blur": "Image is too blurry. Hold the camera steady, focus on the lesion and retake the photo.",
+    "not_skin": "This does not look like a photo of skin. Please upload a close-up of the lesion.",
+}
+
+
+def load_config(path=QUALITY_GATE_CONFIG):
+    cfg = dict(DEFAULTS)
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                cfg.update(json.load(f))
+        except Exception as e:
+            log.warning("Ignoring unreadable quality gate config %s: %s", path, e)
+    return cfg
+
+
+def _downscale(rgb: np.ndarray, size: int):
+    h, w = rgb.shape[:2]
+    scale = size / max(h, w)
+    if scale >= 1:
+        return rgb
+    return cv2.resize(rgb, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def measure(pil_image, cfg=None):
+    """Quality measurements of a PIL RGB image (computed on a downscaled copy)"""
+    cfg = cfg or DEFAULTS
+    width, height = pil_image.size
+    rgb = _downscale(np.asarray(pil_image), int(cfg["analysis_size"]))
+    gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+    ycrcb = cv2.cvtColor(rgb, cv2.COLOR_RGB2YCrCb)
+    cr, cb = ycrcb[..., 1], ycrcb[..., 2]
+    skin = (cr >= 133) & (cr <= 173) & (cb >= 77) & (cb <= 127)
+    return {
+        "width": width,
+        "height": height,
+        "brightness": round(float(gray.mean()), 2),
+        "clipped": round(float(((gray <= 5) | (gray >= 250)).mean()), 4),
+        "sharpness": round(float(cv2.Laplacian(gray, cv2.CV_64F).var()), 2),
+        "skin_fraction": round(float(skin.mean()), 4),
+    }
+
+
+def rejection_reason(m, cfg):
+    """First failed check for measurements `m`, or None if the image passes"""
+    if min(m["width"], m["height"]) < cfg["min_side"]:
+        return "resolution"
+    if m["brightness"] < cfg["dark_max"]:
+        return "underexposed"
+    if m["brightness"] > cfg["bright_min"]:
+        return "overexposed"
+    if m["clipped"] > cfg["clipped_max"]:
+        return "underexposed" if m["brightness"] < 128 else "overexposed"
+    if m["sharpness"] < cfg["blur_min"]:
+        return "blur"
+    if m["skin_fraction"] < cfg["skin_min"]:
+        return "not_skin"
+    return None
+
+
+def check(pil_image, cfg):
+    """Return (reason, message, measurements); reason is None when the image is accepted"""
+    m = measure(pil_image, cfg)
+    reason = rejection_reason(m, cfg)
+    message = MESSAGES[reason].format(**cfg) if reason else None
+    return reason, message, m
@@ -0,0 +1,190 @@
+"""
+Resumable bulk re-scoring of stored cases with another model version.
+
+Walks the prediction records that have a stored original image (see
+blob_store.py) in id order, CHUNK records at a time. Images of the next
+chunk are read and decoded on a thread pool while the current chunk is being
+scored in large batches. Results are written next to the original prediction,
+tagged with the model version:
+
+    record["rescored"]["<version>"] = {"prediction", "class_code", "confidence", "time"}
+
+After each chunk, the last processed record id is checkpointed to
+cache/rescore/<version>.json, so a restarted job continues from there. Writes
+are idempotent field updates, so a chunk replayed after a crash is harmless.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+import metrics
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CHECKPOINT_DIR = os.path.join(BASE_DIR, "cache", "rescore")
+CHUNK = 512
+
+RESCORED = metrics.REGISTRY.counter("skin_rescore_images_total", "Images re-scored by bulk jobs")
+RESCORE_RATE = metrics.REGISTRY.gauge("skin_rescore_images_per_second", "Throughput of the running re-scoring job")
+
+
+def version_field(version):
+    """Version as a single field name (no dots, no leading $), valid for every store backend"""
+    return version.replace(".", "_").lstrip("$")
+
+
+class RescoreJob:
+    def __init__(self, store, blobs, mv, prepare, class_info, batch_size=64, chunk=CHUNK, decode_workers=4,
+                 scheduler=None):
+        """
+        prepare(image_bytes, img_size) -> preprocessed (H, W, 3) array
+        class_info(probs, class_names) -> (class_code, confidence_percent, disease_info)
+        scheduler: optional InferenceScheduler; model calls then run as "batch" work,
+        one batch_size slice at a time
+        """
+        self.store = store
+        self.blobs = blobs
+        self.mv = mv
+        self.prepare = prepare
+        self.class_info = class_info
+        self.batch_size = batch_size
+        self.chunk = chunk
+        self.decode_workers = decode_workers
+        self.scheduler = scheduler
+        self.checkpoint_path = os.path.join(CHECKPOINT_DIR, f"{version_field(mv.name)}.json")
+        self._stop = threading.Event()
+        self._thread = None
+        self.state = self._load_checkpoint()
+
+    # ----- checkpoint -----
+    def _load_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            try:
+                with open(self.checkpoint_path, "r") as f:
+                    return json.load(f)
+            except Exception as e:
+                log.warning("Ignoring unreadable rescore checkpoint %s: %s", self.checkpoint_path, e)
+        return {"version": self.mv.name, "last_id": None, "done": 0, "failed": 0, "status": "new",
+                "started_at": None, "updated_at": None, "images_per_second": None}
+
+    def _save_checkpoint(self):
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        self.state["updated_at"] = datetime.now().isoformat(timespec="seconds")
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.checkpoint_path)
+
+    def reset(self):
+        """Forget the checkpoint and start from the first record"""
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        self.state = self._load_checkpoint()
+
+    # ----- control -----
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run_safe, daemon=True, name=f"rescore-{self.mv.name}")
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self):
+        return dict(self.state, running=self.running)
+
+    # ----- work -----
+    def _chunks(self):
+        """Record chunks after the checkpointed id, in id order"""
+        last_id = self.state["last_id"]
+        while True:
+            recs = list(self.store.scan({"has_original": True}, after=last_id, limit=self.chunk))
+            if not recs:
+                return
+            last_id = recs[-1]["_id"]
+            yield recs
+
+    def _decode(self, rec):
+        try:
+            return self.prepare(self.blobs.get(rec["blobs"]["original"]), self.mv.img_size)
+        except Exception as e:
+            log.warning("Rescore: cannot read image of %s: %s", rec["_id"], e)
+            return None
+
+    def _predict(self, batch):
+        if self.scheduler is None:
+            return np.asarray(self.mv.model.predict(batch, batch_size=self.batch_size, verbose=0))
+        return np.concatenate(self.scheduler.map_chunks(
+            "batch", lambda b: np.asarray(self.mv.model.predict(b, verbose=0)), batch, self.batch_size))
+
+    def _score(self, recs, arrays):
+        ok = [i for i, a in enumerate(arrays) if a is not None]
+        updates = []
+        if ok:
+            probs = self._predict(np.stack([arrays[i] for i in ok]))
+            now = str(datetime.now())
+            for p, i in zip(probs, ok):
+                code, confidence, info = self.class_info(p, self.mv.class_names)
+                updates.append((recs[i]["_id"], {"prediction": info["name"], "class_code": code,
+                                                 "confidence": round(confidence, 2), "time": now}))
+        if updates:
+            self.store.set_field(f"rescored.{version_field(self.mv.name)}", updates)
+        return len(ok), len(recs) - len(ok)
+
+    def _run_safe(self):
+        try:
+            self.run()
+        except Exception as e:
+            log.exception("Rescore job for %s failed", self.mv.name)
+            self.state["status"] = f"failed: {e}"
+            self._save_checkpoint()
+
+    def run(self):
+        self.state["status"] = "running"
+        self.state["started_at"] = self.state["started_at"] or datetime.now().isoformat(timespec="seconds")
+        t_start, done_at_start = time.perf_counter(), self.state["done"]
+        log.info("Rescoring with %s from checkpoint %s", self.mv.name, self.state["last_id"])
+
+        with ThreadPoolExecutor(self.decode_workers, thread_name_prefix="rescore-decode") as pool:
+            chunks = self._chunks()
+            current = next(chunks, None)
+            pending = pool.map(self._decode, current) if current else None
+            while current is not None and not self._stop.is_set():
+                arrays = list(pending)
+                # decode the next chunk while this one is on the model
+                upcoming = next(chunks, None)
+                pending = pool.map(self._decode, upcoming) if upcoming else None
+
+                with metrics.timed("rescore", "chunk"):
+                    scored, failed = self._score(current, arrays)
+                self.state["done"] += scored
+                self.state["failed"] += failed
+                self.state["last_id"] = str(current[-1]["_id"])
+                RESCORED.inc(scored, version=self.mv.name)
+
+                rate = (self.state["done"] - done_at_start) / max(time.perf_counter() - t_start, 1e-9)
+                self.state["images_per_second"] = round(rate, 1)
+                RESCORE_RATE.set(rate)
+                self._save_checkpoint()
+                log.info("Rescore %s: %d done, %d failed, %.1f img/s",
+                         self.mv.name, self.state["done"], self.state["failed"], rate)
+                current = upcoming
+
+        self.state["status"] = "stopped" if self._stop.is_set() else "completed"
+        RESCORE_RATE.set(0)
+        self._save_checkpoint()
+        log.info("Rescore %s %s: %d images", self.mv.name, self.state["status"], self.state["done"])
@@ -0,0 +1,293 @@
+"""
+Retention for the prediction store: purge junk, archive old records.
+
+One run:
+  1. purges malformed / test records: no predicted class, a confidence that
+     is not a number in 0..100, or leftovers such as the "Local MongoDB
+     connected" row written by backend/db.py;
+  2. moves records older than RETENTION_DAYS to zstd-compressed Parquet files
+     partitioned by month (ARCHIVE_DIR/year=YYYY/month=MM/part-*.parquet)
+     and deletes them from the hot store, batch by batch;
+  3. folds every archived batch into ARCHIVE_DIR/rollups.json (class counts,
+     confidence histogram, max confidence), which /dashboard adds to the hot
+     records so its totals and charts do not change after compaction.
+
+Each batch is written to Parquet before it is deleted from the store. Every
+archived row keeps its record_id, so a batch archived twice after a crash can
+be de-duplicated, and `rebuild-rollups` recomputes the rollups from the
+archive files.
+
+Blobs stay where they are: an archived row's `doc` still names its blob keys,
+and `blob_store.py gc` counts those (archived_docs) as references, so images
+of archived cases remain readable and can be re-scored.
+
+    python retention.py run --days 365 --dry-run
+    python retention.py run
+    python retention.py query --since 2023-01 --until 2023-07 --prediction Melanoma --csv out.csv
+    python retention.py rebuild-rollups
+
+Needs pyarrow for archiving and querying.
+"""
+import argparse
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+
+log = logging.getLogger("skin-api")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", os.path.join(BASE_DIR, "data", "archive"))
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", "365"))
+BATCH = 5000
+
+# fixed 10-point confidence bins so hot and archived histograms can be added
+CONFIDENCE_BINS = np.linspace(0, 100, 11)
+TEST_MARKERS = ("result", "user", "model")
+COLUMNS = ("record_id", "prediction_id", "patient_name", "prediction", "confidence", "model_version", "time",
+           "doc")
+
+
+# ---------- RULES ----------
+def junk_reason(rec):
+    """Why a record is junk, or None if it is a usable prediction"""
+    if not str(rec.get("prediction") or "").strip():
+        return "test_record" if any(k in rec for k in TEST_MARKERS) else "no_prediction"
+    try:
+        confidence = float(rec.get("confidence"))
+    except (TypeError, ValueError):
+        return "bad_confidence"
+    if not 0 <= confidence <= 100:
+        return "bad_confidence"
+    return None
+
+
+def cutoff_for(days, now=None):
+    """Stored times are str(datetime), so string comparison orders them"""
+    return ((now or datetime.now()) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# ---------- ROLLUPS ----------
+def empty_rollups():
+    return {"total": 0, "prediction_counts": {}, "confidence_hist": [0] * (len(CONFIDENCE_BINS) - 1),
+            "max_confidence": None, "oldest": None, "newest": None, "updated_at": None}
+
+
+def load_rollups(archive_dir=ARCHIVE_DIR):
+    path = os.path.join(archive_dir, "rollups.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_rollups(rollups, archive_dir=ARCHIVE_DIR):
+    os.makedirs(archive_dir, exist_ok=True)
+    rollups["updated_at"] = datetime.now().isoformat(timespec="seconds")
+    path = os.path.join(archive_dir, "rollups.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(rollups, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def confidence_histogram(values):
+    return np.histogram(np.clip(np.asarray(values, dtype=float), 0, 100), bins=CONFIDENCE_BINS)[0]
+
+
+def add_to_rollups(rollups, predictions, confidences, times):
+    rollups["total"] += len(predictions)
+    counts = rollups["prediction_counts"]
+    for p in predictions:
+        counts[p] = counts.get(p, 0) + 1
+    rollups["confidence_hist"] = (np.asarray(rollups["confidence_hist"]) + confidence_histogram(confidences)).tolist()
+    if len(confidences):
+        top = float(np.max(confidences))
+        rollups["max_confidence"] = top if rollups["max_confidence"] is None else max(rollups["max_confidence"], top)
+    if times:
+        rollups["oldest"] = min([t for t in (rollups["oldest"], min(times)) if t])
+        rollups["newest"] = max([t for t in (rollups["newest"], max(times)) if t])
+    return rollups
+
+
+# ---------- ARCHIVE ----------
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Archiving needs pyarrow (pip install pyarrow)")
+    return pa, pq
+
+
+def _schema(pa):
+    return pa.schema([(c, pa.float64() if c == "confidence" else pa.string()) for c in COLUMNS])
+
+
+def write_archive(records, archive_dir, run_id):
+    """Write records to month partitions; returns the files written"""
+    pa, pq = _pyarrow()
+    by_month = {}
+    for rec in records:
+        t = str(rec.get("time"))
+        by_month.setdefault((t[:4], t[5:7]), []).append(rec)
+    files = []
+    for (year, month), recs in by_month.items():
+        part_dir = os.path.join(archive_dir, f"year={year}", f"month={month}")
+        os.makedirs(part_dir, exist_ok=True)
+        path = os.path.join(part_dir, f"part-{run_id}-{uuid.uuid4().hex[:8]}.parquet")
+        table = pa.table({
+            "record_id": [str(r["_id"]) for r in recs],
+            "prediction_id": [r.get("prediction_id") for r in recs],
+            "patient_name": [r.get("patient_name") for r in recs],
+            "prediction": [r.get("prediction") for r in recs],
+            "confidence": [float(r["confidence"]) for r in recs],
+            "model_version": [r.get("model_version") for r in recs],
+            "time": [str(r.get("time")) for r in recs],
+            "doc": [json.dumps({k: v for k, v in r.items() if k != "_id"}, default=str) for r in recs],
+        }, schema=_schema(pa))
+        pq.write_table(table, path + ".tmp", compression="zstd")
+        os.replace(path + ".tmp", path)
+        files.append(path)
+    return files
+
+
+def purge_junk(store, dry_run=False):
+    """Delete malformed/test records; returns {reason: count}"""
+    reasons, ids = {}, []
+    for rec in store.scan():
+        reason = junk_reason(rec)
+        if reason:
+            reasons[reason] = reasons.get(reason, 0) + 1
+            ids.append(rec["_id"])
+    if ids and not dry_run:
+        for i in range(0, len(ids), BATCH):
+            store.delete(ids[i:i + BATCH])
+    return reasons
+
+
+def archive_old(store, days, archive_dir=ARCHIVE_DIR, dry_run=False):
+    """Archive and prune records older than `days`; returns (archived, files)"""
+    cutoff = cutoff_for(days)
+    if dry_run:
+        return store.count({"until": cutoff}), []
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    archived, files, after = 0, [], None
+    while True:
+        batch = list(store.scan({"until": cutoff}, after=after, limit=BATCH))
+        if not batch:
+            break
+        after = batch[-1]["_id"]
+        # junk that arrived after the purge is dropped, not archived
+        keep = [r for r in batch if junk_reason(r) is None]
+        files += write_archive(keep, archive_dir, run_id)
+        store.delete([r["_id"] for r in batch])
+        rollups = load_rollups(archive_dir) or empty_rollups()
+        save_rollups(add_to_rollups(rollups, [r["prediction"] for r in keep],
+                                    [float(r["confidence"]) for r in keep],
+                                    [str(r["time"]) for r in keep]), archive_dir)
+        archived += len(keep)
+        log.info("Archived %d records older than %s", archived, cutoff)
+    return archived, files
+
+
+def run(store, days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR, dry_run=False):
+    """Purge junk, then archive; returns a report dict"""
+    started = datetime.now()
+    purged = purge_junk(store, dry_run)
+    archived, files = archive_old(store, days, archive_dir, dry_run)
+    store.flush()
+    return {
+        "dry_run": dry_run,
+        "cutoff": cutoff_for(days, started),
+        "purged": purged,
+        "archived": archived,
+        "files": len(files),
+        "hot_records": store.count(),
+        "seconds": round((datetime.now() - started).total_seconds(), 1),
+    }
+
+
+# ---------- OFFLINE QUERIES ----------
+def open_archive(archive_dir=ARCHIVE_DIR):
+    import pyarrow.dataset as ds
+
+    return ds.dataset(archive_dir, format="parquet", partitioning="hive", exclude_invalid_files=True)
+
+
+def query(archive_dir=ARCHIVE_DIR, since="", until="", prediction="", patient_name=""):
+    """Archived rows matching the filters as a pyarrow Table (duplicates by record_id removed)"""
+    import pyarrow.dataset as ds
+
+    expr = None
+    for cond in (
+        ds.field("time") >= since if since else None,
+        ds.field("time") < until if until else None,
+        ds.field("prediction") == prediction if prediction else None,
+        ds.field("patient_name") == patient_name if patient_name else None,
+    ):
+        if cond is not None:
+            expr = cond if expr is None else expr & cond
+    table = open_archive(archive_dir).to_table(columns=list(COLUMNS), filter=expr)
+    _, first = np.unique(table.column("record_id").to_numpy(zero_copy_only=False), return_index=True)
+    return table.take(np.sort(first)) if len(first) < len(table) else table
+
+
+def archived_docs(archive_dir=ARCHIVE_DIR):
+    """Every archived record as a dict (from the `doc` column); nothing if there is no archive yet"""
+    if not os.path.isdir(archive_dir):
+        return
+    _pyarrow()
+    for batch in open_archive(archive_dir).to_batches(columns=["doc"]):
+        for doc in batch.column(0).to_pylist():
+            if doc:
+                yield json.loads(doc)
+
+
+def rebuild_rollups(archive_dir=ARCHIVE_DIR):
+    table = query(archive_dir)
+    rollups = add_to_rollups(empty_rollups(), table.column("prediction").to_pylist(),
+                             table.column("confidence").to_numpy(), table.column("time").to_pylist())
+    save_rollups(rollups, archive_dir)
+    return rollups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    r = sub.add_parser("run", help="purge junk and archive old records")
+    r.add_argument("--days", type=int, default=RETENTION_DAYS)
+    r.add_argument("--dry-run", action="store_true")
+    r.add_argument("--store", choices=["auto", "mongo", "sqlite"], default=None)
+    q = sub.add_parser("query", help="read archived records")
+    q.add_argument("--since", default="")
+    q.add_argument("--until", default="")
+    q.add_argument("--prediction", default="")
+    q.add_argument("--patient-name", default="")
+    q.add_argument("--csv", default=None, help="write matching rows here")
+    sub.add_parser("rebuild-rollups", help="recompute rollups.json from the archive files")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        from prediction_store import open_store
+
+        store = open_store(args.store)
+        print(json.dumps(run(store, args.days, dry_run=args.dry_run), indent=2))
+        store.close()
+    elif args.command == "query":
+        table = query(since=args.since, until=args.until, prediction=args.prediction,
+                      patient_name=args.patient_name)
+        print(f"{table.num_rows} archived records")
+        if args.csv:
+            import pyarrow.csv as pcsv
+
+            pcsv.write_csv(table.drop(["doc"]), args.csv)
+            print(f"wrote {args.csv}")
+    else:
+        print(json.dumps(rebuild_rollups(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
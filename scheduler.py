@@ -0,0 +1,233 @@
+"""
+Priority scheduler for model work.
+
+Every model call goes through a small number of lanes (SCHED_WORKERS threads,
+one by default: TensorFlow already spreads one call over all intra-op
+threads). Queued work is taken strictly by class:
+
+    interactive  /predict
+    batch        /predict/batch, bulk re-scoring, shadow scoring
+    evaluation   /evaluation, /evaluation/cascade
+
+Large jobs submit one chunk at a time (map_chunks), so an upload waits for at
+most the chunk in progress, never the whole job. A running chunk is not
+interrupted.
+
+Work may carry a deadlines.Deadline: when it reaches the front of the queue
+after its request died (deadline passed or client gone) it is dropped with
+DeadlineExceeded instead of run.
+
+Each class can be capped to a share of lane time over the last
+SCHED_WINDOW_SECONDS, e.g. SCHED_SHARES="batch=0.6,evaluation=0.3". No class
+is capped by default. A capped class over its share is held back even when the
+lane is idle, leaving headroom for bursts of interactive work. Queue depth, wait
+time, busy time and the current share of every class are exported as
+skin_sched_* metrics.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import deadlines
+import metrics
+import profiling
+
+log = logging.getLogger("skin-api")
+
+CLASSES = ("interactive", "batch", "evaluation")
+DEFAULT_SHARES = "interactive=1.0,batch=1.0,evaluation=1.0"
+SCHED_WORKERS = int(os.environ.get("SCHED_WORKERS", "1"))
+SCHED_WINDOW_SECONDS = float(os.environ.get("SCHED_WINDOW_SECONDS", "10"))
+SCHED_SHARES = os.environ.get("SCHED_SHARES", DEFAULT_SHARES)
+
+QUEUED = metrics.REGISTRY.gauge("skin_sched_queue_depth", "Model work items waiting, by class")
+WAIT_SECONDS = metrics.REGISTRY.histogram("skin_sched_wait_seconds", "Time from submit to start, by class")
+BUSY_SECONDS = metrics.REGISTRY.counter("skin_sched_busy_seconds_total", "Lane time spent, by class")
+SHARE = metrics.REGISTRY.gauge("skin_sched_cpu_share", "Share of lane time over the window, by class")
+SHARE_LIMIT = metrics.REGISTRY.gauge("skin_sched_cpu_share_limit", "Configured share limit, by class")
+THROTTLED = metrics.REGISTRY.counter("skin_sched_throttled_total", "Jobs held back by their class's share limit")
+
+
+def parse_shares(spec):
+    """{class: limit} from "batch=0.6,evaluation=0.3"; unnamed classes get 1.0"""
+    shares = dict.fromkeys(CLASSES, 1.0)
+    for part in (spec or "").split(","):
+        name, _, value = part.partition("=")
+        name = name.strip()
+        if not name:
+            continue
+        if name not in shares:
+            raise ValueError(f"Unknown scheduling class: {name}")
+        shares[name] = min(1.0, max(0.0, float(value)))
+    # interactive work is never throttled
+    shares["interactive"] = 1.0
+    return shares
+
+
+def _fn_key(fn):
+    return getattr(fn, "__qualname__", None) or repr(fn)
+
+
+class _Job:
+    __slots__ = ("cls", "fn", "args", "kwargs", "deadline", "future", "context", "enqueued", "throttled")
+
+    def __init__(self, cls, fn, args, kwargs, deadline=None):
+        self.cls = cls
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.deadline = deadline
+        self.future = Future()
+        # stage timers inside fn still land in the submitting request's Server-Timing
+        self.context = contextvars.copy_context()
+        self.enqueued = time.perf_counter()
+        # set the first time the share limit holds it back, so it is counted once
+        self.throttled = False
+
+
+class InferenceScheduler:
+    def __init__(self, workers=SCHED_WORKERS, shares=SCHED_SHARES, window=SCHED_WINDOW_SECONDS):
+        self.workers = max(1, int(workers))
+        self.window = float(window)
+        self.shares = parse_shares(shares) if isinstance(shares, str) else dict(parse_shares(""), **shares)
+        self._queues = {cls: deque() for cls in CLASSES}
+        # (start, end) of recent work per class; end is None while running
+        self._spans = {cls: deque() for cls in CLASSES}
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        # recent mean run time per function, for the saved-compute estimate
+        self._run_seconds = {}
+        for cls, limit in self.shares.items():
+            SHARE_LIMIT.set(limit, **{"class": cls})
+        self._threads = [threading.Thread(target=self._lane, name=f"sched-{i}", daemon=True)
+                         for i in range(self.workers)]
+        for t in self._threads:
+            t.start()
+        metrics.REGISTRY.add_collector(self._export_shares)
+
+    # ----- submitting -----
+    def submit(self, cls, fn, *args, deadline=None, **kwargs) -> Future:
+        if cls not in self._queues:
+            raise ValueError(f"Unknown scheduling class: {cls}")
+        job = _Job(cls, fn, args, kwargs, deadline)
+        with self._cond:
+            self._queues[cls].append(job)
+            QUEUED.inc(**{"class": cls})
+            self._cond.notify()
+        return job.future
+
+    def run(self, cls, fn, *args, deadline=None, **kwargs):
+        """Blocking submit; runs inline when already on a lane (nested calls would deadlock)"""
+        if getattr(self._local, "on_lane", False):
+            return fn(*args, **kwargs)
+        return self.submit(cls, fn, *args, deadline=deadline, **kwargs).result()
+
+    async def run_async(self, cls, fn, *args, deadline=None, **kwargs):
+        return await asyncio.wrap_future(self.submit(cls, fn, *args, deadline=deadline, **kwargs))
+
+    def map_chunks(self, cls, fn, items, chunk, deadline=None):
+        """
+        fn(items[i:i + chunk]) for every chunk, submitted one after the other so
+        higher classes can run between chunks. Returns the list of results.
+        """
+        step = max(1, int(chunk))
+        return [self.run(cls, fn, items[i:i + step], deadline=deadline) for i in range(0, len(items), step)]
+
+    def queued(self, cls):
+        """Items of `cls` waiting for a lane"""
+        return len(self._queues[cls])
+
+    def estimate(self, fn):
+        """Recent mean run time of `fn` in seconds (0 until it has run)"""
+        return self._run_seconds.get(_fn_key(fn), 0.0)
+
+    # ----- lanes -----
+    def _share(self, cls, now):
+        """Fraction of lane time `cls` used over the window; prunes old spans"""
+        spans = self._spans[cls]
+        start = now - self.window
+        while spans and spans[0][1] is not None and spans[0][1] <= start:
+            spans.popleft()
+        busy = sum((end if end is not None else now) - max(s, start) for s, end in spans)
+        return busy / (self.window * self.workers)
+
+    def _next(self):
+        """Highest-priority job allowed to run, or (None, seconds to wait); holds the lock"""
+        now = time.perf_counter()
+        retry = None
+        for cls in CLASSES:
+            queue = self._queues[cls]
+            if not queue:
+                continue
+            limit = self.shares[cls]
+            if limit < 1.0 and self._share(cls, now) >= limit:
+                if not queue[0].throttled:
+                    queue[0].throttled = True
+                    THROTTLED.inc(**{"class": cls})
+                # old spans leave the window gradually; look again shortly
+                retry = min(retry or 1.0, max(0.01, self.window * 0.02))
+                continue
+            QUEUED.dec(**{"class": cls})
+            return queue.popleft(), None
+        return None, retry
+
+    def _lane(self):
+        self._local.on_lane = True
+        while True:
+            with self._cond:
+                job, retry = self._next()
+                while job is None:
+                    self._cond.wait(retry)
+                    job, retry = self._next()
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                reason = job.deadline.dead() if job.deadline is not None else None
+                if reason is not None:
+                    deadlines.record_dropped(job.cls, reason, self.estimate(job.fn))
+                    job.future.set_exception(deadlines.DeadlineExceeded(reason))
+                    continue
+                span = [time.perf_counter(), None]
+                self._spans[job.cls].append(span)
+            WAIT_SECONDS.observe(span[0] - job.enqueued, **{"class": job.cls})
+            try:
+                # traced(): a profiled request's stack sampler also samples this lane meanwhile
+                result = job.context.run(profiling.traced, job.fn, *job.args, **job.kwargs)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                end = time.perf_counter()
+                with self._cond:
+                    span[1] = end
+                self._observe_run(job.fn, end - span[0])
+                BUSY_SECONDS.inc(end - span[0], **{"class": job.cls})
+                reason = job.deadline.dead() if job.deadline is not None else None
+                if reason is not None:
+                    deadlines.record_wasted(job.cls, reason, end - span[0])
+
+    def _observe_run(self, fn, seconds):
+        key = _fn_key(fn)
+        previous = self._run_seconds.get(key)
+        self._run_seconds[key] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+
+    # ----- status -----
+    def _export_shares(self):
+        for cls, share in self.status()["share"].items():
+            SHARE.set(share, **{"class": cls})
+
+    def status(self):
+        with self._cond:
+            now = time.perf_counter()
+            return {
+                "workers": self.workers,
+                "window_seconds": self.window,
+                "queued": {cls: len(q) for cls, q in self._queues.items()},
+                "share": {cls: round(self._share(cls, now), 4) for cls in CLASSES},
+                "share_limit": dict(self.shares),
+            }
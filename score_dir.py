@@ -0,0 +1,220 @@
+"""
+Offline batch scoring of an image directory (screening campaigns).
+
+Reuses the server's code from main.py: model registry, EfficientNet
+preprocessing, class mapping and heatmaps. Images are decoded and resized in a
+process pool, scored in large batches, and results are written to CSV or
+Parquet as each batch completes.
+
+    python score_dir.py /data/campaign --output results.csv
+    python score_dir.py /data/campaign --output results.parquet --heatmaps heatmaps/ --explain cam
+    python score_dir.py /data/campaign --output results.csv --model-version b2-v2
+
+Re-running with the same --output resumes: images already present in the
+output are skipped. CSV output is appended to. Parquet output cannot be
+appended, so a resumed run writes <name>.part<N>.parquet next to the original.
+"""
+import argparse
+import csv
+import glob
+import multiprocessing as mp
+import os
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+# ---------- WORKERS (no TensorFlow here: runs in spawned processes) ----------
+def load_resized(args):
+    """(relpath, uint8 HxWx3 array or None, error) using main.decode_image + prepare_input's resize"""
+    root, rel, size = args
+    try:
+        with Image.open(os.path.join(root, rel)) as img:
+            arr = np.asarray(img.convert("RGB").resize((size, size)), dtype=np.uint8)
+        return rel, arr, None
+    except Exception as e:
+        return rel, None, str(e)
+
+
+def list_images(root):
+    rels = []
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTS):
+                rels.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return sorted(rels)
+
+
+# ---------- OUTPUT ----------
+def _parquet_parts(output):
+    stem, _ = os.path.splitext(output)
+    return sorted([output] * os.path.exists(output) + glob.glob(f"{glob.escape(stem)}.part*.parquet"))
+
+
+def already_scored(output):
+    """Relative paths present in an earlier (possibly interrupted) run's output"""
+    done = set()
+    if output.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for part in _parquet_parts(output):
+            try:
+                done.update(pq.read_table(part, columns=["path"]).column("path").to_pylist())
+            except Exception as e:
+                # no footer: the run died mid-file; its rows are scored again
+                print(f"ignoring unreadable {part} ({e}); renaming to {part}.broken")
+                os.replace(part, part + ".broken")
+        return done
+
+    if not os.path.exists(output):
+        return done
+    with open(output, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            # drop a torn last row
+            f.truncate(data.rfind(b"\n") + 1)
+    with open(output, newline="") as f:
+        done.update(row["path"] for row in csv.DictReader(f))
+    return done
+
+
+class CsvSink:
+    def __init__(self, output, columns):
+        new = not os.path.exists(output) or os.path.getsize(output) == 0
+        self._f = open(output, "a", newline="")
+        self._writer = csv.DictWriter(self._f, fieldnames=columns, extrasaction="ignore")
+        if new:
+            self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class ParquetSink:
+    def __init__(self, output, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path, stem, n = output, os.path.splitext(output)[0], 0
+        while os.path.exists(path) or os.path.exists(path + ".broken"):
+            n += 1
+            path = f"{stem}.part{n}.parquet"
+        self.path = path
+        self._pa = pa
+        self._schema = pa.schema([(c, pa.string() if c in STRING_COLUMNS else pa.float64()) for c in columns])
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, rows):
+        # one row group per batch
+        self._writer.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+STRING_COLUMNS = ("path", "model_version", "class_code", "class", "heatmap", "error")
+
+
+# ---------- SCORING ----------
+def explain_batch(main, mv, method, x, preds, conv):
+    """One heatmap per image (None when unavailable)"""
+    top = np.argmax(preds, axis=1)
+    if method == "cam":
+        return [main.make_cam(conv[i:i + 1], int(top[i]), mv) for i in range(len(x))]
+    if method == "gradcam":
+        return [main.make_gradcam(x[i:i + 1], mv) for i in range(len(x))]
+    return [None] * len(x)
+
+
+def run(args):
+    rels = list_images(args.input)
+    done = already_scored(args.output)
+    todo = [r for r in rels if r not in done]
+    print(f"{len(rels)} images, {len(done)} already scored, {len(todo)} to go")
+    if not todo:
+        return
+
+    # spawn, so workers never inherit TensorFlow state; started before main is imported
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(args.workers) as pool:
+        import main
+
+        mv, error = main.resolve_model(args.model_version)
+        if mv is None:
+            raise SystemExit(error)
+        method = main.resolve_explain_method(args.explain, mv) if args.heatmaps else "none"
+        if args.heatmaps:
+            os.makedirs(args.heatmaps, exist_ok=True)
+
+        columns = ["path", "model_version", "class_code", "class", "confidence"] + \
+                  [f"p_{c}" for c in mv.class_names] + ["heatmap", "error"]
+        sink = (ParquetSink if args.output.endswith(".parquet") else CsvSink)(args.output, columns)
+        print(f"model {mv.name} ({mv.img_size}px), {args.workers} decode workers, batch {args.batch_size}, "
+              f"heatmaps: {method}, writing {getattr(sink, 'path', args.output)}")
+
+        t0 = time.perf_counter()
+        scored = failed = 0
+        jobs = ((args.input, rel, mv.img_size) for rel in todo)
+        loaded = pool.imap(load_resized, jobs, chunksize=8)
+        try:
+            while True:
+                batch = [item for _, item in zip(range(args.batch_size), loaded)]
+                if not batch:
+                    break
+                rows = []
+                good = [b for b in batch if b[1] is not None]
+                for rel, _, err in batch:
+                    if err is not None:
+                        rows.append({"path": rel, "model_version": mv.name, "error": err})
+                failed += len(batch) - len(good)
+
+                if good:
+                    x = main.preprocess_input(np.stack([b[1] for b in good]).astype(np.float32))
+                    conv = None
+                    if method == "cam":
+                        preds, conv = main.forward_with_features(x, mv)
+                    else:
+                        preds = np.asarray(mv.model.predict(x, batch_size=args.batch_size, verbose=0))
+                    heatmaps = explain_batch(main, mv, method, x, preds, conv)
+
+                    for (rel, arr, _), p, hm in zip(good, preds, heatmaps):
+                        code, confidence, info = main.class_info(p, mv.class_names)
+                        row = {"path": rel, "model_version": mv.name, "class_code": code,
+                               "class": info["name"], "confidence": round(confidence, 2)}
+                        row.update({f"p_{c}": round(float(v), 6) for c, v in zip(mv.class_names, p)})
+                        if hm is not None:
+                            out = os.path.join(args.heatmaps, os.path.splitext(rel)[0] + ".jpg")
+                            os.makedirs(os.path.dirname(out), exist_ok=True)
+                            cv2.imwrite(out, main.overlay_heatmap(Image.fromarray(arr), hm))
+                            row["heatmap"] = os.path.relpath(out, args.heatmaps)
+                        rows.append(row)
+                    scored += len(good)
+
+                sink.write(rows)
+                elapsed = time.perf_counter() - t0
+                print(f"{scored + failed}/{len(todo)}  {scored / elapsed:.1f} img/s  ({failed} failed)", flush=True)
+        finally:
+            sink.close()
+
+    elapsed = time.perf_counter() - t0
+    print(f"done: {scored} scored, {failed} failed in {elapsed:.1f}s ({scored / max(elapsed, 1e-9):.1f} img/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="directory of images (searched recursively)")
+    parser.add_argument("--output", required=True, help="results .csv or .parquet")
+    parser.add_argument("--model-version", default="", help="registry version (default: active)")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--heatmaps", default=None, help="write heatmap overlays to this directory")
+    parser.add_argument("--explain", default="auto", choices=["auto", "cam", "gradcam"])
+    run(parser.parse_args())
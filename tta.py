@@ -0,0 +1,54 @@
+"""
+Test-time augmentation (TTA) helpers.
+
+All augmented views of an image are stacked into a single batch so the model
+runs once per request instead of once per view.
+"""
+import numpy as np
+
+# flips and right-angle rotations keep the lesion content intact
+TTA_TRANSFORMS = ("identity", "hflip", "vflip", "rot90", "rot180", "rot270")
+
+
+def _apply(arr: np.ndarray, name: str) -> np.ndarray:
+    """Apply one named transform to a single (H, W, C) image."""
+    if name == "identity":
+        return arr
+    if name == "hflip":
+        return arr[:, ::-1, :]
+    if name == "vflip":
+        return arr[::-1, :, :]
+    if name == "rot90":
+        return np.rot90(arr, k=1, axes=(0, 1))
+    if name == "rot180":
+        return np.rot90(arr, k=2, axes=(0, 1))
+    if name == "rot270":
+        return np.rot90(arr, k=3, axes=(0, 1))
+    raise ValueError(f"Unknown TTA transform: {name}")
+
+
+def augment_batch(batch: np.ndarray, transforms=TTA_TRANSFORMS) -> np.ndarray:
+    """
+    Expand a (N, H, W, C) batch into (N * V, H, W, C) augmented views.
+    Views are image-major: rows [i*V, (i+1)*V) all belong to image i.
+    """
+    n, h, w, c = batch.shape
+    if h != w and any(t in ("rot90", "rot270") for t in transforms):
+        raise ValueError("90-degree rotations require square inputs")
+    views = len(transforms)
+    out = np.empty((n * views, h, w, c), dtype=batch.dtype)
+    for i in range(n):
+        for j, name in enumerate(transforms):
+            out[i * views + j] = _apply(batch[i], name)
+    return out
+
+
+def aggregate_views(preds: np.ndarray, n_views: int):
+    """
+    Collapse (N * V, K) view probabilities into per-image mean and variance.
+    Returns (mean, variance), both shaped (N, K).
+    """
+    preds = np.asarray(preds, dtype=np.float32)
+    k = preds.shape[-1]
+    grouped = preds.reshape(-1, n_views, k)
+    return grouped.mean(axis=1), grouped.var(axis=1)